@@ -259,6 +259,7 @@ TEMPLATE_CONTEXT_PROCESSORS = tuple(TEMPLATE_CONTEXT_PROCESSORS) + (
 
 MIDDLEWARE_CLASSES = tuple(MIDDLEWARE_CLASSES) + (
     "cartridge.shop.middleware.SSLRedirect",
+    "cartridge.shop.middleware.PageCache",
 )
 
 ##################
@@ -25,7 +25,8 @@ shipping_fields = [f.name for f in Order._meta.fields
 category_fieldsets = deepcopy(PageAdmin.fieldsets)
 category_fieldsets[0][1]["fields"][3:3] = ["content"]#, "products"]
 category_fieldsets += ((_("Product filters"), {
-    "fields": ("options", "sale", ("price_min", "price_max"), "combined"),
+    "fields": ("options", "sale", ("price_min", "price_max"), "combined",
+               "include_descendants"),
     "classes": ("collapse-closed",)},),)
 
 class CategoryAdmin(PageAdmin):
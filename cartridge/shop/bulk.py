@@ -0,0 +1,85 @@
+"""
+Helpers for writing many model instances at once, for imports and
+other batch jobs. Rows are written with a single statement execution
+per chunk via ``executemany`` rather than saving each instance, so
+``save`` methods aren't called and no signals are sent - callers are
+responsible for anything those would otherwise do, such as bumping
+the catalog cache version.
+"""
+
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+
+def _chunks(items, chunk_size):
+    """
+    Yields lists of ``chunk_size`` items from the given iterable.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _values(fields, instance, add):
+    """
+    Returns the database values for the given fields of the instance.
+    """
+    return [f.get_db_prep_save(f.pre_save(instance, add),
+                               connection=connection) for f in fields]
+
+
+def insert(model, instances, chunk_size=1000):
+    """
+    Inserts the given unsaved instances of the model. Field values are
+    prepared the same way ``save`` prepares them, so ``auto_now`` and
+    ``auto_now_add`` fields are set. IDs aren't set on the instances,
+    so callers look them up afterwards by a unique field if needed.
+    """
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    columns = ", ".join([connection.ops.quote_name(f.column) for f in fields])
+    placeholders = ", ".join(["%s"] * len(fields))
+    table = connection.ops.quote_name(model._meta.db_table)
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, columns, placeholders)
+    cursor = connection.cursor()
+    for chunk in _chunks(instances, chunk_size):
+        cursor.executemany(sql, [_values(fields, instance, True)
+                                 for instance in chunk])
+    transaction.commit_unless_managed()
+
+
+def update(model, field_names, instances, chunk_size=1000):
+    """
+    Updates the given field names for each of the given instances,
+    which must have IDs.
+    """
+    fields = [model._meta.get_field(name) for name in field_names]
+    assignments = ", ".join(["%s = %%s" % connection.ops.quote_name(f.column)
+                             for f in fields])
+    table = connection.ops.quote_name(model._meta.db_table)
+    sql = "UPDATE %s SET %s WHERE id = %%s" % (table, assignments)
+    cursor = connection.cursor()
+    for chunk in _chunks(instances, chunk_size):
+        cursor.executemany(sql, [_values(fields, instance, False) +
+                                 [instance.id] for instance in chunk])
+    transaction.commit_unless_managed()
+
+
+def insert_rows(table, columns, rows, chunk_size=1000):
+    """
+    Inserts the given rows of values for the given columns of a table,
+    such as the table for a many-to-many relationship.
+    """
+    table = connection.ops.quote_name(table)
+    placeholders = ", ".join(["%s"] * len(columns))
+    columns = ", ".join([connection.ops.quote_name(c) for c in columns])
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, columns, placeholders)
+    cursor = connection.cursor()
+    for chunk in _chunks(rows, chunk_size):
+        cursor.executemany(sql, chunk)
+    transaction.commit_unless_managed()
@@ -0,0 +1,408 @@
+"""
+Versioned cache for catalog data. Each cached value is stored under a
+key made up of its name and the current version of each of the scopes
+it depends on - sitewide, a single product or a single category. When
+catalog models change, the versions of the affected scopes are bumped
+so that the old keys are no longer used and simply expire. Since the
+versions are stored in the cache itself, a bump on one server
+invalidates the data for all servers sharing the cache. Full pages
+for anonymous users are cached the same way via ``PageCache``
+middleware, which also answers conditional requests using the
+modified times stored against products and categories.
+"""
+
+from datetime import datetime
+from hashlib import md5
+from time import mktime, time
+
+from django.core.cache import cache
+from django.db.models import Max, Min, Q
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.http import quote_etag
+
+from mezzanine.conf import settings
+from mezzanine.utils.device import device_from_request
+
+
+SITE = "site"
+
+# Versions are kept for as long as possible, and any expiring simply
+# invalidates the data cached against them.
+VERSION_TIMEOUT = 60 * 60 * 24 * 365
+
+
+def product_scope(product_id):
+    """
+    Scope for data belonging to a single product.
+    """
+    return "product-%s" % product_id
+
+
+def category_scope(category_id):
+    """
+    Scope for data belonging to a single category.
+    """
+    return "category-%s" % category_id
+
+
+def _version_key(scope):
+    return "shop-catalog-version-%s" % scope
+
+
+def versions(scopes):
+    """
+    Returns the current version for each of the given scopes, setting
+    up versions for any that don't exist yet. Versions start at the
+    current time so that a version lost from the cache is never reused.
+    """
+    keys = [_version_key(scope) for scope in scopes]
+    current = cache.get_many(keys)
+    for key in keys:
+        if key not in current:
+            cache.add(key, int(time()), VERSION_TIMEOUT)
+            current[key] = cache.get(key)
+    return [current[key] for key in keys]
+
+
+def bump(*scopes):
+    """
+    Increment the version of each of the given scopes, invalidating
+    all data cached against them.
+    """
+    for scope in scopes:
+        key = _version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time()), VERSION_TIMEOUT)
+
+
+def _timeout(timeout):
+    """
+    Returns the given cache timeout, capped at the time until the next
+    product is published or expires. Nothing is saved when that
+    happens, so cached products and pages would otherwise keep showing
+    or hiding the product until the timeout.
+    """
+    from cartridge.shop.models import Product
+    now = datetime.now()
+    for field in ("publish_date", "expiry_date"):
+        products = Product.objects.filter(**{"%s__gt" % field: now})
+        date = products.aggregate(date=Min(field))["date"]
+        if date is not None:
+            # timedelta.total_seconds() isn't available in Python 2.6.
+            delta = date - now
+            seconds = delta.days * 86400 + delta.seconds
+            if delta.microseconds:
+                seconds += 1
+            timeout = max(1, min(timeout, seconds))
+    return timeout
+
+
+def get_or_set(name, scopes, func, for_user=None):
+    """
+    Returns the value cached for the given name and scopes, calling
+    ``func`` to create and cache it if it isn't cached, until the next
+    product is published or expires at the latest. Staff users
+    can view unpublished products so they bypass the cache, as does
+    everyone if ``SHOP_CATALOG_CACHE_SECONDS`` is zero.
+    """
+    timeout = settings.SHOP_CATALOG_CACHE_SECONDS
+    if not timeout or (for_user is not None and for_user.is_staff):
+        return func()
+    parts = [name] + ["%s=%s" % v for v in zip(scopes, versions(scopes))]
+    key = md5(u"|".join(parts).encode("utf-8")).hexdigest()
+    key = "shop-catalog-%s" % key
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, _timeout(timeout))
+    return value
+
+
+def freeze_page(page):
+    """
+    Evaluates a page of products and its totals so that it can be
+    cached without pickling the full queryset being paged through.
+    """
+    page.object_list = list(page.object_list)
+    paginator = page.paginator
+    paginator._count = paginator.count
+    paginator.object_list = None
+    return page
+
+
+def cache_page(request):
+    """
+    Marks the page for the request as one that can be cached in full,
+    if ``SHOP_PAGE_CACHE_SECONDS`` is set and the request is a ``GET``
+    by an anonymous user. Templates can then check for
+    ``request.shop_page_cache`` and leave out anything specific to
+    the visitor, such as the cart and wishlist.
+    """
+    if (settings.SHOP_PAGE_CACHE_SECONDS and request.method == "GET" and
+        not request.user.is_authenticated()):
+        request.shop_page_cache = True
+
+
+def _page_key(request):
+    """
+    Cache key for the full page of the request, which is versioned
+    against the entire catalog since any product can appear on any
+    listing page.
+    """
+    parts = [request.get_host(), request.get_full_path(),
+             device_from_request(request), versions([SITE])[0]]
+    key = u"|".join([unicode(part) for part in parts]).encode("utf-8")
+    return "shop-page-%s" % md5(key).hexdigest()
+
+
+def _has_messages(request):
+    """
+    Messages are specific to the visitor, so pages showing them can't
+    be cached or served from the cache.
+    """
+    return len(getattr(request, "_messages", [])) > 0
+
+
+def _shared(request):
+    """
+    Returns ``True`` if the page for the request is the same for all
+    visitors - an anonymous ``GET`` without messages, where the cart
+    and wishlist are either loaded separately or known to be empty
+    since the visitor doesn't have session or wishlist cookies yet.
+    """
+    if (request.method != "GET" or request.user.is_authenticated() or
+        _has_messages(request)):
+        return False
+    if settings.SHOP_PAGE_CACHE_SECONDS:
+        return True
+    for cookie in (settings.SESSION_COOKIE_NAME, "wishlist"):
+        if cookie in request.COOKIES:
+            return False
+    return True
+
+
+def get_page(request):
+    """
+    Returns the cached page for the request if there is one, or a
+    ``304`` response if the visitor's copy of it is current.
+    """
+    if not settings.SHOP_PAGE_CACHE_SECONDS or not _shared(request):
+        return None
+    cached = cache.get(_page_key(request))
+    if cached is not None:
+        content, modified = cached
+        if modified is not None:
+            request.shop_last_modified = modified
+            if _is_current(request, modified):
+                return HttpResponseNotModified()
+        return HttpResponse(content)
+
+
+def set_page(request, response):
+    """
+    Caches the page for the request if it was marked with
+    ``cache_page``. The CSRF token of the visitor the page was
+    rendered for is removed, and is loaded into the page along with
+    the cart.
+    """
+    if (not getattr(request, "shop_page_cache", False) or
+        response.status_code != 200 or _has_messages(request)):
+        return
+    content = response.content
+    token = request.META.get("CSRF_COOKIE")
+    if token:
+        content = content.replace(token, "")
+    modified = getattr(request, "shop_last_modified", None)
+    cache.set(_page_key(request), (content, modified),
+              _timeout(settings.SHOP_PAGE_CACHE_SECONDS))
+
+
+def _timestamp(modified):
+    return int(mktime(modified.timetuple()))
+
+
+def _etag(request, modified):
+    """
+    ETag for the page of the request as of the given modified time.
+    """
+    parts = [request.get_host(), request.get_full_path(),
+             device_from_request(request), modified.isoformat()]
+    key = u"|".join([unicode(part) for part in parts]).encode("utf-8")
+    return md5(key).hexdigest()
+
+
+def _is_current(request, modified):
+    """
+    Returns ``True`` if the ``If-None-Match`` header, or failing that
+    the ``If-Modified-Since`` header of the request, match the page
+    as of the given modified time.
+    """
+    etags = request.META.get("HTTP_IF_NONE_MATCH")
+    if etags is not None:
+        return _etag(request, modified) in parse_etags(etags)
+    since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+    since = parse_http_date_safe(since) if since else None
+    return since is not None and since >= _timestamp(modified)
+
+
+def _with_sales(modified, sale_dates):
+    """
+    Prices change when sales start and end without anything being
+    saved, so returns the latest of the given modified time and the
+    sale start and end times that have passed.
+    """
+    now = datetime.now()
+    for dates in sale_dates:
+        for date in dates:
+            if date is not None and modified < date <= now:
+                modified = date
+    return modified
+
+
+def product_modified(slug):
+    """
+    Returns the time the published product with the given slug was
+    last modified.
+    """
+    from cartridge.shop.models import Product
+    products = Product.objects.published().filter(slug=slug)
+    fields = ("date_modified", "sale_from", "sale_to")
+    for modified, sale_from, sale_to in products.values_list(*fields)[:1]:
+        if modified is not None:
+            return _with_sales(modified, [(sale_from, sale_to)])
+
+
+def category_modified(category):
+    """
+    Returns the time the given category's products were last
+    modified. Categories with filters can match any product, so
+    rather than being updated whenever a product changes, the latest
+    modified time of the products they match is used. Any sale can
+    apply to the products listed, so the dates of all active sales
+    are used.
+    """
+    from cartridge.shop.models import Product, Sale
+    modified = category.date_modified
+    if (category.sale_id or category.price_min or category.price_max or
+        category.options.exists()):
+        products = Product.objects.filter(category.filters())
+        latest = products.aggregate(latest=Max("date_modified"))["latest"]
+        if latest is not None and (modified is None or latest > modified):
+            modified = latest
+    if modified is not None:
+        sales = Sale.objects.filter(active=True)
+        sale_dates = sales.values_list("valid_from", "valid_to")
+        return _with_sales(modified, sale_dates)
+
+
+def not_modified(request, modified_func):
+    """
+    For pages that are the same for all visitors, returns a ``304``
+    response if the ``If-None-Match`` or ``If-Modified-Since``
+    headers of the request show the visitor's copy is current,
+    according to the modified time returned by ``modified_func``.
+    Otherwise the modified time is stored for ``PageCache`` middleware
+    to add the ``ETag`` and ``Last-Modified`` headers to the response.
+    """
+    if not _shared(request):
+        return None
+    modified = modified_func()
+    if modified is not None:
+        request.shop_last_modified = modified
+        if _is_current(request, modified):
+            return HttpResponseNotModified()
+
+
+def set_modified(request, response):
+    """
+    Adds the ``ETag`` and ``Last-Modified`` headers to the response
+    using the modified time stored by ``not_modified``.
+    """
+    modified = getattr(request, "shop_last_modified", None)
+    if modified is not None and response.status_code in (200, 304):
+        response["Last-Modified"] = http_date(_timestamp(modified))
+        response["ETag"] = quote_etag(_etag(request, modified))
+
+
+def touch(products=None, categories=None):
+    """
+    Updates the modified time of the given product and category IDs.
+    Along with the products, the products they're related to and the
+    categories they're selected for are updated. Categories with
+    filters aren't, since they can match any product - their modified
+    time is derived from the products they match in
+    ``category_modified``. The parents of all categories updated are
+    also updated, since they can include the products of their
+    subcategories.
+    """
+    from cartridge.shop.models import Category, CategoryAncestry, Product
+    now = datetime.now()
+    product_ids = list(products or [])
+    category_ids = list(categories or [])
+    if product_ids:
+        related = Q(id__in=product_ids) | Q(related_products__in=product_ids)
+        Product.objects.filter(related).update(date_modified=now)
+        selected = Category.objects.filter(products__in=product_ids)
+        category_ids.extend(selected.values_list("id", flat=True))
+    if category_ids:
+        ancestry = CategoryAncestry.objects.filter(descendant__in=category_ids)
+        category_ids.extend(ancestry.values_list("ancestor", flat=True))
+        categories = Category.objects.filter(id__in=set(category_ids))
+        categories.update(date_modified=now)
+
+
+def _touch_instance(instance):
+    """
+    Updates the modified time for the given catalog model instance.
+    """
+    from cartridge.shop.models import Category, Product
+    if isinstance(instance, Product):
+        touch(products=[instance.id])
+    elif isinstance(instance, Category):
+        touch(categories=[instance.id])
+    elif getattr(instance, "product_id", None) is not None:
+        touch(products=[instance.product_id])
+
+
+def catalog_changed(sender, instance, **kwargs):
+    """
+    Signal handler for saving or deleting catalog models - bumps the
+    sitewide version, since product listings and related products
+    can contain any product, along with the version of the product
+    or category changed, and updates their modified times.
+    """
+    from cartridge.shop.models import Category, Product
+    scopes = [SITE]
+    if isinstance(instance, Product):
+        scopes.append(product_scope(instance.id))
+    elif isinstance(instance, Category):
+        scopes.append(category_scope(instance.id))
+    elif getattr(instance, "product_id", None) is not None:
+        scopes.append(product_scope(instance.product_id))
+    bump(*scopes)
+    _touch_instance(instance)
+
+
+def catalog_deleting(sender, instance, **kwargs):
+    """
+    Signal handler for catalog models about to be deleted. Their
+    relationships are removed before ``post_delete`` is sent, so the
+    categories listing them are updated beforehand.
+    """
+    _touch_instance(instance)
+
+
+def catalog_relations_changed(sender, instance, action, **kwargs):
+    """
+    Signal handler for changes to the many-to-many relationships
+    between catalog models, such as a product's categories. The
+    categories a product is being removed from are updated before
+    the relationships are removed.
+    """
+    if action.startswith("post_"):
+        catalog_changed(sender, instance)
+    elif action in ("pre_remove", "pre_clear"):
+        _touch_instance(instance)
@@ -4,8 +4,7 @@ Checkout process utilities.
 
 from django.utils.translation import ugettext as _
 
-from mezzanine.conf import settings
-
+from cartridge.shop.conf import settings
 from cartridge.shop.models import Order
 from cartridge.shop.utils import set_shipping, send_mail_template, sign
 
@@ -31,7 +30,6 @@ def default_billship_handler(request, order_form):
     ``cartridge.shop.utils.set_shipping``. The Cart object is also 
     accessible via ``Cart.objects.from_request(request)``
     """
-    settings.use_editable()
     set_shipping(request, _("Flat rate shipping"), 
                  settings.SHOP_DEFAULT_SHIPPING_VALUE)
 
@@ -93,7 +91,6 @@ def send_order_email(request, order):
     """
     Send order receipt email on successful order.
     """
-    settings.use_editable()
     order_context = {"order": order, "request": request, 
         "order_items": order.items.all()}
     for fieldset in ("billing_detail", "shipping_detail"):
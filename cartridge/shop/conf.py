@@ -0,0 +1,100 @@
+"""
+Process-wide snapshot of Mezzanine's editable settings. Accessing an
+editable setting via ``mezzanine.conf.settings`` after calling its
+``use_editable`` method loads all editable settings from the database
+again, so the shop instead reads settings via the ``settings`` object
+here, which keeps the editable settings loaded for
+``SHOP_SETTINGS_CACHE_SECONDS``, or until a setting is saved in the
+current process. All other settings are read from
+``mezzanine.conf.settings`` as usual.
+"""
+
+from threading import Lock
+from time import time
+
+from django.contrib.sites.models import Site
+
+from mezzanine.conf import registry, settings as mezzanine_settings
+
+
+class EditableSettings(object):
+    """
+    Provides settings via attribute access like
+    ``mezzanine.conf.settings`` with editable settings read from a
+    snapshot per site, rather than from the database each time
+    ``use_editable`` is called.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = Lock()
+
+    def _load(self):
+        """
+        Loads the editable settings stored in the database for the
+        current site, converted to their registered types.
+        """
+        values = {}
+        if "mezzanine.conf" not in mezzanine_settings.INSTALLED_APPS:
+            return values
+        from mezzanine.conf.models import Setting
+        site = Site.objects.get_current()
+        for setting_obj in Setting.objects.filter(site=site):
+            try:
+                setting_type = registry[setting_obj.name]["type"]
+            except KeyError:
+                continue
+            if setting_type is bool:
+                setting_value = setting_obj.value != "False"
+            else:
+                setting_value = setting_type(setting_obj.value)
+            values[setting_obj.name] = setting_value
+        return values
+
+    def _snapshot(self):
+        """
+        Returns the editable settings for the current site, loading
+        them if they haven't been loaded or have expired.
+        """
+        site_id = mezzanine_settings.SITE_ID
+        timeout = mezzanine_settings.SHOP_SETTINGS_CACHE_SECONDS
+        loaded, values = self._snapshots.get(site_id, (0, None))
+        if time() - loaded < timeout:
+            return values
+        self._lock.acquire()
+        try:
+            # Another thread may have loaded them while waiting.
+            loaded, values = self._snapshots.get(site_id, (0, None))
+            if time() - loaded >= timeout:
+                values = self._load()
+                self._snapshots[site_id] = (time(), values)
+        finally:
+            self._lock.release()
+        return values
+
+    def refresh(self):
+        """
+        Expires the editable settings for all sites so that they're
+        loaded again on next access.
+        """
+        self._snapshots = {}
+
+    def __getattr__(self, name):
+        try:
+            setting = registry[name]
+        except KeyError:
+            setting = None
+        if setting is None or not setting["editable"]:
+            return getattr(mezzanine_settings, name)
+        return self._snapshot().get(name, setting["default"])
+
+
+settings = EditableSettings()
+
+
+def settings_changed(sender, **kwargs):
+    """
+    Signal handler for saving or deleting Mezzanine's ``Setting``
+    model - expires the editable settings snapshot.
+    """
+    settings.refresh()
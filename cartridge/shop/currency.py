@@ -0,0 +1,157 @@
+"""
+Currency formatting according to the ``SHOP_CURRENCY_LOCALE`` setting.
+The monetary conventions of each locale are read from the ``locale``
+module once only, into a ``CurrencyFormatter`` that's then used for
+formatting without changing the locale of the process, which isn't
+thread-safe. A different locale can be used for the current thread,
+eg per site or per request, with ``activate`` and ``deactivate``.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from locale import Error, LC_MONETARY, localeconv, setlocale
+from threading import Lock, local
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.translation import ugettext as _
+
+from mezzanine.conf import settings
+
+
+# localeconv() value for conventions a locale doesn't specify.
+CHAR_MAX = 127
+
+_formatters = {}
+_formatters_lock = Lock()
+_active = local()
+
+
+class CurrencyFormatter(object):
+    """
+    Formats amounts as currency using the monetary conventions of a
+    locale, as returned by ``locale.localeconv``. Formatters are
+    shared between threads so can't be changed once created.
+    """
+
+    def __init__(self, conv):
+        for name in ("currency_symbol", "frac_digits", "mon_decimal_point",
+                     "p_cs_precedes", "p_sep_by_space", "p_sign_posn",
+                     "positive_sign", "n_cs_precedes", "n_sep_by_space",
+                     "n_sign_posn", "negative_sign"):
+            object.__setattr__(self, name, conv[name])
+        exponent = Decimal(10) ** -self.frac_digits
+        object.__setattr__(self, "exponent", exponent)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CurrencyFormatter instances can't be changed")
+
+    def quantize(self, value):
+        """
+        Returns the given value as a ``Decimal`` rounded to the number
+        of decimal places for the currency.
+        """
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return value.quantize(self.exponent, ROUND_HALF_UP)
+
+    def format(self, value):
+        """
+        Returns the given value formatted as currency, the same way as
+        ``locale.currency`` does.
+        """
+        value = self.quantize(value)
+        negative = value < 0
+        amount = str(abs(value)).replace(".", self.mon_decimal_point)
+        if negative:
+            precedes, separated = self.n_cs_precedes, self.n_sep_by_space
+            sign_posn, sign = self.n_sign_posn, self.negative_sign
+        else:
+            precedes, separated = self.p_cs_precedes, self.p_sep_by_space
+            sign_posn, sign = self.p_sign_posn, self.positive_sign
+        if sign_posn == 3:
+            amount = sign + amount
+        elif sign_posn == 4:
+            amount = amount + sign
+        space = separated and " " or ""
+        if precedes:
+            formatted = self.currency_symbol + space + amount
+        else:
+            formatted = amount + space + self.currency_symbol
+        if sign_posn == 0:
+            return "(%s)" % formatted
+        elif sign_posn == 2:
+            return formatted + sign
+        elif sign_posn in (3, 4):
+            return formatted
+        return sign + formatted
+
+
+def _load(locale_name):
+    """
+    Reads the monetary conventions for the given locale name, restoring
+    the previous locale for the process afterwards.
+    """
+    previous = setlocale(LC_MONETARY)
+    try:
+        try:
+            if setlocale(LC_MONETARY, locale_name) == "C":
+                # C locale doesn't contain a suitable value for
+                # "frac_digits".
+                raise Error
+            conv = localeconv()
+        finally:
+            setlocale(LC_MONETARY, previous)
+    except Error:
+        conv = {"frac_digits": CHAR_MAX}
+    if conv["frac_digits"] == CHAR_MAX:
+        msg = _("Invalid currency locale specified for SHOP_CURRENCY_LOCALE: "
+                "'%s'. You'll need to set the locale for your system, or "
+                "configure the SHOP_CURRENCY_LOCALE setting in your settings "
+                "module.")
+        raise ImproperlyConfigured(msg % locale_name)
+    return CurrencyFormatter(conv)
+
+
+def get_formatter(locale_name=None):
+    """
+    Returns the formatter for the given locale name, defaulting to the
+    locale activated for the current thread, or the
+    ``SHOP_CURRENCY_LOCALE`` setting.
+    """
+    if locale_name is None:
+        locale_name = getattr(_active, "locale_name", None)
+        if locale_name is None:
+            locale_name = settings.SHOP_CURRENCY_LOCALE
+    try:
+        return _formatters[locale_name]
+    except KeyError:
+        _formatters_lock.acquire()
+        try:
+            if locale_name not in _formatters:
+                _formatters[locale_name] = _load(locale_name)
+            return _formatters[locale_name]
+        finally:
+            _formatters_lock.release()
+
+
+def activate(locale_name):
+    """
+    Uses the given locale name for formatting currency in the current
+    thread, eg from middleware for a request.
+    """
+    get_formatter(locale_name)
+    _active.locale_name = locale_name
+
+
+def deactivate():
+    """
+    Reverts the current thread to the ``SHOP_CURRENCY_LOCALE`` setting.
+    """
+    _active.locale_name = None
+
+
+def format_currency(value, locale_name=None):
+    """
+    Formats the given value as currency for the given locale name, or
+    the current locale.
+    """
+    return get_formatter(locale_name).format(value)
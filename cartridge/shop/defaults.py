@@ -20,6 +20,28 @@ register_setting(
     default=30,
 )
 
+register_setting(
+    name="SHOP_CATALOG_CACHE_SECONDS",
+    description="Number of seconds products, categories and related "
+        "products are cached for. Cached data is invalidated whenever the "
+        "catalog changes, so a cache backend shared by all servers should "
+        "be used. Set to 0 to disable caching of the catalog.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_CATALOG_SERIALIZERS",
+    description="Sequence of name/dotted path pairs of the classes the "
+        "``product_db`` command can export and import the whole catalog "
+        "with, selected with its ``--format`` option.",
+    editable=False,
+    default=(
+        ("jsonl", "cartridge.shop.serializers.JSONLinesSerializer"),
+        ("npz", "cartridge.shop.serializers.ColumnarSerializer"),
+    ),
+)
+
 register_setting(
     name="SHOP_CHECKOUT_ACCOUNT_ENABLED",
     description="If True, users can create a login for the checkout process.",
@@ -78,7 +100,8 @@ register_setting(
 register_setting(
     name="SHOP_FORCE_SSL_VIEWS",
     description="Sequence of view names that will be forced to run over SSL "
-        "when SSL_ENABLED is True.",
+        "when SSL_ENABLED is True. Entries beginning with a slash are used "
+        "as URL path prefixes, forcing all URLs under them to run over SSL.",
     editable=False,
     default=("shop_checkout", "shop_complete", "shop_account"),
 )
@@ -112,6 +135,17 @@ register_setting(
     default="cartridge.shop.checkout.default_payment_handler",
 )
 
+register_setting(
+    name="SHOP_IMAGE_THUMBNAIL_SIZES",
+    description="Sequence of width/height pairs of the thumbnails "
+        "generated for product images when importing products, so that "
+        "they aren't generated when pages are first viewed. These should "
+        "match the sizes used by the ``thumbnail`` tag in the shop's "
+        "templates.",
+    editable=False,
+    default=((30, 30), (75, 75), (90, 90), (0, 300)),
+)
+
 register_setting(
     name="SHOP_OPTION_TYPE_CHOICES",
     description="Sequence of value/name pairs for types of product options, "
@@ -140,6 +174,34 @@ register_setting(
     ),
 )
 
+register_setting(
+    name="SHOP_PAGE_CACHE_SECONDS",
+    description="Number of seconds the full pages for products, categories "
+        "and search results are cached for when viewed by anonymous users. "
+        "The cart and wishlist are then loaded into cached pages "
+        "separately. Cached pages are invalidated whenever the catalog "
+        "changes. Set to 0 to disable caching of pages.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_PAGING_COUNT_CACHE_SECONDS",
+    description="Number of seconds the total number of products is cached "
+        "for when paging products with ``SHOP_PAGING_KEYSET``.",
+    editable=False,
+    default=300,
+)
+
+register_setting(
+    name="SHOP_PAGING_KEYSET",
+    description="If True, sorted product listings are paged using next and "
+        "previous cursors keyed on the sort field, rather than page "
+        "numbers, so that deep pages are as fast to load as the first.",
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="SHOP_PER_PAGE_CATEGORY",
     description="Number of products to display per category page.",
@@ -175,6 +237,26 @@ register_setting(
     ),
 )
 
+register_setting(
+    name="SHOP_RECOMMENDATIONS_MAX",
+    description="Maximum number of products bought together with the "
+        "products in the cart to show, when none of them have upsell "
+        "products. Recommendations are built from past orders by the "
+        "build_recommendations command.",
+    editable=False,
+    default=10,
+)
+
+register_setting(
+    name="SHOP_SETTINGS_CACHE_SECONDS",
+    description="Number of seconds the shop keeps editable settings loaded "
+        "for before loading them from the database again. Settings saved "
+        "via the admin are loaded again immediately in the process that "
+        "saved them.",
+    editable=False,
+    default=60,
+)
+
 register_setting(
     name="SHOP_SSL_ENABLED",
     description="If True, users will be automatically redirect to HTTPS "
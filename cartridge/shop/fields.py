@@ -3,12 +3,12 @@ Various model fields that mostly provide default field sizes to ensure
 these are consistant when used across multiple models.
 """
 
-from locale import localeconv
-
 from django.db.models import CharField, DecimalField
 from django.utils.translation import ugettext_lazy as _
 
-from cartridge.shop.utils import set_locale
+from mezzanine.conf import settings
+
+from cartridge.shop.currency import get_formatter
 
 
 class OptionField(CharField):
@@ -28,9 +28,9 @@ class MoneyField(DecimalField):
     precision.
     """
     def __init__(self, *args, **kwargs):
-        set_locale()
+        formatter = get_formatter(settings.SHOP_CURRENCY_LOCALE)
         defaults = {"null": True, "blank": True, "max_digits": 10, 
-                    "decimal_places": localeconv()["frac_digits"]}
+                    "decimal_places": formatter.frac_digits}
         defaults.update(kwargs)
         super(MoneyField, self).__init__(*args, **defaults)
 
@@ -2,11 +2,11 @@
 from copy import copy
 from datetime import datetime
 from itertools import dropwhile, takewhile
-from locale import localeconv
-from re import match
+from re import match, split
 
 from django import forms
 from django.forms.models import BaseInlineFormSet, ModelFormMetaclass
+from django.forms.models import inlineformset_factory
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import User
 from django.utils.datastructures import SortedDict
@@ -17,9 +17,10 @@ from mezzanine.conf import settings
 from mezzanine.core.templatetags.mezzanine_tags import thumbnail
 
 from cartridge.shop import checkout
+from cartridge.shop.currency import get_formatter
 from cartridge.shop.models import Product, ProductOption, ProductVariation
-from cartridge.shop.models import Cart, Order, DiscountCode
-from cartridge.shop.utils import make_choices, set_locale
+from cartridge.shop.models import Cart, CartItem, Order, DiscountCode
+from cartridge.shop.utils import make_choices
 
 
 ADD_PRODUCT_ERRORS = {
@@ -28,6 +29,14 @@ ADD_PRODUCT_ERRORS = {
     "no_stock_quantity": _("The selected quantity is currently unavailable."),
 }
 
+BULK_ADD_ERRORS = {
+    "invalid_line": _("Line %(line)s should contain a SKU and quantity."),
+    "invalid_sku": _("%(sku)s is currently unavailable."),
+    "no_stock": _("%(sku)s is currently not in stock."),
+    "no_stock_quantity": _("The selected quantity of %(sku)s is currently "
+                           "unavailable."),
+}
+
 
 def get_add_product_form(product):
     """
@@ -70,10 +79,13 @@ def get_add_product_form(product):
                 options["unit_price__isnull"] = False
             error = None
             try:
-                variation = product.variations.get(**options)
+                variations = product.variations.select_related("image")
+                variation = variations.get(**options)
             except ProductVariation.DoesNotExist:
                 error = "invalid_options"
             else:
+                # Saves querying the product again for the cart item.
+                variation.product = product
                 if self._to_cart:
                     if not variation.has_stock():
                         error = "no_stock"
@@ -87,6 +99,160 @@ def get_add_product_form(product):
     return AddProductForm
 
 
+class CartLinesField(forms.Field):
+    """
+    List of SKU and quantity pairs, entered as text with a SKU and
+    quantity on each line, or given as a list of pairs or dicts with
+    ``sku`` and ``quantity`` keys when posted as JSON.
+    """
+
+    widget = forms.Textarea
+
+    def to_python(self, value):
+        if not value:
+            return []
+        if isinstance(value, basestring):
+            value = [split("[\s,]+", line.strip()) for line in
+                     value.splitlines() if line.strip()]
+        if not isinstance(value, (list, tuple)):
+            raise forms.ValidationError(self.error_messages["invalid"])
+        lines = []
+        errors = []
+        for i, line in enumerate(value):
+            if isinstance(line, dict):
+                line = (line.get("sku"), line.get("quantity", 1))
+            try:
+                if isinstance(line, list) and len(line) == 1:
+                    line.append(1)
+                sku, quantity = line
+                quantity = int(quantity)
+                if not sku or quantity < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                error = BULK_ADD_ERRORS["invalid_line"] % {"line": i + 1}
+                errors.append(error)
+            else:
+                lines.append((unicode(sku), quantity))
+        if errors:
+            raise forms.ValidationError(errors)
+        return lines
+
+
+class BulkAddProductForm(forms.Form):
+    """
+    Form for adding multiple variations to the cart by SKU, such as
+    when reordering. The variations and their stock levels are loaded
+    with a single query each for all lines, and the errors for every
+    line are reported together.
+    """
+
+    items = CartLinesField(label=_("Items"),
+        help_text=_("Enter a SKU and quantity on each line."))
+
+    def __init__(self, *args, **kwargs):
+        self._for_user = kwargs.pop("for_user", None)
+        self.lines = []
+        super(BulkAddProductForm, self).__init__(*args, **kwargs)
+
+    def clean_items(self):
+        """
+        Set the form's lines of variations and quantities if all of
+        the SKUs are available with enough stock. Quantities for the
+        same SKU on different lines are combined.
+        """
+        quantities = SortedDict()
+        for sku, quantity in self.cleaned_data["items"]:
+            quantities[sku] = quantities.get(sku, 0) + quantity
+        variations = ProductVariation.objects.from_skus(quantities.keys(),
+                                                        self._for_user)
+        lines = []
+        errors = []
+        for sku, quantity in quantities.items():
+            variation = variations.get(sku)
+            if variation is None:
+                error = "invalid_sku"
+            elif not variation.has_stock():
+                error = "no_stock"
+            elif not variation.has_stock(quantity):
+                error = "no_stock_quantity"
+            else:
+                lines.append((variation, quantity))
+                continue
+            errors.append(BULK_ADD_ERRORS[error] % {"sku": sku})
+        if errors:
+            raise forms.ValidationError(errors)
+        self.lines = lines
+        return self.cleaned_data["items"]
+
+
+class CartItemForm(forms.ModelForm):
+    """
+    Quantity of an item in the cart, with zero removing the item.
+    """
+
+    quantity = forms.IntegerField(min_value=0)
+
+    class Meta:
+        model = CartItem
+        fields = ("quantity",)
+
+
+class BaseCartItemFormSet(BaseInlineFormSet):
+    """
+    Changes the quantities of all items in the cart at once, removing
+    those that are deleted.
+    """
+
+    def clean(self):
+        """
+        Check the stock for all increased quantities, with a single
+        query for the variations and another for their quantities in
+        carts. Increases for items with the same SKU are combined.
+        """
+        super(BaseCartItemFormSet, self).clean()
+        increases = SortedDict()
+        for form in self.forms:
+            if self._should_delete_form(form):
+                continue
+            # The instance has the new quantity once cleaned, so the
+            # current quantity is read from the form's initial data.
+            quantity = getattr(form, "cleaned_data", {}).get("quantity")
+            change = (quantity or 0) - form.initial.get("quantity", 0)
+            if change <= 0:
+                continue
+            sku = form.instance.sku
+            forms_changed, total_change = increases.get(sku, ([], 0))
+            increases[sku] = (forms_changed + [form], total_change + change)
+        if not increases:
+            return
+        variations = ProductVariation.objects.from_skus(increases.keys())
+        for sku, (forms_changed, change) in increases.items():
+            variation = variations.get(sku)
+            if variation is None or not variation.has_stock(change):
+                error = ADD_PRODUCT_ERRORS["no_stock_quantity"]
+                for form in forms_changed:
+                    form._errors["quantity"] = form.error_class([error])
+                    del form.cleaned_data["quantity"]
+
+    def save(self):
+        """
+        Apply the changed quantities to the cart.
+        """
+        quantities = {}
+        for form in self.forms:
+            if self._should_delete_form(form):
+                quantities[form.instance.id] = 0
+            elif form.has_changed():
+                quantities[form.instance.id] = form.cleaned_data["quantity"]
+        if quantities:
+            self.instance.update_quantities(quantities)
+
+
+CartItemFormSet = inlineformset_factory(Cart, CartItem, form=CartItemForm,
+                                        formset=BaseCartItemFormSet,
+                                        fields=("quantity",), extra=0)
+
+
 class FormsetForm(object):
     """
     Form mixin that provides template methods for iterating through 
@@ -348,8 +514,8 @@ class MoneyWidget(forms.TextInput):
         except (TypeError, ValueError):
             pass
         else:
-            set_locale()
-            value = ("%%.%sf" % localeconv()["frac_digits"]) % value
+            frac_digits = get_formatter().frac_digits
+            value = ("%%.%sf" % frac_digits) % value
             attrs["style"] = "text-align:right;"
         return super(MoneyWidget, self).render(name, value, attrs)
 
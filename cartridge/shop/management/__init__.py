@@ -3,7 +3,7 @@ from django.conf import settings
 from django.core.management import call_command
 from django.db.models.signals import post_syncdb
 
-from cartridge.shop.models import Product
+from cartridge.shop.models import CategoryAncestry, Product
 from cartridge.shop import models as shop_app
 
 
@@ -22,6 +22,8 @@ def create_initial_product(app, created_models, verbosity, **kwargs):
         print "Creating initial Category and Product."
         print 
         call_command("loaddata", "cartridge.json")
+        # Fixtures bypass ``Category.save``, so set up their ancestry.
+        CategoryAncestry.objects.rebuild()
 
 
 if "south" not in settings.INSTALLED_APPS:
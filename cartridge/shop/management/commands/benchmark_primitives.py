@@ -0,0 +1,212 @@
+"""
+Benchmarks the per-object functions that product listings, imports
+and the checkout call for each product, variation or option, such as
+``Priced.price`` and ``ProductVariation.options``. Each primitive is
+timed with ``timeit`` against fixed in-memory fixtures, and the
+operations per second along with the number of objects allocated per
+call are printed, and optionally written as JSON and compared with the
+results of an earlier run.
+"""
+
+import gc
+from datetime import datetime, timedelta
+from decimal import Decimal
+from optparse import make_option
+from timeit import Timer
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+
+from mezzanine.conf import settings
+
+from cartridge.shop import bulk
+from cartridge.shop.models import DiscountCode, Product, ProductOption
+from cartridge.shop.models import ProductVariation
+from cartridge.shop.utils import make_choices
+
+
+def _fixtures():
+    """
+    Returns a dict of the primitives to benchmark, each a function
+    without arguments that calls the primitive for a fixture. Sale
+    dates are relative to the current time so that the same branches
+    are taken on every run.
+    """
+    now = datetime.now()
+    day = timedelta(days=1)
+    product = Product(title="Benchmark product")
+    on_sale = ProductVariation(unit_price=Decimal("20"),
+                               sale_price=Decimal("15"),
+                               sale_from=now - day, sale_to=now + day)
+    on_sale.product = product
+    expired = ProductVariation(unit_price=Decimal("20"),
+                               sale_price=Decimal("15"),
+                               sale_from=now - day * 2, sale_to=now - day)
+    expired.product = product
+    for field, (type, name) in zip(ProductVariation.option_fields(),
+                                   settings.SHOP_OPTION_TYPE_CHOICES):
+        setattr(on_sale, field.name, "%s 1" % name)
+    discount = DiscountCode(discount_percent=Decimal("10"))
+    choices = ["Choice %s" % i for i in range(10)]
+    return SortedDict([
+        ("Priced.on_sale", on_sale.on_sale),
+        ("Priced.price", on_sale.price),
+        ("Priced.has_price", expired.has_price),
+        ("ProductVariation.option_fields", ProductVariation.option_fields),
+        ("ProductVariation.options", on_sale.options),
+        ("ProductVariation.__unicode__", on_sale.__unicode__),
+        ("ProductOptionManager.as_fields", ProductOption.objects.as_fields),
+        ("DiscountCode.calculate", lambda: discount.calculate(Decimal("120"))),
+        ("make_choices", lambda: make_choices(choices)),
+    ])
+
+
+def _option_fixtures(count):
+    """
+    Inserts the given number of options for each option type, for
+    ``ProductOptionManager.as_fields`` to load. They're inserted
+    without saving each, so that no signals are sent, and are rolled
+    back once the benchmarks have run.
+    """
+    options = []
+    for type, label in settings.SHOP_OPTION_TYPE_CHOICES:
+        for i in range(count):
+            name = "Benchmark %s" % i
+            options.append(ProductOption(type=type, name=name))
+    bulk.insert(ProductOption, options)
+
+
+def allocations(func, number):
+    """
+    Returns the number of objects allocated per call of the function
+    that are tracked by the garbage collector, such as lists, dicts
+    and instances, but not strings or numbers. The result of each
+    call is kept until all calls are made, so objects that are
+    returned are counted along with those that are kept elsewhere,
+    while temporary objects freed within the call aren't. Lists and
+    tuples reused from the interpreter's free lists aren't counted
+    either, which only affects the first hundred or so calls.
+    """
+    results = [None] * number
+    func()
+    gc.collect()
+    gc.disable()
+    try:
+        start = gc.get_count()[0]
+        for i in xrange(number):
+            results[i] = func()
+        allocated = gc.get_count()[0] - start
+    finally:
+        gc.enable()
+    return float(allocated) / number
+
+
+def measure(func, number, repeat):
+    """
+    Returns a dict of statistics for the function, timed as the best
+    of ``repeat`` runs of ``number`` calls.
+    """
+    times = Timer(func).repeat(repeat, number)
+    best = min(times)
+    return {
+        "ops_per_sec": number / max(best, 0.000001),
+        "usec_per_op": best * 1000000 / number,
+        "allocations": allocations(func, number),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the pricing, option and discount functions called "
+            "for each product or variation, reporting operations per "
+            "second and allocations per call.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--primitives",
+            dest="primitives",
+            help="Comma separated primitives to benchmark, defaulting to "
+                 "all of them."),
+        make_option("--number",
+            type="int",
+            dest="number",
+            default=10000,
+            help="Number of calls for each run."),
+        make_option("--repeat",
+            type="int",
+            dest="repeat",
+            default=5,
+            help="Number of runs for each primitive, the best of which "
+                 "is reported."),
+        make_option("--options",
+            type="int",
+            dest="options",
+            default=10,
+            help="Number of options of each type to create for "
+                 "ProductOptionManager.as_fields."),
+        make_option("--output",
+            dest="output",
+            help="File to write the results to as JSON."),
+        make_option("--baseline",
+            dest="baseline",
+            help="JSON file of earlier results to compare with."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        for name in ("number", "repeat"):
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" % name)
+        baseline = {}
+        if options.get("baseline"):
+            baseline = simplejson.load(open(options["baseline"]))
+            baseline = baseline["primitives"]
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            _option_fixtures(options["options"])
+            primitives = _fixtures()
+            names = primitives.keys()
+            if options.get("primitives"):
+                names = [n.strip() for n in options["primitives"].split(",")]
+                for name in names:
+                    if name not in primitives:
+                        raise CommandError("Unknown primitive: %s" % name)
+            results = {
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "django": django.get_version(),
+                "number": options["number"],
+                "repeat": options["repeat"],
+                "primitives": {},
+            }
+            for name in names:
+                summary = measure(primitives[name], options["number"],
+                                  options["repeat"])
+                results["primitives"][name] = summary
+                if verbosity > 0:
+                    self._print(name, summary, baseline.get(name))
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+        if options.get("output"):
+            output = open(options["output"], "w")
+            output.write(simplejson.dumps(results, indent=2, sort_keys=True))
+            output.close()
+
+    def _print(self, name, summary, baseline):
+        """
+        Prints the summary for a primitive, with the change from the
+        baseline summary if given.
+        """
+        line = ("%(name)-32s %(ops_per_sec)12.0f ops/sec  "
+                "%(usec_per_op)8.2fus  %(allocations)6.1f allocations")
+        print line % dict(summary, name=name)
+        if baseline:
+            changes = []
+            for field in ("ops_per_sec", "allocations"):
+                if baseline.get(field):
+                    change = ((summary[field] - baseline[field]) /
+                              baseline[field])
+                    changes.append("%s %+.0f%%" % (field, change * 100))
+            print "%-32s vs baseline: %s" % ("", ", ".join(changes))
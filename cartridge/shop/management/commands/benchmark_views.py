@@ -0,0 +1,258 @@
+"""
+Benchmarks the shop's views against the current catalog, such as one
+created with ``generate_catalog``. Each scenario requests a view with
+the test client for random products, categories or search terms, or
+with a cart of random variations, across a pool of processes, and the
+latency percentiles, queries per request and requests per second for
+each scenario are printed, and optionally written as JSON and compared
+with the results of an earlier run.
+"""
+
+import random
+from datetime import datetime
+from itertools import imap
+from math import ceil
+from multiprocessing import Pool
+from optparse import make_option
+from time import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.utils import simplejson
+from django.utils.http import urlencode
+
+from cartridge.shop.models import Category, Product, ProductVariation
+
+
+SCENARIOS = ("product", "category", "search", "cart", "wishlist",
+             "checkout")
+
+
+def _percentile(values, percent):
+    """
+    Returns the nearest rank percentile of the sorted list of values.
+    """
+    if not values:
+        return 0
+    rank = int(ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def _targets(count):
+    """
+    Returns a dict of random product and category URLs, search terms
+    and SKUs to request in the scenarios, up to ``count`` of each.
+    """
+    products = Product.objects.published().filter(available=True)
+    products = list(products.order_by("?")[:count])
+    categories = Category.objects.published().order_by("?")[:count]
+    variations = ProductVariation.objects.filter(product__in=products,
+                                                 unit_price__isnull=False)
+    variations = variations.exclude(num_in_stock__lt=10)
+    words = set()
+    for product in products:
+        words.update(product.title.lower().split())
+    return {
+        "product": [product.get_absolute_url() for product in products],
+        "category": [category.get_absolute_url() for category in categories],
+        "search": ["%s?%s" % (reverse("shop_search"),
+                              urlencode({"query": word}))
+                   for word in sorted(words)[:count]],
+        "skus": list(variations.values_list("sku", flat=True)[:count]),
+    }
+
+
+def run_scenario(job):
+    """
+    Makes the requests for a scenario in one process, returning a list
+    of the time taken, number of queries and status code for each.
+    """
+    scenario, targets, requests, warmup, seed = job
+    random.seed(seed)
+    client = Client()
+    skus = random.sample(targets["skus"], min(len(targets["skus"]), 3))
+    if scenario in ("cart", "checkout"):
+        client.post(reverse("shop_cart_bulk"), {"items": "\n".join(skus)})
+    elif scenario == "wishlist":
+        client.cookies["wishlist"] = ",".join(skus)
+    if scenario in targets:
+        urls = targets[scenario]
+    else:
+        urls = [reverse("shop_%s" % scenario)]
+    connection.use_debug_cursor = True
+    results = []
+    try:
+        for i in range(warmup + requests):
+            url = random.choice(urls)
+            connection.queries = []
+            start = time()
+            try:
+                status = client.get(url).status_code
+            except Exception:
+                # The test client raises exceptions from views, which
+                # are counted as errors as a server would respond 500.
+                status = 500
+            elapsed = time() - start
+            if i >= warmup:
+                results.append((elapsed, len(connection.queries), status))
+    finally:
+        connection.use_debug_cursor = None
+        connection.queries = []
+    return results
+
+
+def summarize(results, elapsed):
+    """
+    Returns a dict of statistics for the results of a scenario.
+    """
+    times = sorted([result[0] * 1000 for result in results])
+    queries = [result[1] for result in results]
+    errors = len([result for result in results if result[2] >= 400])
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "mean_ms": sum(times) / max(len(times), 1),
+        "p50_ms": _percentile(times, 50),
+        "p95_ms": _percentile(times, 95),
+        "p99_ms": _percentile(times, 99),
+        "queries_mean": float(sum(queries)) / max(len(queries), 1),
+        "queries_max": max(queries or [0]),
+        "requests_per_sec": len(results) / max(elapsed, 0.001),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the shop's views against the current catalog, "
+            "reporting latency percentiles, queries per request and "
+            "requests per second for each scenario.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--scenarios",
+            dest="scenarios",
+            default=",".join(SCENARIOS),
+            help="Comma separated scenarios to run, from: %s." %
+                 ", ".join(SCENARIOS)),
+        make_option("--requests",
+            type="int",
+            dest="requests",
+            default=200,
+            help="Number of requests for each scenario."),
+        make_option("--warmup",
+            type="int",
+            dest="warmup",
+            default=10,
+            help="Number of requests for each scenario in each process "
+                 "that aren't recorded."),
+        make_option("--concurrency",
+            type="int",
+            dest="concurrency",
+            default=1,
+            help="Number of processes making requests at the same time."),
+        make_option("--targets",
+            type="int",
+            dest="targets",
+            default=100,
+            help="Number of random products, categories and search terms "
+                 "to request."),
+        make_option("--seed",
+            type="int",
+            dest="seed",
+            default=0,
+            help="Seed for choosing what to request."),
+        make_option("--output",
+            dest="output",
+            help="File to write the results to as JSON."),
+        make_option("--baseline",
+            dest="baseline",
+            help="JSON file of earlier results to compare with."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        scenarios = [s.strip() for s in options["scenarios"].split(",")]
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                raise CommandError("Unknown scenario: %s" % scenario)
+        for name in ("requests", "concurrency", "targets"):
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" % name)
+        baseline = {}
+        if options.get("baseline"):
+            baseline = simplejson.load(open(options["baseline"]))["scenarios"]
+        random.seed(options["seed"])
+        targets = _targets(options["targets"])
+        for name in ("product", "category", "search", "skus"):
+            if not targets[name]:
+                raise CommandError("No %s to request, generate a catalog "
+                                   "with generate_catalog first" % name)
+        concurrency = options["concurrency"]
+        if concurrency == 1:
+            pool = None
+            map_jobs = imap
+        else:
+            # Close the connection before forking, so that each process
+            # opens its own rather than sharing this one, which closing
+            # in a process would end for all of them.
+            connection.close()
+            pool = Pool(concurrency)
+            map_jobs = pool.imap_unordered
+        results = {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "django": django.get_version(),
+            "concurrency": concurrency,
+            "catalog": {
+                "products": Product.objects.count(),
+                "variations": ProductVariation.objects.count(),
+                "categories": Category.objects.count(),
+            },
+            "scenarios": {},
+        }
+        try:
+            for scenario in scenarios:
+                # Split the requests between the processes.
+                counts = [options["requests"] // concurrency] * concurrency
+                for i in range(options["requests"] % concurrency):
+                    counts[i] += 1
+                jobs = [(scenario, targets, count, options["warmup"],
+                         "%s-%s-%s" % (options["seed"], scenario, i))
+                        for i, count in enumerate(counts) if count]
+                start = time()
+                scenario_results = []
+                for job_results in map_jobs(run_scenario, jobs):
+                    scenario_results.extend(job_results)
+                summary = summarize(scenario_results, time() - start)
+                results["scenarios"][scenario] = summary
+                if verbosity > 0:
+                    self._print(scenario, summary, baseline.get(scenario))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if options.get("output"):
+            output = open(options["output"], "w")
+            output.write(simplejson.dumps(results, indent=2, sort_keys=True))
+            output.close()
+
+    def _print(self, scenario, summary, baseline):
+        """
+        Prints the summary for a scenario, with the change from the
+        baseline summary if given.
+        """
+        line = ("%(scenario)-10s p50 %(p50_ms)7.1fms  p95 %(p95_ms)7.1fms  "
+                "p99 %(p99_ms)7.1fms  queries %(queries_mean)5.1f "
+                "(max %(queries_max)s)  %(requests_per_sec)6.1f req/sec")
+        values = dict(summary, scenario=scenario)
+        print line % values
+        if summary["errors"]:
+            print "%-10s %s errors" % ("", summary["errors"])
+        if baseline:
+            changes = []
+            for name in ("p50_ms", "p95_ms", "queries_mean",
+                         "requests_per_sec"):
+                if baseline.get(name):
+                    change = (summary[name] - baseline[name]) / baseline[name]
+                    changes.append("%s %+.0f%%" % (name, change * 100))
+            print "%-10s vs baseline: %s" % ("", ", ".join(changes))
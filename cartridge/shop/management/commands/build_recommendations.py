@@ -0,0 +1,237 @@
+"""
+Builds "customers also bought" recommendations from past orders. The
+lines of each order are loaded a batch of orders at a time, and the
+number of orders each pair of products was bought together in is
+counted, using sparse matrices when NumPy and SciPy are installed.
+Each pair is scored by its count relative to the number of orders for
+each product, and the highest scoring products for each product are
+stored as ``ProductRecommendation`` rows, replacing any built before.
+"""
+
+from collections import defaultdict
+from heapq import heappush, heappushpop
+from math import sqrt
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from cartridge.shop import catalog
+from cartridge.shop.models import Order, OrderItem, ProductRecommendation
+from cartridge.shop.models import ProductVariation
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    HAS_SPARSE = False
+else:
+    HAS_SPARSE = True
+
+
+def order_baskets(products, batch_size):
+    """
+    Yields lists of the sets of product IDs bought in each order, for
+    ranges of ``batch_size`` order IDs at a time. ``products`` is a
+    dict of SKUs to product IDs, and lines for SKUs no longer in it
+    are skipped.
+    """
+    max_id = Order.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+    for start in range(0, max_id, batch_size):
+        lines = OrderItem.objects.filter(order__gt=start,
+                                         order__lte=start + batch_size)
+        baskets = defaultdict(set)
+        for order_id, sku in lines.values_list("order", "sku").iterator():
+            product_id = products.get(sku)
+            if product_id is not None:
+                baskets[order_id].add(product_id)
+        if baskets:
+            yield baskets.values()
+
+
+class PairCounter(object):
+    """
+    Counts the number of orders each product and each pair of products
+    are bought in. When more than ``max_pairs`` pairs are counted, the
+    least frequent pairs are discarded and the count a pair needs to
+    be kept is raised, so that memory use stays bounded however many
+    orders are counted.
+    """
+
+    def __init__(self, max_pairs):
+        self.max_pairs = max_pairs
+        self.floor = 0
+        self.orders = defaultdict(int)
+        self.pairs = defaultdict(int)
+
+    def add(self, baskets):
+        for basket in baskets:
+            basket = sorted(basket)
+            for i, product_id in enumerate(basket):
+                self.orders[product_id] += 1
+                for other_id in basket[i + 1:]:
+                    self.pairs[(product_id, other_id)] += 1
+        while len(self.pairs) > self.max_pairs:
+            self.floor += 1
+            for pair in [pair for pair, count in self.pairs.iteritems()
+                         if count <= self.floor]:
+                del self.pairs[pair]
+
+    def counts(self):
+        """
+        Yields each pair of product IDs with the number of orders
+        they were bought together in, and the number of orders each
+        was bought in.
+        """
+        for (product_id, other_id), count in self.pairs.iteritems():
+            yield (product_id, other_id, count, self.orders[product_id],
+                   self.orders[other_id])
+
+
+class SparsePairCounter(PairCounter):
+    """
+    ``PairCounter`` that counts the pairs in each batch of orders by
+    multiplying a sparse matrix of orders by products with its own
+    transpose, and keeps the counts as a sparse matrix of products.
+    """
+
+    def __init__(self, max_pairs):
+        self.max_pairs = max_pairs
+        self.floor = 0
+        self.columns = {}
+        self.ids = []
+        self.orders = numpy.zeros(0, dtype=numpy.int64)
+        self.pairs = None
+
+    def _resize(self, matrix, size):
+        """
+        Returns the given square matrix extended to the given size,
+        for products not seen in previous batches.
+        """
+        matrix = matrix.tocsr()
+        padding = numpy.repeat(matrix.indptr[-1], size - matrix.shape[0])
+        indptr = numpy.concatenate([matrix.indptr, padding])
+        return sparse.csr_matrix((matrix.data, matrix.indices, indptr),
+                                 shape=(size, size))
+
+    def add(self, baskets):
+        rows = []
+        columns = []
+        for row, basket in enumerate(baskets):
+            for product_id in basket:
+                column = self.columns.get(product_id)
+                if column is None:
+                    column = self.columns[product_id] = len(self.ids)
+                    self.ids.append(product_id)
+                rows.append(row)
+                columns.append(column)
+        size = len(self.ids)
+        data = numpy.ones(len(rows), dtype=numpy.int64)
+        matrix = sparse.csr_matrix((data, (rows, columns)),
+                                   shape=(len(baskets), size))
+        orders = numpy.zeros(size, dtype=numpy.int64)
+        orders[:len(self.orders)] = self.orders
+        self.orders = orders + numpy.asarray(matrix.sum(axis=0)).ravel()
+        # Only the upper triangle is kept, as the counts are the same
+        # for both products in a pair, and the diagonal is the number
+        # of orders for each product which is kept above.
+        pairs = sparse.triu(matrix.T * matrix, k=1).tocsr()
+        if self.pairs is not None:
+            pairs = self._resize(self.pairs, size) + pairs
+        self.pairs = pairs
+        while self.pairs.nnz > self.max_pairs:
+            self.floor += 1
+            self.pairs.data[self.pairs.data <= self.floor] = 0
+            self.pairs.eliminate_zeros()
+
+    def counts(self):
+        if self.pairs is None:
+            return
+        pairs = self.pairs.tocoo()
+        ids = numpy.array(self.ids)
+        for row, column, count in zip(pairs.row, pairs.col, pairs.data):
+            yield (int(ids[row]), int(ids[column]), int(count),
+                   int(self.orders[row]), int(self.orders[column]))
+
+
+def top_recommendations(counts, top, min_count):
+    """
+    Yields product ID, recommended product ID and score rows for the
+    ``top`` highest scoring products for each product, from the given
+    pair counts. Pairs are scored with the cosine similarity of the
+    orders each product was bought in.
+    """
+    best = defaultdict(list)
+    for product_id, other_id, count, orders, other_orders in counts:
+        if count < min_count:
+            continue
+        score = count / sqrt(orders * other_orders)
+        for pair in ((product_id, other_id), (other_id, product_id)):
+            heap = best[pair[0]]
+            if len(heap) < top:
+                heappush(heap, (score, pair[1]))
+            else:
+                heappushpop(heap, (score, pair[1]))
+    for product_id, heap in best.iteritems():
+        for score, recommended_id in heap:
+            yield product_id, recommended_id, score
+
+
+class Command(BaseCommand):
+    help = ("Builds recommendations of products bought together from "
+            "past orders.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--top",
+            type="int",
+            dest="top",
+            default=10,
+            help="Number of products to recommend for each product."),
+        make_option("--min-count",
+            type="int",
+            dest="min_count",
+            default=1,
+            help="Number of orders products must be bought together in."),
+        make_option("--batch-size",
+            type="int",
+            dest="batch_size",
+            default=10000,
+            help="Number of order IDs to load lines for at a time."),
+        make_option("--max-pairs",
+            type="int",
+            dest="max_pairs",
+            default=5000000,
+            help="Number of product pairs to count before discarding "
+                 "the least frequent."),
+        make_option("--no-numpy",
+            action="store_true",
+            dest="no_numpy",
+            default=False,
+            help="Count pairs without NumPy and SciPy even if installed."),
+    )
+
+    def handle(self, *args, **options):
+        for name in ("top", "min_count", "batch_size", "max_pairs"):
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" %
+                                   name.replace("_", "-"))
+        if HAS_SPARSE and not options["no_numpy"]:
+            counter = SparsePairCounter(options["max_pairs"])
+        else:
+            counter = PairCounter(options["max_pairs"])
+        products = dict(ProductVariation.objects.values_list("sku",
+                                                             "product"))
+        for baskets in order_baskets(products, options["batch_size"]):
+            counter.add(baskets)
+        rows = top_recommendations(counter.counts(), options["top"],
+                                   options["min_count"])
+        transaction.commit_on_success(
+            ProductRecommendation.objects.replace)(rows)
+        catalog.bump(catalog.SITE)
+        if int(options.get("verbosity", 1)) > 0:
+            total = ProductRecommendation.objects.count()
+            print "Recommendations: %s" % total
+            if counter.floor:
+                print ("Pairs bought together in %s orders or fewer were "
+                       "discarded to stay within --max-pairs" % counter.floor)
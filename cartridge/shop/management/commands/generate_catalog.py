@@ -0,0 +1,440 @@
+"""
+Generates a catalog of random categories, products and variations, with
+carts and past orders, for testing the shop at scale. Unlike
+``cartridge/scripts/create_test_products.py`` no network access is
+needed, and the same seed and options always generate the same data.
+Products, cart items and orders are generated a chunk at a time across
+a pool of processes, with each chunk written in its own transaction by
+the process that generated it, using the helpers in
+``cartridge.shop.bulk``.
+"""
+
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import imap, product as combinations
+from multiprocessing import Pool
+from optparse import make_option
+from time import time
+
+from django.contrib.sites.models import Site
+from django.contrib.webdesign.lorem_ipsum import paragraph, sentence, words
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from mezzanine.conf import settings
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+
+from cartridge.shop import bulk, catalog
+from cartridge.shop.models import Cart, CartItem, Category, Order, OrderItem
+from cartridge.shop.models import Priced, Product, ProductOption
+from cartridge.shop.models import ProductVariation
+
+
+CENT = Decimal("0.01")
+
+
+def _seed(options, stream, start):
+    """
+    Seeds the random module for the chunk of the given stream of data
+    starting at ``start``, so that each chunk generates the same data
+    whichever process generates it. The lorem ipsum functions use the
+    random module directly, so its global generator is seeded.
+    """
+    random.seed("%s-%s-%s" % (options["seed"], stream, start))
+
+
+def _sku(options, product, variation):
+    return "%s-%s-%s" % (options["prefix"], product, variation)
+
+
+def _variations_per_product(options):
+    return reduce(lambda x, y: x * max(y, 1), options["option_counts"], 1)
+
+
+def _random_skus(options, count):
+    """
+    Returns a list of ``count`` distinct random SKUs of the generated
+    variations.
+    """
+    total = options["products"] * _variations_per_product(options)
+    count = min(count, total)
+    skus = set()
+    while len(skus) < count:
+        i = random.randrange(total)
+        skus.add(_sku(options, *divmod(i, _variations_per_product(options))))
+    return list(skus)
+
+
+def _variation_lookup(skus):
+    """
+    Returns a dict of the given SKUs to the unit price, product title
+    and product slug of each variation.
+    """
+    variations = ProductVariation.objects.filter(sku__in=skus)
+    return dict([(v[0], v[1:]) for v in variations.values_list("sku",
+                 "unit_price", "product__title", "product__slug")])
+
+
+def generate_categories(options):
+    """
+    Creates ``categories`` categories in a tree ``depth`` levels deep,
+    returning the IDs of the categories without children, which the
+    products are added to. Categories are created with ``save`` so
+    that page and category ancestry fields are set.
+    """
+    count, depth = options["categories"], options["depth"]
+    branching = 1
+    while sum([branching ** level for level in range(1, depth + 1)]) < count:
+        branching += 1
+    published = {"status": CONTENT_STATUS_PUBLISHED}
+    level = [(None, "")]
+    leaves = []
+    created = 0
+    while level and created < count:
+        next_level = []
+        for parent_id, number in level:
+            children = 0
+            for i in range(1, branching + 1):
+                if created == count:
+                    break
+                child_number = "%s%s" % (number and number + "." or "", i)
+                category = Category.objects.create(title="Category %s" %
+                    child_number, parent_id=parent_id, **published)
+                next_level.append((category.id, child_number))
+                created += 1
+                children += 1
+            if not children and parent_id is not None:
+                leaves.append(parent_id)
+        level = next_level
+    leaves.extend([category_id for category_id, number in level])
+    return leaves
+
+
+def generate_options(options):
+    """
+    Creates ``option_values`` options for each option type, returning
+    a list of the option names for each type.
+    """
+    names = []
+    existing = set(ProductOption.objects.values_list("type", "name"))
+    new_options = []
+    for type, type_name in settings.SHOP_OPTION_TYPE_CHOICES:
+        type_names = [u"%s %s" % (type_name, i + 1)
+                      for i in range(options["option_values"])]
+        for name in type_names:
+            if (type, name) not in existing:
+                new_options.append(ProductOption(type=type, name=name))
+        names.append(type_names)
+    bulk.insert(ProductOption, new_options)
+    return names
+
+
+def generate_products(job):
+    """
+    Generates the products numbered from ``start`` to ``stop`` with
+    their variations, and adds each to a random category, returning
+    the number of variations generated.
+    """
+    options, start, stop = job
+    _seed(options, "products", start)
+    now = datetime.now()
+    products = []
+    variations = []
+    for n in range(start, stop):
+        product = Product(title=u"%s %s" % (words(2, False).title(), n),
+                          slug="%s-%s" % (options["prefix"], n),
+                          content=u"<p>%s</p>" % paragraph(),
+                          description=sentence(), available=True,
+                          status=CONTENT_STATUS_PUBLISHED, publish_date=now,
+                          site_id=options["site_id"])
+        values = []
+        for names, count in zip(options["option_names"],
+                                options["option_counts"]):
+            values.append(count and random.sample(names, count) or [None])
+        price = Decimal(random.randint(100, 50000)) / 100
+        on_sale = random.random() < options["sale_ratio"]
+        if on_sale:
+            percent = Decimal(random.randint(50, 90)) / 100
+            sale_from = now - timedelta(days=random.randint(0, 30))
+            sale_to = now + timedelta(days=random.randint(1, 30))
+        for i, option_values in enumerate(combinations(*values)):
+            variation = ProductVariation(sku=_sku(options, n, i),
+                                         default=(i == 0))
+            variation.product_slug = product.slug
+            if i > 0:
+                price += Decimal(random.randint(0, 500)) / 100
+            variation.unit_price = price
+            if on_sale:
+                variation.sale_price = (price * percent).quantize(CENT)
+                variation.sale_from, variation.sale_to = sale_from, sale_to
+            if random.random() > 0.1:
+                variation.num_in_stock = random.randint(0, 100)
+            for field, value in zip(ProductVariation.option_fields(),
+                                    option_values):
+                setattr(variation, field.name, value)
+            if i == 0:
+                for field in Priced._meta.fields:
+                    setattr(product, field.name,
+                            getattr(variation, field.name))
+            variations.append(variation)
+        products.append(product)
+    categories = [random.choice(options["leaves"]) for product in products]
+
+    def write():
+        bulk.insert(Product, products)
+        slugs = [product.slug for product in products]
+        ids = dict(Product.objects.filter(slug__in=slugs).values_list(
+            "slug", "id"))
+        for variation in variations:
+            variation.product_id = ids[variation.product_slug]
+        bulk.insert(ProductVariation, variations)
+        links = [(ids[product.slug], category_id)
+                 for product, category_id in zip(products, categories)]
+        through = Product.categories.through
+        bulk.insert_rows(through._meta.db_table,
+                         ["product_id", "category_id"], links)
+    transaction.commit_on_success(write)()
+    return len(variations)
+
+
+def generate_cart_items(job):
+    """
+    Adds random variations to the carts with the given IDs, returning
+    the number of cart items generated.
+    """
+    options, cart_ids = job
+    _seed(options, "carts", cart_ids[0])
+    counts = [random.randint(1, options["max_lines"]) for id in cart_ids]
+    skus = [_random_skus(options, count) for count in counts]
+    variations = _variation_lookup([sku for s in skus for sku in s])
+    items = []
+    carts = []
+    for cart_id, cart_skus in zip(cart_ids, skus):
+        cart = Cart(id=cart_id, item_count=0, total_price=Decimal("0"))
+        for sku in cart_skus:
+            unit_price, title, slug = variations[sku]
+            quantity = random.randint(1, 3)
+            items.append(CartItem(cart_id=cart_id, sku=sku,
+                description=title, quantity=quantity, unit_price=unit_price,
+                total_price=unit_price * quantity, url="/shop/product/%s/" %
+                slug))
+            cart.item_count += quantity
+            cart.total_price += unit_price * quantity
+        carts.append(cart)
+
+    def write():
+        bulk.insert(CartItem, items)
+        bulk.update(Cart, ["item_count", "total_price"], carts)
+    transaction.commit_on_success(write)()
+    return len(items)
+
+
+def generate_orders(job):
+    """
+    Generates the orders numbered from ``start`` to ``stop``, placed
+    at random times over the last year, returning the number of order
+    items generated.
+    """
+    options, start, stop = job
+    _seed(options, "orders", start)
+    now = datetime.now()
+    statuses = [status for status, name in settings.SHOP_ORDER_STATUS_CHOICES]
+    orders = []
+    lines = []
+    for n in range(start, stop):
+        first_name, last_name = words(2, False).title().split()
+        order = Order(key="%s-order-%s" % (options["prefix"], n),
+                      status=random.choice(statuses),
+                      shipping_total=Decimal("0"),
+                      discount_total=Decimal("0"),
+                      billing_detail_email="customer%s@example.com" % n)
+        order.placed = now - timedelta(seconds=random.randint(0, 31536000))
+        for prefix in ("billing_detail", "shipping_detail"):
+            setattr(order, "%s_first_name" % prefix, first_name)
+            setattr(order, "%s_last_name" % prefix, last_name)
+            setattr(order, "%s_street" % prefix, words(3, False).title())
+            setattr(order, "%s_city" % prefix, words(1, False).title())
+        orders.append(order)
+        lines.append(_random_skus(options,
+                                  random.randint(1, options["max_lines"])))
+    variations = _variation_lookup([sku for skus in lines for sku in skus])
+    items = []
+    for order, skus in zip(orders, lines):
+        order.item_total = Decimal("0")
+        for sku in skus:
+            unit_price, title, slug = variations[sku]
+            quantity = random.randint(1, 3)
+            items.append(OrderItem(sku=sku, description=title,
+                                   quantity=quantity, unit_price=unit_price,
+                                   total_price=unit_price * quantity))
+            items[-1].order_key = order.key
+            order.item_total += unit_price * quantity
+        order.total = order.item_total
+
+    def write():
+        bulk.insert(Order, orders)
+        keys = [order.key for order in orders]
+        ids = dict(Order.objects.filter(key__in=keys).values_list("key",
+                                                                  "id"))
+        # The time is set after inserting, since inserting sets it to
+        # the current time.
+        for order in orders:
+            order.id = ids[order.key]
+            order.time = order.placed
+        bulk.update(Order, ["time"], orders)
+        for item in items:
+            item.order_id = ids[item.order_key]
+        bulk.insert(OrderItem, items)
+    transaction.commit_on_success(write)()
+    return len(items)
+
+
+class Command(BaseCommand):
+    help = ("Generates a random catalog of categories, products and "
+            "variations, with carts and orders, for testing at scale.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--seed",
+            type="int",
+            dest="seed",
+            default=0,
+            help="Seed for the random data, the same seed and options "
+                 "always generate the same data."),
+        make_option("--categories",
+            type="int",
+            dest="categories",
+            default=50,
+            help="Number of categories."),
+        make_option("--depth",
+            type="int",
+            dest="depth",
+            default=2,
+            help="Number of levels in the tree of categories."),
+        make_option("--products",
+            type="int",
+            dest="products",
+            default=1000,
+            help="Number of products."),
+        make_option("--options",
+            dest="options",
+            default="3,2",
+            help="Comma separated number of options of each type in "
+                 "SHOP_OPTION_TYPE_CHOICES for each product, with a "
+                 "variation for each combination."),
+        make_option("--option-values",
+            type="int",
+            dest="option_values",
+            default=10,
+            help="Number of options of each type to choose from."),
+        make_option("--sale-ratio",
+            type="float",
+            dest="sale_ratio",
+            default=0.1,
+            help="Fraction of products on sale."),
+        make_option("--carts",
+            type="int",
+            dest="carts",
+            default=100,
+            help="Number of carts."),
+        make_option("--orders",
+            type="int",
+            dest="orders",
+            default=1000,
+            help="Number of orders."),
+        make_option("--max-lines",
+            type="int",
+            dest="max_lines",
+            default=5,
+            help="Maximum number of items in each cart and order."),
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=1000,
+            help="Number of products, carts or orders generated and "
+                 "written at a time."),
+        make_option("--processes",
+            type="int",
+            dest="processes",
+            help="Number of processes to generate data with (default is "
+                 "the number of CPUs)."),
+        make_option("--prefix",
+            dest="prefix",
+            default="gen",
+            help="Prefix for product slugs, SKUs and order keys, so that "
+                 "more than one catalog can be generated."),
+    )
+
+    def _run(self, pool, function, jobs, name, verbosity):
+        """
+        Runs the function for each job in the pool, printing progress.
+        """
+        total = 0
+        start = time()
+        for i, count in enumerate(pool(function, jobs)):
+            total += count
+            if verbosity > 0:
+                rate = total / max(time() - start, 0.001)
+                print "%s: %s (%.0f/sec), chunk %s of %s" % (name, total,
+                    rate, i + 1, len(jobs))
+        return total
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        for name in ("categories", "depth", "products", "option_values",
+                     "max_lines", "chunk_size"):
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" %
+                                   name.replace("_", "-"))
+        try:
+            counts = [int(count) for count in options["options"].split(",")]
+        except ValueError:
+            raise CommandError("--options must be comma separated numbers")
+        types = len(settings.SHOP_OPTION_TYPE_CHOICES)
+        counts = (counts + [0] * types)[:types]
+        if [count for count in counts
+            if count < 0 or count > options["option_values"]]:
+            raise CommandError("--options must each be between 0 and "
+                               "--option-values")
+        options["option_counts"] = counts
+        options["site_id"] = Site.objects.get_current().id
+        if ProductVariation.objects.filter(sku=_sku(options, 0, 0)).exists():
+            raise CommandError("A catalog with the prefix %s has already "
+                               "been generated" % options["prefix"])
+
+        options["leaves"] = generate_categories(options)
+        options["option_names"] = generate_options(options)
+        if options.get("processes") == 1:
+            pool = None
+            map_jobs = imap
+        else:
+            # Close the connection before forking, so that each process
+            # opens its own rather than sharing this one, which closing
+            # in a process would end for all of them.
+            connection.close()
+            pool = Pool(options.get("processes"))
+            map_jobs = pool.imap_unordered
+        chunk_size = options["chunk_size"]
+        try:
+            jobs = [(options, i, min(i + chunk_size, options["products"]))
+                    for i in range(0, options["products"], chunk_size)]
+            self._run(map_jobs, generate_products, jobs, "Variations",
+                      verbosity)
+            if options["carts"] > 0:
+                bulk.insert(Cart, [Cart() for i in range(options["carts"])])
+                cart_ids = list(Cart.objects.order_by("-id").values_list(
+                    "id", flat=True)[:options["carts"]])
+                cart_ids.reverse()
+                jobs = [(options, cart_ids[i:i + chunk_size])
+                        for i in range(0, len(cart_ids), chunk_size)]
+                self._run(map_jobs, generate_cart_items, jobs, "Cart items",
+                          verbosity)
+            jobs = [(options, i, min(i + chunk_size, options["orders"]))
+                    for i in range(0, options["orders"], chunk_size)]
+            self._run(map_jobs, generate_orders, jobs, "Order items",
+                      verbosity)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        catalog.bump(catalog.SITE)
@@ -1,20 +1,34 @@
 import csv
+import gzip
 import os
 import shutil
 import datetime
+import tempfile
+from hashlib import md5
 from optparse import make_option
+from multiprocessing import Pool
+from time import time
 
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils.datastructures import SortedDict
+from django.utils.html import strip_tags
 from django.utils.translation import ugettext as _
-from django.db.utils import IntegrityError
 from mezzanine.conf import settings
+from mezzanine.core.templatetags.mezzanine_tags import thumbnail
 
+from cartridge.shop import bulk, catalog
+from cartridge.shop.models import Priced
 from cartridge.shop.models import Product
 from cartridge.shop.models import ProductOption
 from cartridge.shop.models import ProductImage
 from cartridge.shop.models import ProductVariation
 from cartridge.shop.models import Category
+from cartridge.shop.models import ProductUpsell
+from cartridge.shop.serializers import dump_products, get_serializer
+from cartridge.shop.serializers import load_products
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 
 
@@ -25,6 +39,10 @@ IMAGE_SUFFIXES = [".jpg", ".JPG", ".jpeg", ".JPEG", ".tif", ".gif", ".GIF"]
 EMPTY_IMAGE_ENTRIES = ["Please add", "N/A", ""]
 DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT = "%H:%M"
+# number of products written per transaction when importing
+IMPORT_CHUNK_SIZE = 500
+# number of variations loaded at a time when exporting
+EXPORT_CHUNK_SIZE = 1000
 
 # Here we define what column headings are used in the csv.
 TITLE = _("Title")
@@ -74,9 +92,48 @@ class Command(BaseCommand):
             dest='export',
             default=False,
             help=_('Export products from csv file.')),
+        make_option('--chunk-size',
+            type='int',
+            dest='chunk_size',
+            help=_('Number of products to import per transaction (default '
+                   '%s), or variations to export at a time (default %s).') %
+                   (IMPORT_CHUNK_SIZE, EXPORT_CHUNK_SIZE)),
+        make_option('--update',
+            action='store_true',
+            dest='update',
+            default=False,
+            help=_('Update variations with existing SKUs when importing, '
+                   'skipping rows that are unchanged since the last import.')),
+        make_option('--retire',
+            action='store_true',
+            dest='retire',
+            default=False,
+            help=_('Mark products with no SKUs in the csv file as '
+                   'unavailable when importing.')),
+        make_option('--processes',
+            type='int',
+            dest='processes',
+            help=_('Number of processes to copy and thumbnail images with '
+                   'when importing (default is the number of CPUs).')),
+        make_option('--format',
+            dest='format',
+            default='csv',
+            help=_('Format of the file, either csv, or the name of a '
+                   'serializer in SHOP_CATALOG_SERIALIZERS to export or '
+                   'import the whole catalog with.')),
+        make_option('--benchmark',
+            action='store_true',
+            dest='benchmark',
+            default=False,
+            help=_('Time exporting the catalog in each format and reading '
+                   'it back, instead of importing or exporting.')),
     )
 
     def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size')
+        if options.get('benchmark'):
+            benchmark_formats(chunk_size or EXPORT_CHUNK_SIZE)
+            return
         try:
             csv_file = args[0]
         except IndexError:
@@ -85,47 +142,115 @@ class Command(BaseCommand):
             raise CommandError("can't both import and export")
         if not options["import"] and not options["export"]:
             raise CommandError(_("need to import or export"))
-        if options['import']:
-            import_products(csv_file)
+        format = options.get('format') or 'csv'
+        if format != 'csv':
+            try:
+                serializer = get_serializer(format)
+            except KeyError:
+                raise CommandError(_("Unknown format: %s") % format)
+            except ImportError, e:
+                raise CommandError(e)
+            if options['import']:
+                import_catalog(serializer, csv_file,
+                               chunk_size or IMPORT_CHUNK_SIZE)
+            else:
+                export_catalog(serializer, csv_file,
+                               chunk_size or EXPORT_CHUNK_SIZE)
+        elif options['import']:
+            import_products(csv_file, chunk_size or IMPORT_CHUNK_SIZE,
+                            options['update'], options['retire'],
+                            options.get('processes'))
         elif options['export']:
-            export_products(csv_file)
-
-
-def _product_from_row(row):
-    product, created = Product.objects.get_or_create(title=row[TITLE])
-    product.content = row[CONTENT]
-    product.description = row[DESCRIPTION]
-    # TODO: set the 2 below from spreadsheet.
-    product.status = CONTENT_STATUS_PUBLISHED
-    product.available = True
-    # TODO: allow arbitrary level/number of categories.
-    base_cat, created = Category.objects.get_or_create(title=row[CATEGORY])
-    sub_cat, created = Category.objects.get_or_create(
-        title=row[SUB_CATEGORY],
-        parent=base_cat)
-    product.categories.add(sub_cat)
-    shop_cat, created = Category.objects.get_or_create(title="Shop")
-    product.categories.add(shop_cat)
-    return product
-
-
-def _make_image(image_str, product):
-    if image_str in EMPTY_IMAGE_ENTRIES:
-        return None
-    # try adding various image suffixes, if none given in original filename.
+            export_products(csv_file, chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def _file_hash(path):
+    """
+    Returns the MD5 hex digest of the contents of the file.
+    """
+    digest = md5()
+    f = open(path, "rb")
+    try:
+        for block in iter(lambda: f.read(65536), ""):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _hash_image(image_str):
+    """
+    Checks the image for a row exists in ``LOCAL_IMAGE_DIR`` and
+    returns its name with the hash of its contents. Run in the pool of
+    image processes.
+    """
     root, suffix = os.path.splitext(image_str)
     if suffix not in IMAGE_SUFFIXES:
         raise CommandError("INCORRECT SUFFIX: %s" % image_str)
     image_path = os.path.join(LOCAL_IMAGE_DIR, image_str)
     if not os.path.exists(image_path):
         raise CommandError("NO FILE %s" % image_path)
-    shutil.copy(image_path, PRODUCT_IMAGE_DIR)
-    #shutil.copy(image_path, os.path.join(PRODUCT_IMAGE_DIR, "orig"))
-    image, created = ProductImage.objects.get_or_create(
-        file="%s" % (os.path.join(SITE_MEDIA_IMAGE_DIR, image_str)),
-        description=image_str,  # TODO: handle column for this.
-        product=product)
-    return image
+    return image_str, _file_hash(image_path)
+
+
+def _store_image(image):
+    """
+    Copies the image into the product image directory unless the same
+    file is already there, and generates its thumbnails for each of
+    ``SHOP_IMAGE_THUMBNAIL_SIZES``, returning its name relative to
+    ``MEDIA_ROOT``. Run in the pool of image processes.
+    """
+    image_str, digest = image
+    image_path = os.path.join(PRODUCT_IMAGE_DIR, image_str)
+    sizes = settings.SHOP_IMAGE_THUMBNAIL_SIZES
+    if not os.path.exists(image_path) or _file_hash(image_path) != digest:
+        shutil.copy(os.path.join(LOCAL_IMAGE_DIR, image_str), image_path)
+        # Remove thumbnails of any previous file with the same name,
+        # which the thumbnail tag would otherwise keep using.
+        root = os.path.splitext(image_path)[0]
+        for width, height in sizes:
+            thumb_path = "%s-%sx%s.jpg" % (root, width, height)
+            if os.path.exists(thumb_path):
+                os.remove(thumb_path)
+    image_url = os.path.join(SITE_MEDIA_IMAGE_DIR, image_str)
+    for width, height in sizes:
+        thumbnail(image_url, width, height)
+    return image_url
+
+
+def ingest_images(image_strs, processes=None):
+    """
+    Copies the given images from ``LOCAL_IMAGE_DIR`` into the product
+    image directory with their thumbnails, returning a dict of image
+    names to their names relative to ``MEDIA_ROOT``. Images are hashed
+    first so that files with the same contents are only stored and
+    thumbnailed once, and both steps are spread over a pool of
+    ``processes`` processes, defaulting to the number of CPUs.
+    """
+    names = sorted(set([image_str for image_str in image_strs
+                        if image_str not in EMPTY_IMAGE_ENTRIES]))
+    if not names:
+        return {}
+    if not os.path.isdir(PRODUCT_IMAGE_DIR):
+        os.makedirs(PRODUCT_IMAGE_DIR)
+    pool = None
+    if processes == 1:
+        map_images = map
+    else:
+        pool = Pool(processes)
+        map_images = pool.map
+    try:
+        hashes = dict(map_images(_hash_image, names))
+        stored = {}
+        for name in names:
+            stored.setdefault(hashes[name], name)
+        unique = [(name, digest) for digest, name in stored.items()]
+        urls = dict(zip([digest for name, digest in unique],
+                        map_images(_store_image, unique)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return dict([(name, urls[hashes[name]]) for name in names])
 
 
 def _make_date(date_str, time_str):
@@ -134,91 +259,568 @@ def _make_date(date_str, time_str):
     return date
 
 
-def import_products(csv_file):
-    print _("Importing ..")
-    # More appropriate for testing.
-    #Product.objects.all().delete()
-    reader = csv.DictReader(open(csv_file), delimiter=',')
-    for row in reader:
-        print row
-        product = _product_from_row(row)
-        try:
-            variation = ProductVariation.objects.create(
-                # strip whitespace
-                sku=row[SKU].replace(" ", ""),
-                product=product,
-            )
-        except IntegrityError:
-            raise CommandError("Product with SKU exists! sku: %s" % row[SKU])
-        if row[NUM_IN_STOCK]:
-            variation.num_in_stock = row[NUM_IN_STOCK]
+def _sku(row):
+    # strip whitespace
+    return row[SKU].replace(" ", "")
+
+
+def _hash(row):
+    """
+    Returns a hash of the values in the row, stored with its variation
+    so that later imports can skip the row if it hasn't changed.
+    """
+    return md5("\0".join([row.get(name) or "" for name in fieldnames]))\
+        .hexdigest()
+
+
+class ProductImporter(object):
+    """
+    Imports products from the rows of the csv file. The existing
+    categories, options, products and SKUs are loaded once up front,
+    and the rows are grouped by product title. Images for all of the
+    rows are stored with ``ingest_images`` before anything is written
+    to the database, then each chunk of products is written in its
+    own transaction, inserting and updating rows with a single
+    statement execution per table, rather than saving each product
+    and variation. Since model ``save`` methods
+    and signals aren't used, the catalog cache and modified times are
+    updated once per chunk.
+
+    With ``update`` set, rows for existing SKUs update their variation
+    rather than being an error, and rows that haven't changed since
+    the last import, going by the hash stored for each variation, are
+    skipped without any writes.
+    """
+
+    def __init__(self, update=False, processes=None):
+        self.update = update
+        self.processes = processes
+        self.site = Site.objects.get_current()
+        self.categories = {}
+        self.category_titles = {}
+        categories = Category.objects.order_by("id")
+        for id, title, parent_id in categories.values_list("id", "title",
+                                                           "parent"):
+            self.categories.setdefault((title, parent_id), id)
+            self.category_titles.setdefault(title, id)
+        self.options = set(ProductOption.objects.values_list("type", "name"))
+        self.products = {}
+        for title, id in Product.objects.order_by("id").values_list("title",
+                                                                    "id"):
+            self.products.setdefault(title, id)
+        self.slugs = set(Product.objects.values_list("slug", flat=True))
+        self.variations = {}
+        self.defaults = set()
+        variations = ProductVariation.objects.values_list("sku", "id",
+            "product", "default", "import_hash")
+        for variation in variations.iterator():
+            self.variations[variation[0]] = variation[1:]
+            if variation[3]:
+                self.defaults.add(variation[2])
+        self.empty_options = dict([("%s__isnull" % f.name, True)
+                                   for f in ProductVariation.option_fields()])
+
+    def _category(self, title, parent_id=None):
+        """
+        Returns the ID of the category with the given title, creating
+        it if it doesn't exist. Categories without a parent are matched
+        by title alone.
+        """
+        if parent_id is None:
+            lookup, key = self.category_titles, title
+        else:
+            lookup, key = self.categories, (title, parent_id)
+        if key not in lookup:
+            category = Category.objects.create(title=title,
+                                               parent_id=parent_id)
+            self.categories[(title, parent_id)] = category.id
+            self.category_titles.setdefault(title, category.id)
+            lookup[key] = category.id
+        return lookup[key]
+
+    def _slug(self, product):
+        """
+        Returns a unique slug for a new product, the same way
+        ``Slugged.save`` does without querying for each attempt.
+        """
+        slug = product.get_slug()
+        i = 0
+        while slug in self.slugs:
+            i += 1
+            slug = "%s-%s" % (product.get_slug(), i)
+        self.slugs.add(slug)
+        return slug
+
+    def _set_priced(self, obj, row):
+        """
+        Sets the price and sale fields from the row on the given
+        product or variation.
+        """
         if row[UNIT_PRICE]:
-            variation.unit_price = row[UNIT_PRICE]
+            obj.unit_price = row[UNIT_PRICE]
         if row[SALE_PRICE]:
-            variation.sale_price = row[SALE_PRICE]
+            obj.sale_price = row[SALE_PRICE]
         if row[SALE_START_DATE] and row[SALE_START_TIME]:
-            variation.sale_from = _make_date(row[SALE_START_DATE],
-                                                row[SALE_START_TIME])
+            obj.sale_from = _make_date(row[SALE_START_DATE],
+                                       row[SALE_START_TIME])
         if row[SALE_END_DATE] and row[SALE_END_TIME]:
-            variation.sale_to = _make_date(row[SALE_END_DATE],
-                                                row[SALE_END_TIME])
-        for option in TYPE_CHOICES:
-            if row[option]:
-                setattr(variation, "option%s" % TYPE_CHOICES[option], row[option])
-                new_option, created = ProductOption.objects.get_or_create(
-                    type=TYPE_CHOICES[option],  # TODO: set dynamically
-                    name=row[option])
-        variation.save()
-        image = _make_image(row[IMAGE], product)
-        if image:
-            variation.image = image
-        product.variations.manage_empty()
-        product.copy_default_variation()
-        product.save()
+            obj.sale_to = _make_date(row[SALE_END_DATE], row[SALE_END_TIME])
+
+    def check(self, products):
+        """
+        Checks every row has a SKU that isn't repeated, and unless
+        updating, doesn't exist yet, before anything is written.
+        """
+        skus = set()
+        for title, rows in products.items():
+            for row in rows:
+                sku = _sku(row)
+                if not sku:
+                    raise CommandError("Product has no SKU: %s" % title)
+                exists = not self.update and sku in self.variations
+                if exists or sku in skus:
+                    raise CommandError("Product with SKU exists! sku: %s" %
+                                       row[SKU])
+                skus.add(sku)
+
+    def import_chunk(self, chunk):
+        """
+        Writes the given list of product titles and their rows.
+        """
+        now = datetime.datetime.now()
+        images = self.images
 
+        # Products - insert new products with the price fields of
+        # their first row, which becomes their default variation, and
+        # update existing products with the content of their last row.
+        new_products = []
+        updated_products = []
+        defaulted_products = []
+        for title, rows in chunk:
+            product = Product(title=title, content=rows[-1][CONTENT],
+                              description=rows[-1][DESCRIPTION],
+                              status=CONTENT_STATUS_PUBLISHED,
+                              available=True, publish_date=now,
+                              site=self.site)
+            product.description = (product.description or
+                strip_tags(product.description_from_content()))
+            product.id = self.products.get(title)
+            default_row = None
+            if product.id not in self.defaults:
+                default_row = rows[0]
+            else:
+                for row in rows:
+                    variation = self.variations.get(_sku(row))
+                    if variation is not None and variation[2]:
+                        default_row = row
+            if default_row is not None:
+                self._set_priced(product, default_row)
+                product.image = images.get(default_row[IMAGE])
+            if product.id is None:
+                product.slug = self._slug(product)
+                new_products.append(product)
+            elif default_row is None:
+                updated_products.append(product)
+            else:
+                defaulted_products.append(product)
+        bulk.insert(Product, new_products)
+        slugs = [product.slug for product in new_products]
+        ids = dict(Product.objects.filter(slug__in=slugs).values_list("slug",
+                                                                      "id"))
+        for product in new_products:
+            product.id = ids[product.slug]
+            self.products[product.title] = product.id
+        fields = ["content", "description", "status", "available",
+                  "date_modified"]
+        bulk.update(Product, fields, updated_products)
+        priced = [f.name for f in Priced._meta.fields]
+        bulk.update(Product, fields + priced + ["image"], defaulted_products)
+        product_ids = [self.products[title] for title, rows in chunk]
+
+        # Categories - add each product to the categories for all of
+        # its rows that it isn't already in, being the sub-category of
+        # each row, or the category if it has no sub-category, along
+        # with "Shop".
+        through = Product.categories.through
+        existing = through.objects.filter(product__in=product_ids)
+        existing = set(existing.values_list("product", "category"))
+        links = []
+        for title, rows in chunk:
+            product_id = self.products[title]
+            category_ids = [self._category("Shop")]
+            for row in rows:
+                if row[CATEGORY]:
+                    category_id = self._category(row[CATEGORY])
+                    if row[SUB_CATEGORY]:
+                        category_id = self._category(row[SUB_CATEGORY],
+                                                     category_id)
+                    category_ids.append(category_id)
+            for category_id in category_ids:
+                if (product_id, category_id) not in existing:
+                    existing.add((product_id, category_id))
+                    links.append((product_id, category_id))
+        bulk.insert_rows(through._meta.db_table, ["product_id",
+                         "category_id"], links)
+
+        # Options and images - insert any that don't exist yet.
+        options = []
+        for title, rows in chunk:
+            for row in rows:
+                for option in TYPE_CHOICES:
+                    key = (TYPE_CHOICES[option], row[option])
+                    if row[option] and key not in self.options:
+                        self.options.add(key)
+                        options.append(ProductOption(type=key[0],
+                                                     name=key[1]))
+        bulk.insert(ProductOption, options)
+        product_images = {}
+        existing = ProductImage.objects.filter(product__in=product_ids)
+        for id, product_id, file in existing.order_by("-id").values_list(
+                "id", "product", "file"):
+            product_images[(product_id, file)] = id
+        new_images = []
+        for title, rows in chunk:
+            for row in rows:
+                key = (self.products[title], images.get(row[IMAGE]))
+                if key[1] is not None and key not in product_images:
+                    product_images[key] = None
+                    new_images.append(ProductImage(product_id=key[0],
+                                                   file=key[1],
+                                                   description=row[IMAGE]))
+        if new_images:
+            bulk.insert(ProductImage, new_images)
+            existing = ProductImage.objects.filter(product__in=product_ids)
+            for id, product_id, file in existing.order_by("-id").values_list(
+                    "id", "product", "file"):
+                product_images[(product_id, file)] = id
+
+        # Variations - remove any empty variation from existing
+        # products that wasn't imported, as ``manage_empty`` does when
+        # a product has other variations, then insert or update the
+        # variations for every row. Rows without an image use the
+        # product's first image, as ``ProductVariation.save`` does,
+        # which is then also used for the product if it's the default
+        # variation's, as ``copy_default_variation`` does.
+        empty = ProductVariation.objects.filter(product__in=product_ids,
+                                                import_hash="",
+                                                **self.empty_options)
+        for product_id in empty.filter(default=True).values_list("product",
+                                                                 flat=True):
+            self.defaults.discard(product_id)
+        empty.delete()
+        first_images = {}
+        for (product_id, file), id in product_images.items():
+            if id < first_images.get(product_id, id + 1):
+                first_images[product_id] = id
+        image_files = dict([(id, file) for (product_id, file), id
+                            in product_images.items()])
+        defaulted = dict([(product.id, product) for product in
+                          new_products + defaulted_products])
+        imaged_products = []
+        new_variations = []
+        updated_variations = []
+        for title, rows in chunk:
+            product_id = self.products[title]
+            for row in rows:
+                variation = ProductVariation(product_id=product_id,
+                                             sku=_sku(row),
+                                             import_hash=_hash(row))
+                existing = self.variations.get(variation.sku)
+                if existing is not None:
+                    variation.id, variation.default = existing[0], existing[2]
+                if row[NUM_IN_STOCK]:
+                    variation.num_in_stock = row[NUM_IN_STOCK]
+                self._set_priced(variation, row)
+                for option in TYPE_CHOICES:
+                    if row[option]:
+                        setattr(variation, "option%s" % TYPE_CHOICES[option],
+                                row[option])
+                image_id = product_images.get((product_id,
+                                               images.get(row[IMAGE])))
+                variation.image_id = image_id or first_images.get(product_id)
+                if product_id not in self.defaults:
+                    self.defaults.add(product_id)
+                    variation.default = True
+                product = defaulted.get(product_id)
+                if (variation.default and product is not None and
+                        product.image is None and variation.image_id):
+                    product.image = image_files[variation.image_id]
+                    imaged_products.append(product)
+                if variation.id is None:
+                    new_variations.append(variation)
+                else:
+                    updated_variations.append(variation)
+        bulk.insert(ProductVariation, new_variations)
+        fields = ["product", "num_in_stock", "default", "image",
+                  "import_hash"] + priced
+        fields += [f.name for f in ProductVariation.option_fields()]
+        bulk.update(ProductVariation, fields, updated_variations)
+        bulk.update(Product, ["image"], imaged_products)
+
+        # Anything cached for the products is now out of date.
+        ProductUpsell.objects.update_for(product_ids)
+        catalog.touch(products=product_ids)
+
+    def set_available(self, product_ids, available, chunk_size):
+        """
+        Marks the given products available or unavailable where they
+        aren't already, returning the number of products marked.
+        """
+        product_ids = list(product_ids)
+        marked = 0
+        for i in range(0, len(product_ids), chunk_size):
+            products = Product.objects.filter(available=not available,
+                id__in=product_ids[i:i + chunk_size])
+            ids = list(products.values_list("id", flat=True))
+            if ids:
+                Product.objects.filter(id__in=ids).update(available=available)
+                catalog.touch(products=ids)
+                marked += len(ids)
+        return marked
+
+    def retire(self, listed, chunk_size):
+        """
+        Marks products unavailable that have variations, but aren't
+        one of the given listed products, returning the number of
+        products marked.
+        """
+        product_ids = set([variation[1] for variation in
+                           self.variations.values()]) - listed
+        return self.set_available(product_ids, False, chunk_size)
+
+    def run(self, rows, chunk_size, retire=False):
+        """
+        Imports the given rows a chunk of products at a time, printing
+        the number of rows imported per second after each chunk, and
+        returns the number of variations inserted, updated and
+        unchanged, and the number of products retired and restored.
+        Products are listed if any of their variations are in the
+        rows, including new and unchanged ones, and listed products
+        that were retired by an earlier import are made available
+        again.
+        """
+        products = SortedDict()
+        for row in rows:
+            products.setdefault(row[TITLE], []).append(row)
+        self.check(products)
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0, "retired": 0,
+                  "restored": 0}
+        listed = set()
+        changed = SortedDict()
+        for title, rows in products.items():
+            for row in rows:
+                variation = self.variations.get(_sku(row))
+                if variation is None:
+                    counts["inserted"] += 1
+                elif variation[3] == _hash(row):
+                    counts["unchanged"] += 1
+                    listed.add(variation[1])
+                    continue
+                else:
+                    counts["updated"] += 1
+                changed.setdefault(title, []).append(row)
+        titles = changed.keys()
+        self.images = ingest_images([row[IMAGE] for rows in changed.values()
+                                     for row in rows], self.processes)
+        start = time()
+        imported = 0
+        for i in range(0, len(titles), chunk_size):
+            chunk = [(title, changed[title])
+                     for title in titles[i:i + chunk_size]]
+            transaction.commit_on_success(self.import_chunk)(chunk)
+            imported += sum([len(rows) for title, rows in chunk])
+            rate = imported / max(time() - start, 0.001)
+            print _("Imported %(rows)s rows (%(rate).0f rows/sec)") % {
+                "rows": imported, "rate": rate}
+        # Rows that changed are written to the product for their title.
+        listed.update([self.products[title] for title in titles])
+        counts["restored"] = transaction.commit_on_success(
+            self.set_available)(listed, True, chunk_size)
+        if retire:
+            counts["retired"] = transaction.commit_on_success(self.retire)(
+                listed, chunk_size)
+        if imported or counts["retired"] or counts["restored"]:
+            catalog.bump(catalog.SITE)
+        return counts
+
+
+def import_products(csv_file, chunk_size=IMPORT_CHUNK_SIZE, update=False,
+                    retire=False, processes=None):
+    print _("Importing ..")
+    # More appropriate for testing.
+    #Product.objects.all().delete()
+    reader = csv.DictReader(open(csv_file), delimiter=',')
+    counts = ProductImporter(update, processes).run(reader, chunk_size,
+                                                    retire)
+    print _("Inserted: %(inserted)s, Updated: %(updated)s, "
+            "Unchanged: %(unchanged)s, Retired: %(retired)s, "
+            "Restored: %(restored)s") % counts
     print "Variations: %s" % ProductVariation.objects.all().count()
     print "Products: %s" % Product.objects.all().count()
+    return counts
+
+
+def _first_categories(product_ids):
+    """
+    Returns a dict of product IDs to the first of their categories, in
+    the same order as ``product.categories.all()``, as (title, parent
+    title) pairs.
+    """
+    through = Product.categories.through.objects
+    links = through.filter(product__in=product_ids).values_list("product",
+                                                                "category")
+    categories = Category.objects.filter(id__in=[l[1] for l in links])
+    categories = dict([(c[0], c[1:]) for c in categories.values_list("id",
+                       "titles", "title", "parent__title")])
+    first = {}
+    for product_id, category_id in links:
+        category = categories[category_id]
+        if product_id not in first or category < first[product_id]:
+            first[product_id] = category
+    return dict([(product_id, category[1:])
+                 for product_id, category in first.items()])
 
 
-def export_products(csv_file):
+def export_products(csv_file, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the variations to the csv file a chunk at a time, loading
+    the products and categories for each chunk together so that memory
+    use and the number of queries don't grow with each variation. The
+    file is gzipped if its name ends with ``.gz``.
+    """
     print _("Exporting ..")
-    filehandle = open(csv_file, 'w')
+    if csv_file.endswith(".gz"):
+        filehandle = gzip.open(csv_file, 'wb')
+    else:
+        filehandle = open(csv_file, 'w')
     writer = csv.DictWriter(filehandle, delimiter=',', fieldnames=fieldnames)
     headers = dict()
     for field in fieldnames:
         headers[field] = field
     writer.writerow(headers)
-    for pv in ProductVariation.objects.all():
-        row = dict()
-        row[TITLE] = pv.product.title
-        row[CONTENT] = pv.product.content
-        row[DESCRIPTION] = pv.product.description
-        row[SKU] = pv.sku
-        row[IMAGE] = pv.image
-        # TODO: handle multiple categories, and multiple levels of categories
-        cat = pv.product.categories.all()[0]
-        if cat.parent:
-            row[SUB_CATEGORY] = cat.title
-            row[CATEGORY] = cat.parent.title
-        else:
-            row[CATEGORY] = cat.title
-            row[SUB_CATEGORY] = ""
+    options = [(option, "option%s" % TYPE_CHOICES[option])
+               for option in TYPE_CHOICES]
+    variation_fields = ["id", "product", "sku", "image__description",
+                        "image__file", "num_in_stock", "unit_price",
+                        "sale_price", "sale_from", "sale_to"]
+    variation_fields += [field for option, field in options]
+    last_id = 0
+    while True:
+        variations = ProductVariation.objects.filter(id__gt=last_id)
+        variations = list(variations.order_by("id").values(
+            *variation_fields)[:chunk_size])
+        if not variations:
+            break
+        last_id = variations[-1]["id"]
+        product_ids = set([pv["product"] for pv in variations])
+        products = Product.objects.filter(id__in=product_ids)
+        products = dict([(p[0], p[1:]) for p in products.values_list("id",
+                         "title", "content", "description")])
+        categories = _first_categories(product_ids)
+        for pv in variations:
+            row = dict()
+            product = products[pv["product"]]
+            row[TITLE], row[CONTENT], row[DESCRIPTION] = product
+            row[SKU] = pv["sku"]
+            row[IMAGE] = pv["image__description"] or pv["image__file"]
+            # TODO: handle multiple categories, and multiple levels of
+            # categories
+            title, parent_title = categories.get(pv["product"], ("", None))
+            if parent_title:
+                row[SUB_CATEGORY] = title
+                row[CATEGORY] = parent_title
+            else:
+                row[CATEGORY] = title
+                row[SUB_CATEGORY] = ""
 
-        for option in TYPE_CHOICES:
-            row[option] = getattr(pv, "option%s" % TYPE_CHOICES[option])
+            for option, field in options:
+                row[option] = pv[field]
 
-        row[NUM_IN_STOCK] = pv.num_in_stock
-        row[UNIT_PRICE] = pv.unit_price
-        row[SALE_PRICE] = pv.sale_price
-        try:
-            row[SALE_START_DATE] = pv.sale_from.strftime(DATE_FORMAT)
-            row[SALE_START_TIME] = pv.sale_from.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        try:
-            row[SALE_END_DATE] = pv.sale_to.strftime(DATE_FORMAT)
-            row[SALE_END_TIME] = pv.sale_to.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        writer.writerow(row)
+            row[NUM_IN_STOCK] = pv["num_in_stock"]
+            row[UNIT_PRICE] = pv["unit_price"]
+            row[SALE_PRICE] = pv["sale_price"]
+            if pv["sale_from"]:
+                row[SALE_START_DATE] = pv["sale_from"].strftime(DATE_FORMAT)
+                row[SALE_START_TIME] = pv["sale_from"].strftime(TIME_FORMAT)
+            if pv["sale_to"]:
+                row[SALE_END_DATE] = pv["sale_to"].strftime(DATE_FORMAT)
+                row[SALE_END_TIME] = pv["sale_to"].strftime(TIME_FORMAT)
+            writer.writerow(row)
     filehandle.close()
+
+
+def _counted(chunks, counts):
+    """
+    Yields the given chunks, adding the number of items in each to
+    the list of counts.
+    """
+    for chunk in chunks:
+        counts.append(len(chunk))
+        yield chunk
+
+
+def export_catalog(serializer, file_name, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the whole catalog to the file with the given serializer
+    from ``SHOP_CATALOG_SERIALIZERS``.
+    """
+    print _("Exporting ..")
+    start = time()
+    counts = []
+    serializer.write(_counted(dump_products(chunk_size), counts), file_name)
+    rate = sum(counts) / max(time() - start, 0.001)
+    print _("Exported %(products)s products (%(rate).0f products/sec)") % {
+        "products": sum(counts), "rate": rate}
+
+
+def import_catalog(serializer, file_name, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Loads the whole catalog from the file with the given serializer
+    from ``SHOP_CATALOG_SERIALIZERS``.
+    """
+    print _("Importing ..")
+    start = time()
+    total = load_products(serializer.read(file_name, chunk_size))
+    rate = total / max(time() - start, 0.001)
+    print _("Imported %(products)s products (%(rate).0f products/sec)") % {
+        "products": total, "rate": rate}
+    print "Variations: %s" % ProductVariation.objects.all().count()
+    print "Products: %s" % Product.objects.all().count()
+
+
+def benchmark_formats(chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports the catalog to a temporary file in csv and each format in
+    ``SHOP_CATALOG_SERIALIZERS``, printing the time taken to write
+    each file and to read it back without writing to the database,
+    and the size of each file.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        formats = [("csv", None)]
+        for name, path in settings.SHOP_CATALOG_SERIALIZERS:
+            try:
+                formats.append((name, get_serializer(name)))
+            except ImportError, e:
+                print "%s: %s" % (name, e)
+        for name, serializer in formats:
+            file_name = os.path.join(directory, "catalog.%s" % name)
+            start = time()
+            if serializer is None:
+                export_products(file_name, chunk_size)
+            else:
+                export_catalog(serializer, file_name, chunk_size)
+            written = time() - start
+            start = time()
+            if serializer is None:
+                for row in csv.DictReader(open(file_name)):
+                    pass
+            else:
+                for records in serializer.read(file_name, chunk_size):
+                    pass
+            read = time() - start
+            print _("%(format)s: write %(write).2fs, read %(read).2fs, "
+                    "%(size)s bytes") % {"format": name, "write": written,
+                    "read": read, "size": os.path.getsize(file_name)}
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,154 @@
+"""
+Updates the unit price and number in stock of variations from a feed
+of SKUs, without the rest of the product data that ``product_db``
+imports. The feed is read a chunk of rows at a time, each chunk is
+written with a single ``UPDATE`` statement, and the prices of the
+products for the updated SKUs are then copied from their default
+variations in one pass.
+"""
+
+import csv
+import sys
+from decimal import Decimal, InvalidOperation
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import simplejson
+from django.utils.translation import ugettext as _
+
+from cartridge.shop import catalog
+from cartridge.shop.management.commands.product_db import NUM_IN_STOCK
+from cartridge.shop.management.commands.product_db import SKU, UNIT_PRICE
+from cartridge.shop.models import Product, ProductVariation
+
+
+CHUNK_SIZE = 500
+
+
+def _csv_rows(feed):
+    """
+    Yields the SKU, unit price and number in stock of each row in a
+    csv feed, using the same column headings as ``product_db``.
+    """
+    for row in csv.DictReader(feed):
+        yield row.get(SKU), row.get(UNIT_PRICE), row.get(NUM_IN_STOCK)
+
+
+def _json_rows(feed):
+    """
+    Yields the SKU, unit price and number in stock of each line in a
+    feed of JSON objects, one per line.
+    """
+    for line in feed:
+        if line.strip():
+            try:
+                row = simplejson.loads(line)
+            except ValueError:
+                raise CommandError("Invalid JSON: %s" % line.strip())
+            yield (row.get("sku"), row.get("unit_price"),
+                   row.get("num_in_stock"))
+
+
+def _clean(rows):
+    """
+    Yields the given rows with their SKUs stripped of whitespace, and
+    their unit price and number in stock converted, with blank values
+    converted to ``None`` to leave them unchanged.
+    """
+    for sku, unit_price, num_in_stock in rows:
+        sku = unicode(sku or "").replace(" ", "")
+        if not sku:
+            raise CommandError("Row has no SKU")
+        try:
+            if unit_price not in (None, ""):
+                unit_price = Decimal(str(unit_price))
+            else:
+                unit_price = None
+            if num_in_stock not in (None, ""):
+                num_in_stock = int(num_in_stock)
+            else:
+                num_in_stock = None
+        except (InvalidOperation, ValueError):
+            raise CommandError("Invalid price or stock for SKU: %s" % sku)
+        yield sku, unit_price, num_in_stock
+
+
+def update_stock_prices(rows, chunk_size=CHUNK_SIZE):
+    """
+    Updates the variations for the given SKU, unit price and number in
+    stock rows, a chunk of rows per transaction, then the prices of
+    their products. Returns the number of rows read and the number of
+    products updated.
+    """
+    update = transaction.commit_on_success(
+        ProductVariation.objects.update_stock_prices)
+    product_ids = set()
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            product_ids.update(update(chunk))
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        product_ids.update(update(chunk))
+        total += len(chunk)
+    if product_ids:
+        transaction.commit_on_success(
+            Product.objects.copy_default_prices)(product_ids)
+        catalog.touch(products=product_ids)
+        catalog.bump(catalog.SITE)
+    return total, len(product_ids)
+
+
+class Command(BaseCommand):
+    args = "<feed_file>"
+    help = _("Update the unit price and number in stock of variations "
+             "from a csv or JSON lines file of SKUs, or - for stdin.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--format",
+            dest="format",
+            choices=("csv", "json"),
+            help=_("Format of the feed, either csv with the same headings "
+                   "as product_db, or json with an object per line. "
+                   "Defaults to json for .json and .jsonl files.")),
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=CHUNK_SIZE,
+            help=_("Number of rows to update per statement.")),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            feed_file = args[0]
+        except IndexError:
+            raise CommandError(_("Please provide a feed file"))
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        format = options.get("format")
+        if format is None:
+            if feed_file.endswith((".json", ".jsonl")):
+                format = "json"
+            else:
+                format = "csv"
+        if feed_file == "-":
+            feed = sys.stdin
+        else:
+            feed = open(feed_file)
+        if format == "json":
+            rows = _json_rows(feed)
+        else:
+            rows = _csv_rows(feed)
+        start = time()
+        total, products = update_stock_prices(_clean(rows),
+                                              options["chunk_size"])
+        if int(options.get("verbosity", 1)) > 0:
+            rate = total / max(time() - start, 0.001)
+            print _("Updated %(rows)s rows for %(products)s products "
+                    "(%(rate).0f rows/sec)") % {"rows": total,
+                    "products": products, "rate": rate}
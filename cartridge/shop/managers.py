@@ -2,10 +2,16 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
 
-from django.db.models import Manager, Q
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Manager, Q, Sum
+from django.db.models.query import ValuesQuerySet
 from django.utils.datastructures import SortedDict
 
 from mezzanine.conf import settings
+from mezzanine.core.managers import DisplayableManager, SearchableQuerySet
+from mezzanine.pages.models import Page
+
+from cartridge.shop import bulk
 
 
 class CartManager(Manager):
@@ -26,7 +32,10 @@ class CartManager(Manager):
             cart = self.create()
             request.session["cart"] = cart.id
         else:
-            cart.save() # Update timestamp.
+            # Update timestamp, without saving the cart's totals which
+            # may be changed concurrently.
+            cart.last_updated = datetime.now()
+            self.filter(id=cart.id).update(last_updated=cart.last_updated)
         return cart
 
 
@@ -44,6 +53,158 @@ class OrderManager(Manager):
         raise self.model.DoesNotExist
 
 
+class CategoryAncestryManager(Manager):
+
+    def _insert(self, rows):
+        """
+        Insert the given ancestor, descendant and depth rows in a
+        single statement execution.
+        """
+        if rows:
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            sql = ("INSERT INTO %s (ancestor_id, descendant_id, depth) "
+                   "VALUES (%%s, %%s, %%s)" % table)
+            connection.cursor().executemany(sql, rows)
+            transaction.commit_unless_managed()
+
+    def _category_ids(self, ids=None):
+        """
+        Return the set of all category IDs, or only those in the given
+        list of page IDs.
+        """
+        categories = self.model._meta.get_field("ancestor").rel.to.objects
+        if ids is not None:
+            categories = categories.filter(id__in=ids)
+        return set(categories.values_list("id", flat=True))
+
+    def rebuild(self):
+        """
+        Recreate the ancestry of every category from the page tree.
+        Pages moved by saving them are handled by ``update_for`` and
+        the page signal handlers, so this only needs to be called if
+        pages are moved without saving them, such as with a queryset
+        update.
+        """
+        parents = dict(Page.objects.values_list("id", "parent"))
+        category_ids = self._category_ids()
+        rows = []
+        for category_id in category_ids:
+            page_id, depth = category_id, 0
+            while page_id is not None:
+                if page_id in category_ids:
+                    rows.append((page_id, category_id, depth))
+                page_id, depth = parents.get(page_id), depth + 1
+        self.all().delete()
+        self._insert(rows)
+
+    def subtree(self, page_id):
+        """
+        Return the list of IDs of the categories in the page tree below
+        the page with the given ID, including the page itself if it's
+        a category, walking down a level of the tree at a time.
+        """
+        category_ids = list(self._category_ids([page_id]))
+        page_ids = [page_id]
+        while page_ids:
+            children = Page.objects.filter(parent__in=page_ids)
+            page_ids = list(children.values_list("id", flat=True))
+            category_ids.extend(self._category_ids(page_ids))
+        return category_ids
+
+    def update_for(self, category):
+        """
+        Update the ancestry for the given category and all of its
+        descendants, after it's been created or moved to a new parent.
+        The descendants' depths relative to the category remain the
+        same, so the rows within the subtree are kept, while the rows
+        linking the subtree to the category's previous ancestors are
+        replaced with rows linking it to its new ancestors.
+        """
+        chain = []
+        # The parent may have been assigned from a string, such as by
+        # the admin's page tree.
+        page_id, depth = Page._meta.pk.to_python(category.parent_id), 1
+        while page_id is not None:
+            chain.append((page_id, depth))
+            parent = Page.objects.filter(id=page_id).values_list("parent")
+            page_id, depth = parent[0][0], depth + 1
+        category_ids = self._category_ids([id for id, depth in chain])
+        ancestors = [(id, depth) for id, depth in chain if id in category_ids]
+        descendants = self.filter(ancestor=category)
+        subtree = list(descendants.values_list("descendant", "depth"))
+        if not subtree:
+            subtree = [(category.id, 0)]
+            self._insert([(category.id, category.id, 0)])
+        subtree_ids = [id for id, depth in subtree]
+        stale = self.filter(descendant__in=subtree_ids)
+        stale.exclude(ancestor__in=subtree_ids).delete()
+        self._insert([(ancestor_id, descendant_id, a_depth + d_depth)
+                      for ancestor_id, a_depth in ancestors
+                      for descendant_id, d_depth in subtree])
+
+
+class ListingQuerySet(ValuesQuerySet):
+    """
+    Values queryset that yields a ``ListingProduct`` for each row
+    rather than a dict.
+    """
+
+    def iterator(self):
+        from cartridge.shop.models import ListingProduct
+        for row in super(ListingQuerySet, self).iterator():
+            yield ListingProduct(row)
+
+
+class ProductQuerySet(SearchableQuerySet):
+
+    def listing(self):
+        """
+        Return the products as ``ListingProduct`` objects containing
+        only the fields used when rendering a list of products, rather
+        than loading each product's full content into a model instance.
+        """
+        from cartridge.shop.models import ListingProduct
+        fields = ListingProduct.__slots__
+        return self._clone(klass=ListingQuerySet, setup=True, _fields=fields)
+
+
+class ProductManager(DisplayableManager):
+
+    def get_query_set(self):
+        """
+        Swap in ``ProductQuerySet`` while keeping the site and search
+        handling of ``DisplayableManager``.
+        """
+        queryset = super(ProductManager, self).get_query_set()
+        return queryset._clone(klass=ProductQuerySet)
+
+    def copy_default_prices(self, product_ids, chunk_size=500):
+        """
+        Copy the price fields from the default variation of each of
+        the given product IDs, as ``Product.copy_default_variation``
+        does, with a single statement for each chunk of products.
+        """
+        from cartridge.shop.models import Priced, ProductVariation
+        qn = connection.ops.quote_name
+        product = qn(self.model._meta.db_table)
+        variation = qn(ProductVariation._meta.db_table)
+        assignments = ", ".join(["%(column)s = (SELECT %(variation)s."
+            "%(column)s FROM %(variation)s WHERE %(variation)s.product_id = "
+            "%(product)s.id AND %(variation)s.%(default)s = %%s)" % {
+                "column": qn(f.column), "variation": variation,
+                "product": product, "default": qn("default")}
+            for f in Priced._meta.fields])
+        product_ids = list(product_ids)
+        cursor = connection.cursor()
+        for i in range(0, len(product_ids), chunk_size):
+            ids = product_ids[i:i + chunk_size]
+            sql = "UPDATE %s SET %s WHERE id IN (%s)" % (product,
+                assignments, ", ".join(["%s"] * len(ids)))
+            params = [True] * len(Priced._meta.fields) + ids
+            cursor.execute(sql, params)
+        transaction.commit_unless_managed()
+
+
 class ProductOptionManager(Manager):
 
     def as_fields(self):
@@ -91,6 +252,88 @@ class ProductVariationManager(Manager):
                 except self.model.DoesNotExist:
                     self.create(**variation)
                     
+    def from_skus(self, skus, for_user=None):
+        """
+        Return a dict of variations of published products with a price,
+        keyed by SKU, with their products and images. The quantities
+        of each in carts are loaded in a single query, and cached on
+        each variation for ``has_stock``.
+        """
+        from cartridge.shop.models import CartItem, Product
+        published = Product.objects.published(for_user=for_user)
+        variations = self.filter(sku__in=skus, unit_price__isnull=False,
+                                 product__in=published)
+        variations = dict([(variation.sku, variation) for variation in
+                           variations.select_related("product", "image")])
+        items = CartItem.objects.filter(sku__in=variations.keys())
+        items = items.values("sku").annotate(quantity_sum=Sum("quantity"))
+        in_carts = dict([(i["sku"], i["quantity_sum"]) for i in items])
+        for sku, variation in variations.items():
+            if variation.num_in_stock is not None:
+                num_in_stock = variation.num_in_stock - in_carts.get(sku, 0)
+                variation._cached_num_in_stock = num_in_stock
+        return variations
+
+    def update_stock_prices(self, rows):
+        """
+        Update the unit price and number in stock for the given SKU,
+        unit price and number in stock rows with a single statement,
+        where a value of ``None`` leaves the field unchanged, and later
+        rows for the same SKU take priority. Return the IDs of the
+        products for the SKUs.
+        """
+        # ``CASE`` uses the first row for a SKU, whereas applying the
+        # rows in order keeps the last value given for each field, so
+        # repeated SKUs are merged with later values taking priority.
+        merged = SortedDict()
+        for row in rows:
+            previous = merged.get(row[0], row)
+            merged[row[0]] = tuple([previous[i] if row[i] is None else
+                                    row[i] for i in range(len(row))])
+        rows = merged.values()
+        qn = connection.ops.quote_name
+        assignments = []
+        params = []
+        for i, name in ((1, "unit_price"), (2, "num_in_stock")):
+            field = self.model._meta.get_field(name)
+            whens = [row for row in rows if row[i] is not None]
+            if whens:
+                assignments.append("%s = CASE sku %s ELSE %s END" % (
+                    qn(field.column), " ".join(["WHEN %s THEN %s"] *
+                    len(whens)), qn(field.column)))
+                for row in whens:
+                    params.extend([row[0], field.get_db_prep_save(row[i],
+                                   connection=connection)])
+        skus = [row[0] for row in rows]
+        if not assignments:
+            return []
+        sql = "UPDATE %s SET %s WHERE sku IN (%s)" % (
+            qn(self.model._meta.db_table), ", ".join(assignments),
+            ", ".join(["%s"] * len(skus)))
+        connection.cursor().execute(sql, params + skus)
+        transaction.commit_unless_managed()
+        variations = self.filter(sku__in=skus)
+        return list(set(variations.values_list("product", flat=True)))
+
+    def reduce_stock(self, quantities):
+        """
+        Reduce the number in stock for the given SKU and quantity
+        pairs with a single statement execution, leaving variations
+        that don't track stock unchanged. Return a dict of the IDs of
+        the products for the SKUs found, keyed by SKU.
+        """
+        if not quantities:
+            return {}
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        sql = ("UPDATE %s SET num_in_stock = num_in_stock - %%s "
+               "WHERE sku = %%s AND num_in_stock IS NOT NULL" % table)
+        connection.cursor().executemany(sql, [(quantity, sku)
+                                              for sku, quantity in quantities])
+        transaction.commit_unless_managed()
+        skus = [sku for sku, quantity in quantities]
+        variations = self.filter(sku__in=skus)
+        return dict(variations.values_list("sku", "product"))
+
     def manage_empty(self):
         """
         Create an empty variation (no options) if none exist, 
@@ -111,6 +354,160 @@ class ProductVariationManager(Manager):
             first_variation.save()
 
 
+class ProductUpsellManager(Manager):
+
+    def _insert(self, rows):
+        """
+        Insert the given SKU, product and upsell product rows in a
+        single statement execution.
+        """
+        if rows:
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            sql = ("INSERT INTO %s (sku, product_id, upsell_id) "
+                   "VALUES (%%s, %%s, %%s)" % table)
+            connection.cursor().executemany(sql, rows)
+            transaction.commit_unless_managed()
+
+    def _rows(self, product_ids=None):
+        """
+        Return the SKU, product and upsell product rows for every
+        product, or only for the upsell products linked to or from the
+        given product IDs.
+        """
+        from cartridge.shop.models import Product, ProductVariation
+        links = Product.upsell_products.through.objects.all()
+        if product_ids is not None:
+            links = links.filter(Q(from_product__in=product_ids) |
+                                 Q(to_product__in=product_ids))
+        upsells = defaultdict(list)
+        for product_id, upsell_id in links.values_list("from_product",
+                                                       "to_product"):
+            upsells[product_id].append(upsell_id)
+        if not upsells:
+            return []
+        variations = ProductVariation.objects.filter(
+            product__in=upsells.keys()).exclude(sku="")
+        return [(sku, product_id, upsell_id) for sku, product_id in
+                variations.values_list("sku", "product")
+                for upsell_id in upsells[product_id]]
+
+    def rebuild(self):
+        """
+        Recreate the index of upsell products for every SKU.
+        """
+        self.all().delete()
+        self._insert(self._rows())
+        self._bump()
+
+    def update_for(self, product_ids):
+        """
+        Update the index for the given product IDs, after their
+        variations or upsell products may have changed. Upsell
+        products are symmetrical, so the rows for the products they're
+        upsold on are also updated. Only the rows that differ are
+        deleted or inserted, and the version of the index is only
+        incremented if there are any, so that saving variations
+        without changing their SKUs, or of products without upsell
+        products, doesn't make every cart look up its upsell products
+        again.
+        """
+        product_ids = list(product_ids)
+        existing = self.filter(Q(product__in=product_ids) |
+                               Q(upsell__in=product_ids))
+        existing = dict([(row[1:], row[0]) for row in existing.values_list(
+            "id", "sku", "product", "upsell")])
+        rows = set(self._rows(product_ids))
+        stale = [id for row, id in existing.items() if row not in rows]
+        missing = [row for row in rows if row not in existing]
+        if stale:
+            self.filter(id__in=stale).delete()
+        self._insert(missing)
+        if stale or missing:
+            self._bump()
+
+    def _bump(self):
+        """
+        Increment the version of the index, so that carts look up
+        their upsell products again.
+        """
+        from cartridge.shop.models import IndexVersion
+        IndexVersion.objects.bump("upsells")
+
+    def for_skus(self, skus):
+        """
+        Return the sorted IDs of the upsell products for the given
+        SKUs.
+        """
+        upsells = self.filter(sku__in=skus).values_list("upsell", flat=True)
+        return sorted(set(upsells))
+
+
+class ProductRecommendationManager(Manager):
+
+    def replace(self, rows, chunk_size=1000):
+        """
+        Replace all recommendations with the given product,
+        recommended product and score rows, inserting them in chunks
+        with a single statement execution each.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        sql = ("INSERT INTO %s (product_id, recommended_id, score) "
+               "VALUES (%%s, %%s, %%s)" % table)
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s" % table)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                cursor.executemany(sql, chunk)
+                chunk = []
+        if chunk:
+            cursor.executemany(sql, chunk)
+        transaction.commit_unless_managed()
+        from cartridge.shop.models import IndexVersion
+        IndexVersion.objects.bump("recommendations")
+
+    def for_products(self, product_ids):
+        """
+        Return the IDs of the products recommended for the given
+        product IDs, highest scoring first, excluding the given
+        products themselves.
+        """
+        recommended = self.filter(product__in=product_ids)
+        recommended = recommended.exclude(recommended__in=product_ids)
+        ids = []
+        for id in recommended.order_by("-score").values_list("recommended",
+                                                            flat=True):
+            if id not in ids:
+                ids.append(id)
+        return ids
+
+
+class IndexVersionManager(Manager):
+
+    def bump(self, name):
+        """
+        Increment the version of the index with the given name,
+        creating it if it doesn't exist yet.
+        """
+        update = {"version": F("version") + 1}
+        if not self.filter(name=name).update(**update):
+            try:
+                sid = transaction.savepoint()
+                self.create(name=name, version=1)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by a concurrent build.
+                transaction.savepoint_rollback(sid)
+                self.filter(name=name).update(**update)
+
+    def versions(self):
+        """
+        Return the name and version of each index, sorted by name.
+        """
+        return list(self.order_by("name").values_list("name", "version"))
+
+
 class ProductActionManager(Manager):
     
     use_for_related_fields = True
@@ -138,6 +535,59 @@ class ProductActionManager(Manager):
         """
         self._action_for_field("total_purchase")
 
+    def _actions_for_products(self, field, product_ids):
+        """
+        Increases the given field as per ``_action_for_field`` once
+        for each occurrence of the given product IDs, creating the
+        missing actions and increasing the fields with a statement
+        execution each, rather than per product. Actions created by a
+        concurrent request between reading and inserting them are
+        skipped, as ``get_or_create`` does, and increased along with
+        the rest.
+        """
+        timestamp = datetime.today().toordinal()
+        counts = defaultdict(int)
+        for product_id in product_ids:
+            counts[product_id] += 1
+        if not counts:
+            return
+        existing = self.filter(timestamp=timestamp, product__in=counts.keys())
+        existing = set(existing.values_list("product", flat=True))
+        missing = [(product_id, timestamp, 0, 0) for product_id in counts
+                   if product_id not in existing]
+        table = self.model._meta.db_table
+        columns = ("product_id", "timestamp", "total_cart", "total_purchase")
+        try:
+            sid = transaction.savepoint()
+            bulk.insert_rows(table, columns, missing)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Some were created by a concurrent request, so insert
+            # each of them, skipping those that now exist.
+            transaction.savepoint_rollback(sid)
+            for row in missing:
+                try:
+                    sid = transaction.savepoint()
+                    bulk.insert_rows(table, columns, [row])
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+        column = connection.ops.quote_name(field)
+        sql = ("UPDATE %s SET %s = %s + %%s WHERE product_id = %%s "
+               "AND timestamp = %%s" % (connection.ops.quote_name(table),
+                                        column, column))
+        rows = [(count, product_id, timestamp)
+                for product_id, count in counts.items()]
+        connection.cursor().executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+    def purchased_products(self, product_ids):
+        """
+        Increase total_purchase for each of the given product IDs, as
+        for the products in an order.
+        """
+        self._actions_for_products("total_purchase", product_ids)
+
 
 class DiscountCodeManager(Manager):
 
@@ -157,7 +607,7 @@ class DiscountCodeManager(Manager):
         that the given cart contains items that the code is valid for.
         """
         total_price_valid = (Q(min_purchase__isnull=True) | 
-                             Q(min_purchase__lte=cart.total_price()))
+                             Q(min_purchase__lte=cart.total_price))
         discount = self.active().get(total_price_valid, code=code)
         products = discount.products.all()
         if products.count() > 0:
@@ -1,11 +1,76 @@
 
-from django.core.urlresolvers import reverse
+from threading import Lock
+
+from django.core.urlresolvers import NoReverseMatch, reverse
 from django.http import HttpResponseRedirect, HttpResponsePermanentRedirect
 
-from mezzanine.conf import settings
+from cartridge.shop import catalog
+from cartridge.shop.conf import settings
 
 
 class SSLRedirect(object):
+    """
+    Redirects requests to ``SHOP_FORCE_HOST`` and between HTTP and HTTPS.
+    The paths that are forced to run over SSL are resolved once for each
+    URLconf and value of ``SHOP_FORCE_SSL_VIEWS``, and the number of
+    redirects issued of each type are counted in ``redirects``.
+    """
+
+    redirects = {"host": 0, "https": 0, "http": 0}
+    _redirects_lock = Lock()
+
+    def __init__(self):
+        self._routes = {}
+
+    def _ssl_paths(self, urlconf):
+        """
+        Returns the set of paths and path prefixes forced to run over
+        SSL. Entries in ``SHOP_FORCE_SSL_VIEWS`` beginning with a slash
+        are used as path prefixes, and all others as view names.
+        """
+        views = tuple(settings.SHOP_FORCE_SSL_VIEWS)
+        key = (urlconf, views)
+        try:
+            return self._routes[key]
+        except KeyError:
+            pass
+        paths, prefixes = set(), set()
+        for view in views:
+            if view.startswith("/"):
+                prefixes.add(view)
+            else:
+                try:
+                    paths.add(reverse(view, urlconf=urlconf))
+                except NoReverseMatch:
+                    # The view isn't installed, eg the account view.
+                    pass
+        self._routes[key] = routes = (frozenset(paths), frozenset(prefixes))
+        return routes
+
+    def _is_ssl_path(self, request):
+        """
+        Checks the request path against the SSL paths, and each of its
+        parent paths against the SSL path prefixes.
+        """
+        urlconf = getattr(request, "urlconf", settings.ROOT_URLCONF)
+        paths, prefixes = self._ssl_paths(urlconf)
+        if request.path in paths:
+            return True
+        if prefixes:
+            parts = request.path.split("/")
+            for i in range(1, len(parts) + 1):
+                prefix = "/".join(parts[:i])
+                if prefix in prefixes or prefix + "/" in prefixes:
+                    return True
+        return False
+
+    def _redirect(self, kind, response):
+        self._redirects_lock.acquire()
+        try:
+            self.redirects[kind] += 1
+        finally:
+            self._redirects_lock.release()
+        return response
 
     def process_request(self, request):
         """
@@ -13,15 +78,35 @@ class SSLRedirect(object):
         if SHOP_SSL_ENABLED is True, ensure checkout views are accessed over 
         HTTPS and all other views are accessed over HTTP.
         """
-        settings.use_editable()
         force_host = settings.SHOP_FORCE_HOST
         if force_host and request.get_host().split(":")[0] != force_host:
             url = "http://%s%s" % (force_host, request.get_full_path())
-            return HttpResponsePermanentRedirect(url)            
+            return self._redirect("host", HttpResponsePermanentRedirect(url))
         if settings.SHOP_SSL_ENABLED and not settings.DEV_SERVER:
             url = "%s%s" % (request.get_host(), request.get_full_path())
-            if request.path in map(reverse, settings.SHOP_FORCE_SSL_VIEWS):
+            if self._is_ssl_path(request):
                 if not request.is_secure():
-                    return HttpResponseRedirect("https://%s" % url)
+                    response = HttpResponseRedirect("https://%s" % url)
+                    return self._redirect("https", response)
             elif request.is_secure():
-                return HttpResponseRedirect("http://%s" % url)
+                response = HttpResponseRedirect("http://%s" % url)
+                return self._redirect("http", response)
+
+
+class PageCache(object):
+    """
+    Serves the full page for product, category and search pages to
+    anonymous users from the catalog cache, when
+    ``SHOP_PAGE_CACHE_SECONDS`` is set, and adds the ``ETag`` and
+    ``Last-Modified`` headers for product and category pages. Should
+    come after the session, authentication, messages and CSRF
+    middleware.
+    """
+
+    def process_request(self, request):
+        return catalog.get_page(request)
+
+    def process_response(self, request, response):
+        catalog.set_page(request, response)
+        catalog.set_modified(request, response)
+        return response
@@ -1,20 +1,23 @@
 
 from datetime import datetime
 from decimal import Decimal
+from hashlib import md5
 from operator import iand, ior
 
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 from django.db.models import CharField, Q
 from django.db.models.base import ModelBase
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.signals import pre_delete, pre_save
 from django.utils.translation import ugettext_lazy as _
 
 from mezzanine.conf import settings
-from mezzanine.core.managers import DisplayableManager
+from mezzanine.conf.models import Setting
 from mezzanine.core.models import Displayable, RichText
 from mezzanine.generic.fields import RatingField
 from mezzanine.pages.models import Page
 
-from cartridge.shop import fields, managers
+from cartridge.shop import bulk, catalog, conf, fields, managers
 
 
 class Category(Page, RichText):
@@ -30,11 +33,29 @@ class Category(Page, RichText):
     combined = models.BooleanField(default=True, help_text="If checked, "
         "products must match all specified filters, otherwise products "
         "can match any specified filter.")
+    include_descendants = models.BooleanField(_("Include subcategories"),
+        default=False, help_text="If checked, products selected for any "
+        "subcategories are also shown in this category.")
+    date_modified = models.DateTimeField(_("Date modified"), auto_now=True,
+                                         null=True, editable=False)
 
     class Meta:
         verbose_name = _("Product category")
         verbose_name_plural = _("Product categories")
 
+    def save(self, *args, **kwargs):
+        """
+        Update the category's ancestry when it's first created or moved
+        to a different parent.
+        """
+        moved = self.id is None
+        if not moved:
+            lookup = {"id": self.id, "parent": self.parent_id}
+            moved = not Category.objects.filter(**lookup).exists()
+        super(Category, self).save(*args, **kwargs)
+        if moved:
+            CategoryAncestry.objects.update_for(self)
+
     def filters(self):
         """
         Returns product filters as a Q object for the category.
@@ -67,9 +88,16 @@ class Category(Page, RichText):
                 sale = Q(sale_price__lte=self.price_max) & valid_sale_date
                 prices.append(Q(unit_price__lte=self.price_max) | sale)
             filters.append(reduce(iand, prices))
-        # Turn the variation filters into a product filter.
+        # Turn the variation filters into a product filter, using the
+        # products selected for all subcategories as well if required,
+        # which are joined directly via the category ancestry.
         operator = iand if self.combined else ior
-        products = Q(id__in=self.products.only("id"))
+        if self.include_descendants:
+            lookup = {"categories__ancestor_links__ancestor": self}
+            selected = Product.objects.filter(**lookup)
+        else:
+            selected = self.products.all()
+        products = Q(id__in=selected.only("id"))
         if filters:
             filters = reduce(operator, filters)
             variations = ProductVariation.objects.filter(filters)
@@ -78,12 +106,31 @@ class Category(Page, RichText):
             # selected is neccessary as combining the variations
             # with an empty ID list lookup and ``AND`` will always
             # result in an empty result.
-            if self.products.count() > 0:
+            if selected.count() > 0:
                 filters.append(products)
             return reduce(operator, filters)
         return products
 
 
+class CategoryAncestry(models.Model):
+    """
+    Closure table storing every ancestor of each category along with
+    the number of levels between them, including a row for each
+    category as its own ancestor at depth zero. Allows all products in
+    a category's subtree to be queried with a single join regardless
+    of the depth of the tree.
+    """
+
+    ancestor = models.ForeignKey("Category", related_name="descendant_links")
+    descendant = models.ForeignKey("Category", related_name="ancestor_links")
+    depth = models.IntegerField()
+
+    objects = managers.CategoryAncestryManager()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
 class Priced(models.Model):
     """
     Abstract model with unit and sale price fields. Inherited by
@@ -139,17 +186,19 @@ class Product(Displayable, Priced, RichText):
                                         related_name="products")
     date_added = models.DateTimeField(_("Date added"), auto_now_add=True,
                                       null=True)
+    date_modified = models.DateTimeField(_("Date modified"), auto_now=True,
+                                         null=True, editable=False)
     related_products = models.ManyToManyField("self", blank=True)
     upsell_products = models.ManyToManyField("self", blank=True)
     rating = RatingField(verbose_name=_("Rating"))
 
-    objects = DisplayableManager()
+    objects = managers.ProductManager()
 
     class Meta:
         verbose_name = _("Product")
         verbose_name_plural = _("Products")
 
-    @models.permalink
+    @models.permalink
     def get_absolute_url(self):
         return ("shop_product", (), {"slug": self.slug})
 
@@ -175,6 +224,43 @@ class Product(Displayable, Priced, RichText):
     admin_thumb.short_description = ""
 
 
+class ListingProduct(object):
+    """
+    Lightweight, read-only stand-in for a ``Product`` returned by
+    ``Product.objects.listing()``, holding only the fields needed to
+    render a product in a list of products, along with the price and
+    URL methods used by the listing templates.
+    """
+
+    __slots__ = ("id", "title", "slug", "image", "unit_price", "sale_id",
+                 "sale_price", "sale_from", "sale_to", "date_added",
+                 "rating_average")
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            setattr(self, name, row[name])
+
+    def __unicode__(self):
+        return self.title
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ("shop_product", (), {"slug": self.slug})
+
+    # Share the pricing methods of the model, which only depend on the
+    # price fields above.
+    on_sale = Priced.__dict__["on_sale"]
+    has_price = Priced.__dict__["has_price"]
+    price = Priced.__dict__["price"]
+
+
 class ProductImage(models.Model):
     """
     An image for a product - a relationship is also defined with the
@@ -244,6 +330,7 @@ class ProductVariation(Priced):
                                        null=True)
     default = models.BooleanField(_("Default"))
     image = models.ForeignKey("ProductImage", null=True, blank=True)
+    import_hash = CharField(max_length=32, blank=True, editable=False)
 
     objects = managers.ProductVariationManager()
 
@@ -321,6 +408,54 @@ class ProductVariation(Priced):
         return self._cached_num_in_stock >= quantity
 
 
+class ProductUpsell(models.Model):
+    """
+    Index of the upsell products for each SKU, so that the upsell
+    products for the items in a cart can be found from their SKUs
+    without joining through the variations and upsell products of
+    each product. Updated when variations or upsell products change.
+    """
+
+    sku = fields.SKUField(db_index=True)
+    product = models.ForeignKey("Product", related_name="upsell_index")
+    upsell = models.ForeignKey("Product", related_name="upsell_index_for")
+
+    objects = managers.ProductUpsellManager()
+
+
+class ProductRecommendation(models.Model):
+    """
+    A product bought along with another product, scored by how often
+    they're bought together. Built from past orders by the
+    ``build_recommendations`` command, and used when a product has no
+    related or upsell products selected.
+    """
+
+    product = models.ForeignKey("Product", related_name="recommendations")
+    recommended = models.ForeignKey("Product",
+                                    related_name="recommended_for")
+    score = models.FloatField()
+
+    objects = managers.ProductRecommendationManager()
+
+    class Meta:
+        unique_together = ("product", "recommended")
+
+
+class IndexVersion(models.Model):
+    """
+    A version number for each of the upsell and recommendation
+    indexes, incremented whenever the index changes. Carts store the
+    upsell products for their items against these, so that they're
+    looked up again once either index changes.
+    """
+
+    name = CharField(max_length=20, unique=True)
+    version = models.IntegerField(default=0)
+
+    objects = managers.IndexVersionManager()
+
+
 class Order(models.Model):
 
     billing_detail_first_name = CharField(_("First name"), max_length=100)
@@ -387,16 +522,18 @@ class Order(models.Model):
             if field in request.session:
                 setattr(self, field, request.session[field])
         self.cart = Cart.objects.from_request(request)
-        self.total = self.item_total = self.cart.total_price()
+        self.total = self.item_total = self.cart.total_price
         if self.shipping_total is not None:
             self.total += self.shipping_total
         if self.discount_total is not None:
             self.total -= self.discount_total
         self.save() # We need an ID before we can add related items.
+        product_fields = [f.name for f in SelectedProduct._meta.fields]
+        items = []
         for item in self.cart:
-            product_fields = [f.name for f in SelectedProduct._meta.fields]
             item = dict([(f, getattr(item, f)) for f in product_fields])
-            self.items.create(**item)
+            items.append(OrderItem(order=self, **item))
+        bulk.insert(OrderItem, items)
 
     def complete(self, request):
         """
@@ -408,16 +545,18 @@ class Order(models.Model):
             if field in request.session:
                 del request.session[field]
         del request.session["order"]
-        for item in self.cart:
-            try:
-                variation = ProductVariation.objects.get(sku=item.sku)
-            except ProductVariation.DoesNotExist:
-                pass
-            else:
-                if variation.num_in_stock is not None:
-                    variation.num_in_stock -= item.quantity
-                    variation.save()
-                variation.product.actions.purchased()
+        quantities = [(item.sku, item.quantity) for item in self.cart]
+        product_ids = ProductVariation.objects.reduce_stock(quantities)
+        purchased = [product_ids[sku] for sku, quantity in quantities
+                     if sku in product_ids]
+        ProductAction.objects.purchased_products(purchased)
+        # Stock is reduced without saving each variation, so no signals
+        # are sent, and the catalog cache is invalidated here instead.
+        product_ids = set(purchased)
+        if product_ids:
+            catalog.touch(products=product_ids)
+            catalog.bump(catalog.SITE, *[catalog.product_scope(id)
+                                         for id in product_ids])
         self.cart.delete()
 
 
@@ -425,6 +564,10 @@ class Cart(models.Model):
 
     last_updated = models.DateTimeField(_("Last updated"), auto_now=True,
                                         null=True)
+    item_count = models.IntegerField(_("Item count"), default=0)
+    total_price = fields.MoneyField(_("Total price"), default=Decimal("0"))
+    upsell_key = CharField(max_length=32, blank=True, editable=False)
+    upsell_ids = models.TextField(blank=True, editable=False)
 
     objects = managers.CartManager()
 
@@ -437,59 +580,179 @@ class Cart(models.Model):
             self._cached_items = self.items.all()
         return iter(self._cached_items)
 
+    def _update_totals(self, quantity, total_price):
+        """
+        Atomically adjusts the stored item count and total price by
+        the given amounts.
+        """
+        Cart.objects.filter(id=self.id).update(
+            item_count=models.F("item_count") + quantity,
+            total_price=models.F("total_price") + total_price)
+        self.item_count += quantity
+        self.total_price += total_price
+        if hasattr(self, "_cached_items"):
+            del self._cached_items
+
+    def _add_item(self, variation, quantity):
+        """
+        Increase quantity of existing item if SKU and price match,
+        otherwise create new. The quantity is increased in the database
+        rather than read and saved, and the unique constraint for the
+        cart, SKU and price prevents duplicate items being created by
+        concurrent requests. Callers should select the variation's
+        product and image along with it, as these are used for the
+        item's description, URL and image when it's created.
+        """
+        unit_price = variation.price()
+        total_price = unit_price * quantity
+        items = self.items.filter(sku=variation.sku, unit_price=unit_price)
+        update = {"quantity": models.F("quantity") + quantity,
+                  "total_price": models.F("total_price") + total_price}
+        if not items.update(**update):
+            item = CartItem(cart=self, sku=variation.sku,
+                            unit_price=unit_price, quantity=quantity,
+                            description=unicode(variation),
+                            url=variation.product.get_absolute_url())
+            if variation.image_id is not None:
+                item.image = unicode(variation.image.file)
+            try:
+                sid = transaction.savepoint()
+                item.save(force_insert=True)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by a concurrent request.
+                transaction.savepoint_rollback(sid)
+                items.update(**update)
+            else:
+                variation.product.actions.added_to_cart()
+        return total_price
+
     def add_item(self, variation, quantity):
         """
-        Increase quantity of existing item if SKU matches, otherwise create
-        new.
-        """
-        item, created = self.items.get_or_create(sku=variation.sku,
-                                                 unit_price=variation.price())
-        if created:
-            item.description = unicode(variation)
-            item.unit_price = variation.price()
-            item.url = variation.product.get_absolute_url()
-            image = variation.image
-            if image is not None:
-                item.image = unicode(image.file)
-            variation.product.actions.added_to_cart()
-        item.quantity += quantity
+        Add the given quantity of the variation and update the totals.
+        """
+        self._update_totals(quantity, self._add_item(variation, quantity))
+
+    @transaction.commit_on_success
+    def add_items(self, lines):
+        """
+        Add each of the given variation and quantity pairs in a single
+        transaction, updating the totals once for all of them.
+        """
+        total_quantity = 0
+        total_price = Decimal("0")
+        for variation, quantity in lines:
+            total_price += self._add_item(variation, quantity)
+            total_quantity += quantity
+        if total_quantity:
+            self._update_totals(total_quantity, total_price)
+
+    def update_quantity(self, item_id, quantity):
+        """
+        Change the quantity of an item, removing it if the quantity is
+        zero or less.
+        """
+        if quantity <= 0:
+            self.remove_item(item_id)
+            return
+        try:
+            item = self.items.get(id=item_id)
+        except CartItem.DoesNotExist:
+            return
+        change = quantity - item.quantity
+        item.quantity = quantity
         item.save()
+        self._update_totals(change, item.unit_price * change)
+
+    @transaction.commit_on_success
+    def update_quantities(self, quantities):
+        """
+        Change the quantities of items given as a dict of item IDs to
+        quantities, removing those with a quantity of zero or less.
+        The quantities are changed in a single statement execution,
+        and the totals are then recalculated once for all items.
+        """
+        removed = [id for id, quantity in quantities.items() if quantity <= 0]
+        changed = [(quantity, quantity, id, self.id)
+                   for id, quantity in quantities.items() if quantity > 0]
+        if removed:
+            self.items.filter(id__in=removed).delete()
+        if changed:
+            table = connection.ops.quote_name(CartItem._meta.db_table)
+            sql = ("UPDATE %s SET quantity = %%s, total_price = unit_price * "
+                   "%%s WHERE id = %%s AND cart_id = %%s" % table)
+            connection.cursor().executemany(sql, changed)
+        totals = self.items.aggregate(item_count=models.Sum("quantity"),
+                                      total_price=models.Sum("total_price"))
+        self.item_count = totals["item_count"] or 0
+        self.total_price = totals["total_price"] or Decimal("0")
+        Cart.objects.filter(id=self.id).update(item_count=self.item_count,
+                                               total_price=self.total_price)
+        if hasattr(self, "_cached_items"):
+            del self._cached_items
 
     def remove_item(self, item_id):
         """
         Remove item by SKU.
         """
         try:
-            self.items.get(id=item_id).delete()
+            item = self.items.get(id=item_id)
         except CartItem.DoesNotExist:
             pass
+        else:
+            item.delete()
+            self._update_totals(-item.quantity, -item.total_price)
 
     def has_items(self):
         """
         Template helper function - does the cart have items?
         """
-        return len(list(self)) > 0
+        return self.item_count > 0
 
     def total_quantity(self):
         """
         Template helper function - sum of all item quantities.
         """
-        return sum([item.quantity for item in self])
-
-    def total_price(self):
-        """
-        Template helper function - sum of all costs of item quantities.
-        """
-        return sum([item.total_price for item in self])
+        return self.item_count
 
     def upsell_products(self):
         """
-        Returns the upsell products for each of the items in the cart.
+        Returns the upsell products for each of the items in the cart,
+        or if none are selected, the products recommended for them.
+        The IDs of the upsell products are looked up from the upsell
+        index and stored on the cart against the SKUs of its items and
+        the versions of the upsell and recommendation indexes, so the
+        products themselves are loaded by ID until any of those change.
         """
-        skus = [item.sku for item in self]
-        cart = Product.objects.filter(variations__sku__in=skus)
-        upsell = Product.objects.published().filter(upsell_products__in=cart)
-        return list(upsell.distinct())
+        skus = sorted(set([item.sku for item in self]))
+        if not skus:
+            return []
+        versions = IndexVersion.objects.versions()
+        key = u"|".join(skus + [u"%s:%s" % v for v in versions])
+        key = md5(key.encode("utf-8")).hexdigest()
+        if key == self.upsell_key:
+            ids = [int(id) for id in self.upsell_ids.split(",") if id]
+        else:
+            ids = ProductUpsell.objects.for_skus(skus)
+            if not ids:
+                variations = ProductVariation.objects.filter(sku__in=skus)
+                product_ids = list(variations.values_list("product",
+                                                          flat=True))
+                ids = ProductRecommendation.objects.for_products(product_ids)
+                ids = ids[:settings.SHOP_RECOMMENDATIONS_MAX]
+            self.upsell_key = key
+            self.upsell_ids = ",".join([str(id) for id in ids])
+            Cart.objects.filter(id=self.id).update(upsell_key=self.upsell_key,
+                                                   upsell_ids=self.upsell_ids)
+        if not ids:
+            return []
+
+        def upsell_products():
+            published = Product.objects.published().filter(id__in=ids)
+            return sorted(published, key=lambda p: ids.index(p.id))
+
+        name = "upsell-%s" % self.upsell_ids
+        return catalog.get_or_set(name, [catalog.SITE], upsell_products)
 
 
 class SelectedProduct(models.Model):
@@ -520,6 +783,9 @@ class CartItem(SelectedProduct):
     url = CharField(max_length=200)
     image = CharField(max_length=200, null=True)
 
+    class Meta:
+        unique_together = ("cart", "sku", "unit_price")
+
     def get_absolute_url(self):
         return self.url
 
@@ -638,6 +904,10 @@ class Sale(Discount):
                     priced_objects.filter(**extra_filter).update(**update)
                 except Warning:
                     pass
+            catalog.touch(products=products.values_list("id", flat=True))
+        # Bulk updates don't send signals, so invalidate the catalog
+        # cache once the prices are applied.
+        catalog.bump(catalog.SITE)
 
     def delete(self, *args, **kwargs):
         """
@@ -653,8 +923,12 @@ class Sale(Discount):
         """
         update = {"sale_id": None, "sale_price": None,
                   "sale_from": None, "sale_to": None}
+        products = Product.objects.filter(sale_id=self.id)
+        product_ids = list(products.values_list("id", flat=True))
         for priced_model in (Product, ProductVariation):
             priced_model.objects.filter(sale_id=self.id).update(**update)
+        catalog.touch(products=product_ids)
+        catalog.bump(catalog.SITE)
 
 
 class DiscountCode(Discount):
@@ -681,3 +955,83 @@ class DiscountCode(Discount):
         elif self.discount_percent is not None:
             return amount / Decimal("100") * self.discount_percent
         return 0
+
+
+def page_moving(sender, instance, **kwargs):
+    """
+    Signal handler for saving pages directly rather than via their
+    subclass, as the admin's page tree does when a page is dragged to
+    a different parent, which doesn't call ``Category.save``. If the
+    page is moved, the categories below it are noted for
+    ``page_moved``, and updated along with their current ancestors,
+    which no longer include their products.
+    """
+    if instance.id is not None:
+        lookup = {"id": instance.id, "parent": instance.parent_id}
+        if not Page.objects.filter(**lookup).exists():
+            instance._moved_categories = \
+                CategoryAncestry.objects.subtree(instance.id)
+            catalog.touch(categories=instance._moved_categories)
+
+
+def page_moved(sender, instance, **kwargs):
+    """
+    Signal handler for pages saved after ``page_moving`` - updates the
+    ancestry of the categories below a moved page, and their new
+    ancestors.
+    """
+    category_ids = getattr(instance, "_moved_categories", None)
+    if category_ids:
+        del instance._moved_categories
+        if instance.id in category_ids:
+            CategoryAncestry.objects.update_for(instance)
+        else:
+            CategoryAncestry.objects.rebuild()
+        scopes = [catalog.category_scope(id) for id in category_ids]
+        catalog.bump(catalog.SITE, *scopes)
+        catalog.touch(categories=category_ids)
+
+
+def variation_changed(sender, instance, **kwargs):
+    """
+    Signal handler for saving or deleting variations - updates the
+    upsell index for the variation's product, as its SKUs may have
+    changed.
+    """
+    ProductUpsell.objects.update_for([instance.product_id])
+
+
+def upsells_changed(sender, instance, action, pk_set, **kwargs):
+    """
+    Signal handler for changes to a product's upsell products -
+    updates the upsell index for the products changed.
+    """
+    if action.startswith("post_"):
+        ProductUpsell.objects.update_for([instance.id] + list(pk_set or []))
+
+
+# Invalidate the catalog cache and update modified times when any
+# catalog models change.
+for model in (Product, ProductVariation, ProductImage, Category, Sale,
+              ProductOption):
+    post_save.connect(catalog.catalog_changed, sender=model)
+    post_delete.connect(catalog.catalog_changed, sender=model)
+for model in (Product, Category):
+    pre_delete.connect(catalog.catalog_deleting, sender=model)
+for relation in (Product.categories, Product.related_products,
+                 Product.upsell_products, Category.options):
+    m2m_changed.connect(catalog.catalog_relations_changed,
+                        sender=relation.through)
+
+# Keep the category ancestry up to date with pages moved in the tree.
+pre_save.connect(page_moving, sender=Page)
+post_save.connect(page_moved, sender=Page)
+
+# Keep the upsell index up to date with variations and upsell products.
+post_save.connect(variation_changed, sender=ProductVariation)
+post_delete.connect(variation_changed, sender=ProductVariation)
+m2m_changed.connect(upsells_changed, sender=Product.upsell_products.through)
+
+# Reload the shop's editable settings when they're changed.
+post_save.connect(conf.settings_changed, sender=Setting)
+post_delete.connect(conf.settings_changed, sender=Setting)
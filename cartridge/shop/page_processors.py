@@ -1,7 +1,8 @@
 
 from mezzanine.pages.page_processors import processor_for
-from mezzanine.conf import settings
 
+from cartridge.shop import catalog
+from cartridge.shop.conf import settings
 from cartridge.shop.models import Category, Product
 from cartridge.shop.views import product_list
 
@@ -11,9 +12,20 @@ def category_processor(request, page):
     """
     Add paging/sorting to the products for the category.
     """
-    settings.use_editable()
+    modified = lambda: catalog.category_modified(page.category)
+    response = catalog.not_modified(request, modified)
+    if response is not None:
+        return response
     per_page = settings.SHOP_PER_PAGE_CATEGORY
-    published_products = Product.objects.published(for_user=request.user)
-    filters = page.category.filters()
-    products = published_products.filter(filters).distinct()
-    return {"products": product_list(products, request, per_page)}
+
+    def products():
+        published = Product.objects.published(for_user=request.user)
+        filters = page.category.filters()
+        products = published.filter(filters).distinct().listing()
+        return catalog.freeze_page(product_list(products, request, per_page))
+
+    name = "category-products-%s-%s" % (per_page, request.GET.urlencode())
+    scopes = [catalog.SITE, catalog.category_scope(page.id)]
+    catalog.cache_page(request)
+    return {"products": catalog.get_or_set(name, scopes, products,
+                                           for_user=request.user)}
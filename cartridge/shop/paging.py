@@ -0,0 +1,226 @@
+"""
+Keyset (cursor) based paging for product listings. Rather than
+counting and offsetting through the full result set like Django's
+``Paginator``, each page is fetched by filtering on the sort column
+and ID of the last row seen, so a deep page costs the same as the
+first one.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import md5
+from math import ceil
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import simplejson
+
+from mezzanine.conf import settings
+
+from cartridge.shop.utils import sign
+
+
+CURSOR_NEXT = "n"
+CURSOR_PREVIOUS = "p"
+
+
+def encode_cursor(direction, value, id):
+    """
+    Returns an opaque, signed token for the given direction and the
+    sort value and ID of the row to page from.
+    """
+    if isinstance(value, float):
+        # ``unicode`` rounds floats to 12 significant digits, which
+        # would skip rows sharing a sort value that isn't exactly
+        # representable, such as an average rating.
+        value = repr(value)
+    elif value is not None:
+        value = unicode(value)
+    data = simplejson.dumps([direction, value, id])
+    return "%s.%s" % (urlsafe_b64encode(data), sign(data)[:16])
+
+
+def decode_cursor(token):
+    """
+    Returns the direction, sort value and ID for the given token, or
+    ``None`` if the token is missing, malformed or has been tampered
+    with.
+    """
+    try:
+        data, signature = str(token).rsplit(".", 1)
+        data = urlsafe_b64decode(data)
+        if sign(data)[:16] != signature:
+            return None
+        direction, value, id = simplejson.loads(data)
+    except (TypeError, ValueError):
+        return None
+    if direction not in (CURSOR_NEXT, CURSOR_PREVIOUS):
+        return None
+    return direction, value, int(id)
+
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset ordered by a single sort field plus ID.
+    Rows with a ``NULL`` sort value are always ordered last, by ID,
+    regardless of how the database orders ``NULL``, so that paging
+    is consistent across backends.
+    """
+
+    def __init__(self, object_list, per_page, sort):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.descending = sort.startswith("-")
+        self.field = sort.lstrip("-")
+        self._count = None
+
+    def _ordered(self, queryset, reverse=False):
+        """
+        Order the queryset by the sort field then ID, in the sort
+        direction, or the opposite direction if ``reverse`` is given.
+        """
+        prefix = "-" if self.descending != reverse else ""
+        return queryset.order_by(prefix + self.field, prefix + "id")
+
+    def _after(self, value, id, reverse=False):
+        """
+        Q object matching rows that follow the given sort value and ID
+        in the sort direction, or precede them if ``reverse`` is given.
+        """
+        lookup = "lt" if self.descending != reverse else "gt"
+        if value is None:
+            return Q(**{"%s__isnull" % self.field: True,
+                        "id__%s" % lookup: id})
+        return (Q(**{"%s__%s" % (self.field, lookup): value}) |
+                Q(**{self.field: value, "id__%s" % lookup: id}))
+
+    def _forwards(self, value, id, limit):
+        """
+        Rows after the given position, non-null sort values first then
+        null sort values.
+        """
+        isnull = "%s__isnull" % self.field
+        rows = []
+        if value is not None or id is None:
+            valued = self.object_list.filter(**{isnull: False})
+            if id is not None:
+                valued = valued.filter(self._after(value, id))
+            rows.extend(self._ordered(valued)[:limit])
+        if len(rows) < limit:
+            nulls = self.object_list.filter(**{isnull: True})
+            if value is None and id is not None:
+                nulls = nulls.filter(self._after(None, id))
+            nulls = nulls.order_by("-id" if self.descending else "id")
+            rows.extend(nulls[:limit - len(rows)])
+        return rows
+
+    def _backwards(self, value, id, limit):
+        """
+        Rows before the given position, returned nearest first.
+        """
+        isnull = "%s__isnull" % self.field
+        rows = []
+        if value is None:
+            nulls = self.object_list.filter(**{isnull: True})
+            nulls = nulls.filter(self._after(None, id, reverse=True))
+            nulls = nulls.order_by("id" if self.descending else "-id")
+            rows.extend(nulls[:limit])
+        if len(rows) < limit:
+            valued = self.object_list.filter(**{isnull: False})
+            if value is not None:
+                valued = valued.filter(self._after(value, id, reverse=True))
+            valued = self._ordered(valued, reverse=True)
+            rows.extend(valued[:limit - len(rows)])
+        return rows
+
+    def _get_count(self):
+        """
+        Total number of rows, cached for ``SHOP_PAGING_COUNT_CACHE_SECONDS``
+        against the SQL of the underlying query so that it's an
+        approximation rather than an exact count on every request.
+        """
+        if self._count is None:
+            sql = unicode(self.object_list.query).encode("utf-8")
+            key = "shop-paging-count-%s" % md5(sql).hexdigest()
+            self._count = cache.get(key)
+            if self._count is None:
+                self._count = self.object_list.count()
+                timeout = settings.SHOP_PAGING_COUNT_CACHE_SECONDS
+                cache.set(key, self._count, timeout)
+        return self._count
+    count = property(_get_count)
+
+    def _get_num_pages(self):
+        return max(1, int(ceil(self.count / float(self.per_page))))
+    num_pages = property(_get_num_pages)
+
+    def page(self, cursor=None):
+        """
+        Returns the ``KeysetPage`` for the given cursor token, or the
+        first page if no valid cursor is given.
+        """
+        position = decode_cursor(cursor) if cursor else None
+        limit = self.per_page + 1
+        if position is None:
+            rows = self._forwards(None, None, limit)
+            has_next, has_previous = len(rows) > self.per_page, False
+            rows = rows[:self.per_page]
+        else:
+            direction, value, id = position
+            if value is not None:
+                field = self.object_list.model._meta.get_field(self.field)
+                try:
+                    value = field.to_python(value)
+                except ValidationError:
+                    # Cursor from a different sort option.
+                    return self.page()
+            if direction == CURSOR_NEXT:
+                rows = self._forwards(value, id, limit)
+                has_next, has_previous = len(rows) > self.per_page, True
+                rows = rows[:self.per_page]
+            else:
+                rows = self._backwards(value, id, limit)
+                has_next, has_previous = True, len(rows) > self.per_page
+                rows = rows[:self.per_page]
+                rows.reverse()
+        return KeysetPage(rows, self, has_next, has_previous)
+
+
+class KeysetPage(object):
+    """
+    A page of rows from ``KeysetPaginator``. Provides the same
+    ``has_next``/``has_previous`` interface as Django's ``Page`` with
+    cursor tokens in place of page numbers.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next and len(object_list) > 0
+        self._has_previous = has_previous and len(object_list) > 0
+
+    def __repr__(self):
+        return "<KeysetPage of %s>" % len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def _cursor(self, direction, row):
+        return encode_cursor(direction, getattr(row, self.paginator.field),
+                             row.id)
+
+    def next_cursor(self):
+        if self.has_next():
+            return self._cursor(CURSOR_NEXT, self.object_list[-1])
+
+    def previous_cursor(self):
+        if self.has_previous():
+            return self._cursor(CURSOR_PREVIOUS, self.object_list[0])
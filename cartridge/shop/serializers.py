@@ -0,0 +1,496 @@
+"""
+Serializers for exporting and importing the whole catalog, which unlike
+the flat csv layout of ``product_db`` keep every category a product is
+in, each with its full path of parent categories, and all of its images
+and variations. Products are dumped as dicts a chunk at a time, and
+written by a serializer class registered in ``SHOP_CATALOG_SERIALIZERS``
+with a ``write`` method taking the chunks and a file name, and a
+``read`` method taking the file name and chunk size and yielding chunks
+of the same dicts, which ``load_products`` writes back to the database.
+"""
+
+import gzip
+import zipfile
+from cStringIO import StringIO
+from datetime import datetime
+from decimal import Decimal
+
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+from cartridge.shop import bulk, catalog
+from cartridge.shop.models import Category, Product, ProductImage
+from cartridge.shop.models import ProductOption, ProductUpsell
+from cartridge.shop.models import ProductVariation
+
+try:
+    import numpy
+except ImportError:
+    HAS_NUMPY = False
+else:
+    HAS_NUMPY = True
+
+
+PRODUCT_FIELDS = ("title", "slug", "content", "description", "status",
+                  "publish_date", "expiry_date", "available", "unit_price",
+                  "sale_price", "sale_from", "sale_to", "image")
+IMAGE_FIELDS = ("file", "description")
+VARIATION_FIELDS = ("sku", "default", "num_in_stock", "unit_price",
+                    "sale_price", "sale_from", "sale_to")
+VARIATION_FIELDS += tuple([f.name for f in ProductVariation.option_fields()])
+
+
+def get_serializer(name):
+    """
+    Returns an instance of the serializer class registered with the
+    given name in ``SHOP_CATALOG_SERIALIZERS``.
+    """
+    serializers = dict(settings.SHOP_CATALOG_SERIALIZERS)
+    return import_dotted_path(serializers[name])()
+
+
+def _value(value):
+    """
+    Converts decimals and dates to strings so that all values can be
+    serialized as JSON. Each is converted back by the ``to_python``
+    method of its field when loaded.
+    """
+    if isinstance(value, Decimal):
+        return unicode(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _open(file_name, mode):
+    """
+    Opens the file, gzipped if its name ends with ``.gz``.
+    """
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, mode)
+    return open(file_name, mode)
+
+
+def dump_products(chunk_size=1000):
+    """
+    Yields lists of dicts for ``chunk_size`` products at a time, with
+    the product fields, and lists of their category paths, images and
+    variations, each loaded for the whole chunk with a single query.
+    """
+    parents = dict([(c[0], c[1:]) for c in
+                    Category.objects.values_list("id", "title", "parent")])
+    paths = {}
+    for category_id in parents:
+        path = []
+        parent_id = category_id
+        while parent_id in parents:
+            title, parent_id = parents[parent_id]
+            path.insert(0, title)
+        paths[category_id] = path
+    last_id = 0
+    while True:
+        products = Product.objects.filter(id__gt=last_id).order_by("id")
+        products = list(products.values("id", *PRODUCT_FIELDS)[:chunk_size])
+        if not products:
+            break
+        last_id = products[-1]["id"]
+        records = SortedDict()
+        for product in products:
+            record = dict([(name, _value(product[name]))
+                           for name in PRODUCT_FIELDS])
+            record.update({"categories": [], "images": [], "variations": []})
+            records[product["id"]] = record
+        links = Product.categories.through.objects.filter(
+            product__in=records.keys()).order_by("id")
+        for product_id, category_id in links.values_list("product",
+                                                         "category"):
+            records[product_id]["categories"].append(paths[category_id])
+        images = ProductImage.objects.filter(product__in=records.keys())
+        for image in images.order_by("id").values("product", *IMAGE_FIELDS):
+            records[image["product"]]["images"].append(
+                dict([(name, image[name]) for name in IMAGE_FIELDS]))
+        variations = ProductVariation.objects.filter(
+            product__in=records.keys()).order_by("id")
+        for variation in variations.values("product", "image__file",
+                                           *VARIATION_FIELDS):
+            record = dict([(name, _value(variation[name]))
+                           for name in VARIATION_FIELDS])
+            record["image"] = variation["image__file"]
+            records[variation["product"]]["variations"].append(record)
+        yield records.values()
+
+
+class ProductLoader(object):
+    """
+    Writes dicts of products from ``dump_products`` to the database a
+    chunk at a time. Products are matched by slug and variations by
+    SKU, and are updated if they exist or inserted if they don't. The
+    categories of each product are replaced, and its images and
+    variations not in the dict are removed, so that loading a dump
+    into an existing catalog leaves the same products as the dump.
+    """
+
+    def __init__(self):
+        self.site = Site.objects.get_current()
+        self.categories = {}
+        categories = Category.objects.order_by("id")
+        for id, title, parent_id in categories.values_list("id", "title",
+                                                           "parent"):
+            self.categories.setdefault((parent_id, title), id)
+        self.options = set(ProductOption.objects.values_list("type", "name"))
+
+    def _category(self, path):
+        """
+        Returns the ID of the category at the end of the given path of
+        titles, creating the categories in the path that don't exist.
+        """
+        parent_id = None
+        for title in path:
+            key = (parent_id, title)
+            if key not in self.categories:
+                category = Category.objects.create(title=title,
+                                                   parent_id=parent_id)
+                self.categories[key] = category.id
+            parent_id = self.categories[key]
+        return parent_id
+
+    def _set_fields(self, instance, record, names):
+        """
+        Sets the given field names on the instance from the record,
+        converting each value with the ``to_python`` method of its
+        field.
+        """
+        for name in names:
+            field = instance._meta.get_field(name)
+            setattr(instance, field.attname, field.to_python(record[name]))
+
+    def load(self, records):
+        """
+        Writes the given list of product dicts.
+        """
+        slugs = [record["slug"] for record in records]
+        ids = dict(Product.objects.filter(slug__in=slugs).values_list("slug",
+                                                                      "id"))
+        new_products = []
+        updated_products = []
+        for record in records:
+            product = Product(site=self.site, id=ids.get(record["slug"]))
+            self._set_fields(product, record, PRODUCT_FIELDS)
+            if product.id is None:
+                new_products.append(product)
+            else:
+                updated_products.append(product)
+        bulk.insert(Product, new_products)
+        new_slugs = [product.slug for product in new_products]
+        ids.update(Product.objects.filter(slug__in=new_slugs).values_list(
+            "slug", "id"))
+        bulk.update(Product, PRODUCT_FIELDS + ("date_modified",),
+                    updated_products)
+        product_ids = [ids[slug] for slug in slugs]
+
+        # Categories - replace the categories of every product.
+        through = Product.categories.through
+        through.objects.filter(product__in=product_ids).delete()
+        links = []
+        for record in records:
+            for path in record["categories"]:
+                link = (ids[record["slug"]], self._category(path))
+                if link not in links:
+                    links.append(link)
+        bulk.insert_rows(through._meta.db_table, ["product_id",
+                         "category_id"], links)
+
+        # Images - remove those not in the records, clearing them from
+        # variations first so the variations aren't deleted with them,
+        # then insert any that don't exist yet.
+        images = ProductImage.objects.filter(product__in=product_ids)
+        images = images.values_list("product", "file", "id")
+        image_ids = dict([((image[0], image[1]), image[2])
+                          for image in images])
+        keys = set([(ids[record["slug"]], image["file"])
+                    for record in records for image in record["images"]])
+        stale = [id for key, id in image_ids.items() if key not in keys]
+        if stale:
+            ProductVariation.objects.filter(image__in=stale).update(
+                image=None)
+            ProductImage.objects.filter(id__in=stale).delete()
+            image_ids = dict([(key, id) for key, id in image_ids.items()
+                              if key in keys])
+        new_images = []
+        for record in records:
+            for image in record["images"]:
+                key = (ids[record["slug"]], image["file"])
+                if key not in image_ids:
+                    image_ids[key] = None
+                    new_images.append(ProductImage(product_id=key[0],
+                        file=image["file"], description=image["description"]))
+        if new_images:
+            bulk.insert(ProductImage, new_images)
+            image_ids.update(dict([((image[0], image[1]), image[2])
+                                   for image in images.all()]))
+
+        # Options - insert any that don't exist yet.
+        new_options = []
+        for record in records:
+            for variation in record["variations"]:
+                for field in ProductVariation.option_fields():
+                    key = (int(field.name[len("option"):]),
+                           variation[field.name])
+                    if key[1] and key not in self.options:
+                        self.options.add(key)
+                        new_options.append(ProductOption(type=key[0],
+                                                         name=key[1]))
+        bulk.insert(ProductOption, new_options)
+
+        # Variations - remove those not in the records, then update the
+        # remaining ones by SKU, and insert the rest.
+        skus = [variation["sku"] for record in records
+                for variation in record["variations"]]
+        ProductVariation.objects.filter(product__in=product_ids).exclude(
+            sku__in=skus).delete()
+        variation_ids = dict(ProductVariation.objects.filter(
+            sku__in=skus).values_list("sku", "id"))
+        new_variations = []
+        updated_variations = []
+        for record in records:
+            product_id = ids[record["slug"]]
+            for data in record["variations"]:
+                variation = ProductVariation(product_id=product_id,
+                                             id=variation_ids.get(data["sku"]))
+                self._set_fields(variation, data, VARIATION_FIELDS)
+                variation.image_id = image_ids.get((product_id,
+                                                    data["image"]))
+                if variation.id is None:
+                    new_variations.append(variation)
+                else:
+                    updated_variations.append(variation)
+        bulk.insert(ProductVariation, new_variations)
+        fields = ("product", "image") + VARIATION_FIELDS
+        bulk.update(ProductVariation, fields, updated_variations)
+
+        # Anything cached for the products is now out of date.
+        ProductUpsell.objects.update_for(product_ids)
+        catalog.touch(products=product_ids)
+
+
+def load_products(chunks):
+    """
+    Writes each of the given lists of product dicts in its own
+    transaction, returning the number of products written.
+    """
+    loader = ProductLoader()
+    total = 0
+    for records in chunks:
+        transaction.commit_on_success(loader.load)(records)
+        total += len(records)
+    catalog.bump(catalog.SITE)
+    return total
+
+
+class JSONLinesSerializer(object):
+    """
+    Writes each product as a JSON object on its own line, so that the
+    file can be written and read a product at a time.
+    """
+
+    def write(self, chunks, file_name):
+        f = _open(file_name, "wb")
+        try:
+            for records in chunks:
+                for record in records:
+                    f.write(simplejson.dumps(record))
+                    f.write("\n")
+        finally:
+            f.close()
+
+    def read(self, file_name, chunk_size):
+        f = _open(file_name, "rb")
+        try:
+            records = []
+            for line in f:
+                if line.strip():
+                    records.append(simplejson.loads(line))
+                if len(records) == chunk_size:
+                    yield records
+                    records = []
+            if records:
+                yield records
+        finally:
+            f.close()
+
+
+class ColumnarSerializer(object):
+    """
+    Writes each chunk of products as NumPy arrays in a zip file that
+    ``numpy.load`` can open, with a table of arrays per chunk for the
+    products, and for their categories, images and variations, which
+    each have an array of the index of their product in the chunk.
+    Each column is stored as an array typed by its model field, with
+    an array marking which values are null, so that columns can be
+    analysed without converting them: prices as floats, integers and
+    booleans as such, and dates as ``datetime64`` values. Strings are
+    stored as a single array of UTF-8 bytes with an array of offsets.
+    Each chunk is read from the file whole, as it was written, and its
+    products are yielded in chunks of the chunk size given when
+    reading, with prices rounded back to their field's decimal places.
+    """
+
+    tables = (
+        ("products", PRODUCT_FIELDS),
+        ("categories", ("product", "path")),
+        ("images", ("product",) + IMAGE_FIELDS),
+        ("variations", ("product", "image") + VARIATION_FIELDS),
+    )
+    models = {
+        "products": Product,
+        "images": ProductImage,
+        "variations": ProductVariation,
+    }
+    # Array types and the values stored for nulls, by field type.
+    dtypes = {
+        "DecimalField": ("float64", 0),
+        "IntegerField": ("int64", 0),
+        "BooleanField": ("bool", False),
+        "DateTimeField": ("datetime64[s]", "1970-01-01T00:00:00"),
+    }
+
+    def __init__(self):
+        if not HAS_NUMPY:
+            raise ImportError("NumPy is required for the columnar format")
+        self.fields = {}
+        for table, names in self.tables:
+            if table not in self.models:
+                continue
+            for name in names:
+                field = self.models[table]._meta.get_field(name)
+                if field.get_internal_type() in self.dtypes:
+                    self.fields[(table, name)] = field
+
+    def _tables(self, records):
+        """
+        Returns a dict of table names to lists of rows for the given
+        product dicts.
+        """
+        rows = dict([(table, []) for table, fields in self.tables])
+        for i, record in enumerate(records):
+            rows["products"].append([record[name] for name in
+                                     PRODUCT_FIELDS])
+            for path in record["categories"]:
+                rows["categories"].append([i, u"\n".join(path)])
+            for image in record["images"]:
+                rows["images"].append([i] + [image[name] for name in
+                                             IMAGE_FIELDS])
+            for variation in record["variations"]:
+                rows["variations"].append([i, variation["image"]] +
+                    [variation[name] for name in VARIATION_FIELDS])
+        return rows
+
+    def _write_array(self, archive, name, array):
+        f = StringIO()
+        numpy.lib.format.write_array(f, array)
+        archive.writestr("%s.npy" % name, f.getvalue())
+
+    def _write_column(self, archive, name, field, values):
+        """
+        Writes the given values as an array typed by the given field,
+        or as strings if there's no field.
+        """
+        nulls = numpy.array([v is None for v in values], dtype=bool)
+        self._write_array(archive, name + ".null", nulls)
+        if field is not None:
+            dtype, null = self.dtypes[field.get_internal_type()]
+            if dtype.startswith("datetime64"):
+                # Dates are dumped as strings with a space.
+                values = [v and v.replace(" ", "T") for v in values]
+            values = [null if v is None else v for v in values]
+            self._write_array(archive, name, numpy.array(values, dtype=dtype))
+            return
+        values = [unicode(v).encode("utf-8")
+                  for v in values if v is not None]
+        offsets = numpy.cumsum([0] + map(len, values))
+        data = numpy.frombuffer("".join(values) or "\0", dtype=numpy.uint8)
+        self._write_array(archive, name + ".offsets", offsets)
+        self._write_array(archive, name + ".data", data)
+
+    def write(self, chunks, file_name):
+        archive = zipfile.ZipFile(file_name, "w", zipfile.ZIP_DEFLATED)
+        try:
+            for i, records in enumerate(chunks):
+                rows = self._tables(records)
+                for table, fields in self.tables:
+                    for j, field in enumerate(fields):
+                        name = "%06d/%s/%s" % (i, table, field)
+                        values = [row[j] for row in rows[table]]
+                        if field == "product":
+                            self._write_array(archive, name,
+                                numpy.array(values, dtype=numpy.int32))
+                        else:
+                            self._write_column(archive, name,
+                                self.fields.get((table, field)), values)
+        finally:
+            archive.close()
+
+    def _read_column(self, arrays, name, field):
+        """
+        Returns the list of values for the given column name, in the
+        form ``dump_products`` gives them for the given field, or as
+        strings if there's no field.
+        """
+        if name.endswith("/product"):
+            return arrays[name].tolist()
+        nulls = arrays[name + ".null"].tolist()
+        if field is None:
+            data = arrays[name + ".data"].tostring()
+            offsets = arrays[name + ".offsets"]
+            values = iter([data[offsets[i]:offsets[i + 1]].decode("utf-8")
+                           for i in range(len(offsets) - 1)])
+            return [None if null else values.next() for null in nulls]
+        values = arrays[name].tolist()
+        internal_type = field.get_internal_type()
+        if internal_type == "DecimalField":
+            values = [u"%.*f" % (field.decimal_places, v) for v in values]
+        elif internal_type == "DateTimeField":
+            values = [_value(v) for v in values]
+        return [None if null else value for null, value in zip(nulls, values)]
+
+    def read(self, file_name, chunk_size):
+        arrays = numpy.load(file_name)
+        try:
+            chunks = sorted(set([name.split("/")[0]
+                                 for name in arrays.files]))
+            pending = []
+            for chunk in chunks:
+                columns = {}
+                for table, fields in self.tables:
+                    for field in fields:
+                        name = "%s/%s/%s" % (chunk, table, field)
+                        columns[(table, field)] = self._read_column(arrays,
+                            name, self.fields.get((table, field)))
+                records = []
+                for values in zip(*[columns[("products", field)]
+                                    for field in PRODUCT_FIELDS]):
+                    record = dict(zip(PRODUCT_FIELDS, values))
+                    record.update({"categories": [], "images": [],
+                                   "variations": []})
+                    records.append(record)
+                for i, path in zip(columns[("categories", "product")],
+                                   columns[("categories", "path")]):
+                    records[i]["categories"].append(path.split(u"\n"))
+                for table, fields in self.tables[2:]:
+                    for values in zip(*[columns[(table, field)]
+                                        for field in fields]):
+                        records[values[0]][table].append(
+                            dict(zip(fields[1:], values[1:])))
+                pending.extend(records)
+                while len(pending) >= chunk_size:
+                    yield pending[:chunk_size]
+                    pending = pending[chunk_size:]
+            if pending:
+                yield pending
+        finally:
+            arrays.close()
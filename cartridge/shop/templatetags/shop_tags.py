@@ -1,38 +1,25 @@
 
-import locale
 from urllib import quote
 
 from django import template
 from django.template.defaultfilters import slugify
 
-from mezzanine.conf import settings
-
-from cartridge.shop.utils import set_locale
+from cartridge.shop.conf import settings
+from cartridge.shop.currency import format_currency
 
 
 register = template.Library()
 
 
 @register.filter
-def currency(value):
+def currency(value, locale_name=None):
     """
-    Format a value as currency according to locale.
+    Format a value as currency according to locale, optionally with
+    the name of a different locale to use as the filter's argument.
     """
-    set_locale()
     if len(str(value)) == 0:
         value = 0
-    if hasattr(locale, "currency"):
-        value = locale.currency(value)
-    else:
-        # based on locale.currency() in python >= 2.5
-        conv = locale.localeconv()
-        value = [conv["currency_symbol"], conv["p_sep_by_space"] and " " or "", 
-            (("%%.%sf" % conv["frac_digits"]) % value).replace(".", 
-            conv["mon_decimal_point"])]
-        if not conv["p_cs_precedes"]:
-            value.reverse()
-        value = "".join(value)
-    return value
+    return format_currency(value, locale_name)
 
 
 def _order_totals(context):
@@ -45,7 +32,7 @@ def _order_totals(context):
         for f in ("item_total", "shipping_total", "discount_total"):
             context[f] = getattr(context["order"], f)
     elif "cart" in context:
-        context["item_total"] = context["cart"].total_price()
+        context["item_total"] = context["cart"].total_price
         if context["item_total"] == 0:
             # Ignore session if cart has no items, as cart may have 
             # expired sooner than the session.
@@ -97,7 +84,8 @@ def product_sorting(context, products):
 @register.inclusion_tag("shop/product_paging.html", takes_context=True)
 def product_paging(context, products):
     """
-    Renders the links for each page number in a paginated list of products.
+    Renders the links for each page number in a paginated list of products,
+    or the next and previous links for products paged by cursor.
     """
     settings = context["settings"]
     querystring = ""
@@ -105,6 +93,11 @@ def product_paging(context, products):
         value = context["request"].REQUEST.get(name)
         if value is not None:
             querystring += "&%s=%s" % (name, quote(value))
+    if getattr(products, "keyset", False):
+        context.update({"products": products, "querystring": querystring,
+                        "next_cursor": products.next_cursor(),
+                        "previous_cursor": products.previous_cursor()})
+        return context
     page_range = products.paginator.page_range
     page_links = settings.SHOP_MAX_PAGING_LINKS
     if len(page_range) > page_links:
@@ -1,23 +1,81 @@
 
+import csv
+import gzip
+import os
+import re
 from datetime import datetime, timedelta
 from decimal import Decimal
 from operator import mul
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.db.models.signals import pre_save
+from django.test import Client, TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from django.utils.unittest import skipUnless
 
-from mezzanine.conf import settings
+from mezzanine.conf import registry, settings
+from mezzanine.conf.models import Setting
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+from mezzanine.pages.models import Page
 from mezzanine.utils.tests import run_pyflakes_for_package
 
 from cartridge.shop.models import Product, ProductOption, ProductVariation
-from cartridge.shop.models import Category, Cart, Order
+from cartridge.shop.models import Category, CategoryAncestry, Cart, Order
+from cartridge.shop.models import CartItem, IndexVersion
+from cartridge.shop.models import ProductAction, ProductRecommendation
+from cartridge.shop.models import ProductUpsell, Sale
+from cartridge.shop import bulk, catalog
 from cartridge.shop.checkout import CHECKOUT_STEPS
+from cartridge.shop.conf import settings as shop_settings
+from cartridge.shop.currency import CurrencyFormatter
+from cartridge.shop.management.commands import build_recommendations
+from cartridge.shop.middleware import SSLRedirect
+from cartridge.shop.paging import KeysetPaginator
 
 
 TEST_STOCK = 5
 TEST_PRICE = Decimal("20")
 
+# The maximum number of queries for each view and model method, given
+# as a function of the size of its input, such as the number of items
+# in the cart. Most are constant, so that adding items, variations or
+# products doesn't add queries.
+QUERY_BUDGETS = {
+    "category": lambda products: 8,
+    "product": lambda variations: 15,
+    "cart": lambda items: 16,
+    "cart_bulk": lambda items: 7,
+    "cart_panel": lambda items: 4,
+    "wishlist": lambda skus: 8,
+    "checkout": lambda items: 8,
+    "complete": lambda items: 13,
+    "Cart.add_item": lambda items: 7,
+    "Order.setup": lambda items: 5,
+    "Order.complete": lambda items: 12,
+    "Sale.save": lambda products: 16,
+    "Category.filters": lambda options: 2,
+}
+QUERY_BUDGET_SIZES = (1, 5)
+
+
+def fingerprint(sql):
+    """
+    Returns the given SQL with its literal values replaced, so that
+    queries that only differ by their values can be grouped together.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    return re.sub(r"\(\?(, \?)*\)", "(...)", sql)
+
 
 class ShopTests(TestCase):
 
@@ -173,6 +231,51 @@ class ShopTests(TestCase):
         self._category.combined = False
         self.assertCategoryFilteredProducts(1)
 
+    def test_category_descendants(self):
+        """
+        Test the category ancestry is maintained when categories are
+        created and moved, and that products in subcategories are
+        included when ``include_descendants`` is checked.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        child = Category.objects.create(parent=self._category, **published)
+        grandchild = Category.objects.create(parent=child, **published)
+        other = Category.objects.create(**published)
+        ancestry = lambda c: dict(CategoryAncestry.objects.filter(
+            descendant=c).values_list("ancestor", "depth"))
+        self.assertEqual(ancestry(grandchild), {self._category.id: 2,
+                                                child.id: 1, grandchild.id: 0})
+        grandchild.products.add(self._product)
+        self.assertCategoryFilteredProducts(0)
+        self._category.include_descendants = True
+        self.assertCategoryFilteredProducts(1)
+        # Move the subtree to another category.
+        child.parent = other
+        child.save()
+        self.assertEqual(ancestry(grandchild), {other.id: 2, child.id: 1,
+                                                grandchild.id: 0})
+        self.assertCategoryFilteredProducts(0)
+        CategoryAncestry.objects.rebuild()
+        self.assertEqual(ancestry(grandchild), {other.id: 2, child.id: 1,
+                                                grandchild.id: 0})
+        # Move the subtree back as the admin's page tree does, saving
+        # the page rather than the category.
+        page = Page.objects.get(id=child.id)
+        page.parent_id = str(self._category.id)
+        page.save()
+        self.assertEqual(ancestry(grandchild), {self._category.id: 2,
+                                                child.id: 1, grandchild.id: 0})
+        self.assertCategoryFilteredProducts(1)
+        # Move a page that isn't a category, containing the subtree.
+        page = Page.objects.create(title="Container")
+        child.parent = page
+        child.save()
+        page.parent_id = other.id
+        page.save()
+        self.assertEqual(ancestry(grandchild), {other.id: 3, child.id: 1,
+                                                grandchild.id: 0})
+        self.assertCategoryFilteredProducts(0)
+
     def test_cart(self):
         """
         Test the cart object and cart add/remove forms.
@@ -188,7 +291,7 @@ class ShopTests(TestCase):
         cart = Cart.objects.from_request(self.client)
         self.assertFalse(cart.has_items())
         self.assertEqual(cart.total_quantity(), 0)
-        self.assertEqual(cart.total_price(), Decimal("0"))
+        self.assertEqual(cart.total_price, Decimal("0"))
 
         # Add quantity and check stock levels / cart totals.
         field_names = [f.name for f in ProductVariation.option_fields()]
@@ -201,7 +304,7 @@ class ShopTests(TestCase):
         self.assertFalse(variation.has_stock(TEST_STOCK * 2))
         self.assertTrue(cart.has_items())
         self.assertEqual(cart.total_quantity(), TEST_STOCK)
-        self.assertEqual(cart.total_price(), TEST_PRICE * TEST_STOCK)
+        self.assertEqual(cart.total_price, TEST_PRICE * TEST_STOCK)
 
         # Add remaining quantity and check again.
         self.client.post(self._product.get_absolute_url(), data)
@@ -210,7 +313,21 @@ class ShopTests(TestCase):
         self.assertFalse(variation.has_stock())
         self.assertTrue(cart.has_items())
         self.assertEqual(cart.total_quantity(), TEST_STOCK * 2)
-        self.assertEqual(cart.total_price(), TEST_PRICE * TEST_STOCK * 2)
+        self.assertEqual(cart.total_price, TEST_PRICE * TEST_STOCK * 2)
+        self.assertEqual(cart.items.count(), 1)
+
+        # Change quantities, which can't exceed stock.
+        data = {"items-TOTAL_FORMS": 1, "items-INITIAL_FORMS": 1,
+                "items-0-id": cart.items.all()[0].id,
+                "items-0-quantity": TEST_STOCK * 2 + 1}
+        response = self.client.post(reverse("shop_cart"), data)
+        self.assertEqual(response.status_code, 200)
+        data["items-0-quantity"] = TEST_STOCK
+        response = self.client.post(reverse("shop_cart"), data)
+        self.assertRedirects(response, reverse("shop_cart"))
+        cart = Cart.objects.from_request(self.client)
+        self.assertEqual(cart.total_quantity(), TEST_STOCK)
+        self.assertEqual(cart.total_price, TEST_PRICE * TEST_STOCK)
 
         # Remove from cart.
         for item in cart:
@@ -220,7 +337,105 @@ class ShopTests(TestCase):
         self.assertTrue(variation.has_stock(TEST_STOCK * 2))
         self.assertFalse(cart.has_items())
         self.assertEqual(cart.total_quantity(), 0)
-        self.assertEqual(cart.total_price(), Decimal("0"))
+        self.assertEqual(cart.total_price, Decimal("0"))
+
+    def test_cart_concurrent_add(self):
+        """
+        Test adding an item that a concurrent request creates between
+        looking it up and inserting it, which merges the quantities.
+        """
+        self._product.variations.all().delete()
+        self._product.variations.manage_empty()
+        variation = self._product.variations.all()[0]
+        variation.unit_price = TEST_PRICE
+        variation.num_in_stock = TEST_STOCK * 2
+        variation.save()
+        cart = Cart.objects.create()
+
+        def concurrent_add(sender, instance, **kwargs):
+            # Insert the row without sending signals, as the other
+            # request would have, just before this request's insert.
+            bulk.insert(CartItem, [CartItem(cart=cart, sku=variation.sku,
+                unit_price=TEST_PRICE, quantity=1, total_price=TEST_PRICE,
+                description="", url="")])
+
+        pre_save.connect(concurrent_add, sender=CartItem)
+        try:
+            cart.add_item(variation, TEST_STOCK)
+        finally:
+            pre_save.disconnect(concurrent_add, sender=CartItem)
+        items = list(cart.items.all())
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].quantity, TEST_STOCK + 1)
+        self.assertEqual(items[0].total_price, TEST_PRICE * (TEST_STOCK + 1))
+        # Only this request's quantity is added to the totals, as the
+        # other request adds its own.
+        cart = Cart.objects.get(id=cart.id)
+        self.assertEqual(cart.item_count, TEST_STOCK)
+        self.assertEqual(cart.total_price, TEST_PRICE * TEST_STOCK)
+        self.assertFalse(ProductAction.objects.filter(total_cart__gt=0))
+
+    def test_purchased_concurrent(self):
+        """
+        Test increasing the purchase counts of products when another
+        request creates one of their actions for today between
+        looking them up and inserting them.
+        """
+        other = Product.objects.create(status=CONTENT_STATUS_PUBLISHED)
+        self._product.actions.purchased()
+        # Look up no existing actions, as the concurrent request's
+        # action wouldn't have been found.
+        ProductAction.objects.filter = lambda **kwargs: \
+            ProductAction.objects.none()
+        try:
+            ProductAction.objects.purchased_products([other.id,
+                self._product.id, self._product.id])
+        finally:
+            del ProductAction.objects.filter
+        actions = ProductAction.objects.values_list("product",
+                                                    "total_purchase")
+        self.assertEqual(dict(actions), {self._product.id: 3, other.id: 1})
+
+    def test_bulk_add(self):
+        """
+        Test adding multiple SKUs to the cart via form and JSON posts.
+        """
+        self._product.variations.all().delete()
+        self._product.variations.create_from_options(self._options)
+        variations = self._product.variations.all()[:2]
+        for variation in variations:
+            variation.unit_price = TEST_PRICE
+            variation.num_in_stock = TEST_STOCK
+            variation.save()
+        skus = [variation.sku for variation in variations]
+        url = reverse("shop_cart_bulk")
+
+        # All errors are returned together and nothing is added.
+        items = [[skus[0], TEST_STOCK], [skus[0], 1], ["missing", 1], ["x", 0]]
+        response = self.client.post(url, simplejson.dumps(items),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(simplejson.loads(response.content)["errors"]), 1)
+        items.pop()
+        response = self.client.post(url, simplejson.dumps({"items": items}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(simplejson.loads(response.content)["errors"]), 2)
+        self.assertFalse(Cart.objects.from_request(self.client).has_items())
+
+        # Valid lines are all added.
+        data = {"items": "%s %s\n%s" % (skus[0], TEST_STOCK, skus[1])}
+        response = self.client.post(url, data)
+        self.assertRedirects(response, reverse("shop_cart"))
+        cart = Cart.objects.from_request(self.client)
+        self.assertEqual(cart.total_quantity(), TEST_STOCK + 1)
+        self.assertEqual(cart.total_price, TEST_PRICE * (TEST_STOCK + 1))
+        items = [{"sku": skus[1], "quantity": TEST_STOCK - 1}]
+        response = self.client.post(url, simplejson.dumps(items),
+                                    content_type="application/json")
+        self.assertEqual(simplejson.loads(response.content)["item_count"],
+                         TEST_STOCK * 2)
+        self.assertEqual(cart.items.count(), 2)
 
     def test_order(self):
         """
@@ -252,6 +467,7 @@ class ShopTests(TestCase):
             self.fail("Couldn't create an order")
         items = order.items.all()
         variation = self._product.variations.all()[0]
+        cart = Cart.objects.from_request(self.client)
 
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(len(items), 1)
@@ -260,6 +476,849 @@ class ShopTests(TestCase):
         self.assertEqual(variation.num_in_stock, TEST_STOCK)
         self.assertEqual(order.item_total, TEST_PRICE * TEST_STOCK)
 
+    def test_keyset_paging(self):
+        """
+        Test that paging forwards and backwards by cursor visits every
+        product once in sort order, with null sort values last.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        for i in range(7):
+            price = TEST_PRICE if i % 3 else None
+            Product.objects.create(unit_price=price, **published)
+        products = Product.objects.all()
+        expected = list(products.filter(unit_price__isnull=False)
+                                .order_by("-unit_price", "-id"))
+        expected += list(products.filter(unit_price__isnull=True)
+                                 .order_by("-id"))
+        paginator = KeysetPaginator(products, 3, "-unit_price")
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor()))
+        paged = [p for page in pages for p in page.object_list]
+        self.assertEqual(paged, expected)
+        self.assertEqual(paginator.count, len(expected))
+        for i in range(len(pages) - 1, 0, -1):
+            previous = paginator.page(pages[i].previous_cursor())
+            self.assertEqual(previous.object_list, pages[i - 1].object_list)
+        self.assertFalse(previous.has_previous())
+        self.assertEqual(paginator.page("invalid").object_list,
+                         pages[0].object_list)
+
+    def test_keyset_paging_floats(self):
+        """
+        Test that paging by a float sort value, such as the average
+        rating, doesn't skip products sharing a value that can't be
+        represented exactly.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        for i in range(4):
+            Product.objects.create(rating_average=10 / 3.0, **published)
+        products = Product.objects.filter(rating_average__gt=0)
+        expected = list(products.order_by("-rating_average", "-id"))
+        paginator = KeysetPaginator(products, 1, "-rating_average")
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor()))
+        paged = [p for page in pages for p in page.object_list]
+        self.assertEqual(paged, expected)
+        self.assertEqual(len(paged), 4)
+
+    def test_listing(self):
+        """
+        Test that listing products give the same prices and URLs as
+        the full product model.
+        """
+        now = datetime.now()
+        self._product.unit_price = TEST_PRICE
+        self._product.sale_price = TEST_PRICE / 2
+        self._product.sale_from = now - timedelta(days=1)
+        self._product.save()
+        listing = Product.objects.filter(id=self._product.id).listing()
+        self.assertEqual(len(listing), 1)
+        for name in ("on_sale", "has_price", "price", "get_absolute_url"):
+            self.assertEqual(getattr(listing[0], name)(),
+                             getattr(self._product, name)())
+        self.assertEqual(unicode(listing[0]), unicode(self._product))
+
+    def test_catalog_cache(self):
+        """
+        Test that cached catalog data is used until the catalog changes.
+        """
+        setting = registry["SHOP_CATALOG_CACHE_SECONDS"]
+        default = setting["default"]
+        setting["default"] = 300
+        try:
+            self._product.title = "Before"
+            self._product.save()
+            url = self._product.get_absolute_url()
+            self.assertContains(self.client.get(url), "Before")
+            # Updates don't send signals, so the cached product is used.
+            products = Product.objects.filter(id=self._product.id)
+            products.update(title="Stale")
+            self.assertNotContains(self.client.get(url), "Stale")
+            self._product.title = "After"
+            self._product.save()
+            self.assertContains(self.client.get(url), "After")
+            # Nothing is saved when a product is published or expires,
+            # so data is only cached until the next of those.
+            self.assertEqual(catalog._timeout(300), 300)
+            publish_date = datetime.now() + timedelta(seconds=60)
+            products.update(publish_date=publish_date)
+            self.assertTrue(0 < catalog._timeout(300) <= 60)
+            expiry_date = datetime.now() + timedelta(seconds=30)
+            products.update(expiry_date=expiry_date)
+            self.assertTrue(0 < catalog._timeout(300) <= 30)
+        finally:
+            setting["default"] = default
+
+    def test_upsell_products(self):
+        """
+        Test the upsell index is maintained and used for the cart.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        upsell = Product.objects.create(**published)
+        self._product.variations.all().delete()
+        self._product.variations.manage_empty()
+        variation = self._product.variations.all()[0]
+        variation.unit_price = TEST_PRICE
+        variation.save()
+        cart = Cart.objects.create()
+        cart.add_item(variation, 1)
+        self.assertEqual(cart.upsell_products(), [])
+        self._product.upsell_products.add(upsell)
+        self.assertEqual(cart.upsell_products(), [upsell])
+        # Only the index versions and products are loaded once the
+        # cart's items are, regardless of the cache.
+        cart = Cart.objects.get(id=cart.id)
+        list(cart)
+        cache.clear()
+        self.assertNumQueries(2, cart.upsell_products)
+        # Saving variations without changing their SKUs leaves the
+        # index and its version as they are.
+        versions = IndexVersion.objects.versions()
+        variation.save()
+        Product.objects.create(**published).variations.manage_empty()
+        self.assertEqual(IndexVersion.objects.versions(), versions)
+        variation.sku = "changed"
+        variation.save()
+        self.assertNotEqual(IndexVersion.objects.versions(), versions)
+        self.assertEqual(ProductUpsell.objects.for_skus(["changed"]),
+                         [upsell.id])
+        self._product.upsell_products.clear()
+        self.assertEqual(ProductUpsell.objects.count(), 0)
+
+    def test_recommendations(self):
+        """
+        Test building recommendations from orders, and using them when
+        no upsell products are selected.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        products = [self._product, Product.objects.create(**published),
+                    Product.objects.create(**published)]
+        skus = []
+        for product in products:
+            product.variations.manage_empty()
+            variation = product.variations.all()[0]
+            variation.unit_price = TEST_PRICE
+            variation.save()
+            skus.append(variation.sku)
+        for order_skus in ((0, 1), (0, 1), (0, 2), (2,)):
+            order = Order.objects.create()
+            for i in order_skus:
+                order.items.create(sku=skus[i], quantity=1)
+        call_command("build_recommendations", verbosity=0)
+        self.assertEqual(ProductRecommendation.objects.for_products(
+            [products[0].id]), [products[1].id, products[2].id])
+        cart = Cart.objects.create()
+        cart.add_item(products[0].variations.all()[0], 1)
+        self.assertEqual(cart.upsell_products(), products[1:])
+        # Rebuilding the recommendations updates the cart's products.
+        ProductRecommendation.objects.replace([(products[0].id,
+                                                products[2].id, 1)])
+        cart = Cart.objects.get(id=cart.id)
+        self.assertEqual(cart.upsell_products(), products[2:])
+
+    @skipUnless(build_recommendations.HAS_SPARSE, "scipy isn't installed")
+    def test_sparse_pair_counter(self):
+        """
+        Test the sparse matrix pair counter gives the same counts as
+        the dict pair counter, across batches with new products and
+        when discarding pairs to stay within the maximum.
+        """
+        batches = [[set([1, 2, 3]), set([1, 2]), set([4])],
+                   [set([5, 1]), set([2, 5, 3]), set([1, 2])],
+                   [set([6, 3]), set([2, 3])]]
+        for max_pairs in (100, 4):
+            counters = [build_recommendations.PairCounter(max_pairs),
+                        build_recommendations.SparsePairCounter(max_pairs)]
+            results = []
+            for counter in counters:
+                for baskets in batches:
+                    counter.add(baskets)
+                counts = set()
+                for a, b, count, a_orders, b_orders in counter.counts():
+                    if a > b:
+                        a, b, a_orders, b_orders = b, a, b_orders, a_orders
+                    counts.add((a, b, count, a_orders, b_orders))
+                results.append((counts, counter.floor))
+            self.assertEqual(results[0], results[1])
+            self.assertTrue(len(results[0][0]) <= max_pairs)
+        self.assertTrue(results[0][1] > 0)
+
+    def test_product_import(self):
+        """
+        Test importing products from a csv file, adding variations to
+        existing products on a later import.
+        """
+        from cartridge.shop.management.commands import product_db
+        option_type = settings.SHOP_OPTION_TYPE_CHOICES[0][1]
+        rows = [("Imported", "Shirts", "", "imported-1", "test0", "10"),
+                ("Imported", "Shirts", "Long", "imported-2", "test1", "12"),
+                ("Other", "Shirts", "Short", "other-1", "", "5")]
+        csv_file = mkstemp(suffix=".csv")[1]
+        try:
+            for i in range(2):
+                writer = csv.DictWriter(open(csv_file, "w"),
+                                        product_db.fieldnames, restval="")
+                writer.writerow(dict(zip(product_db.fieldnames,
+                                         product_db.fieldnames)))
+                for row in rows:
+                    writer.writerow({product_db.TITLE: row[0],
+                                     product_db.CATEGORY: row[1],
+                                     product_db.SUB_CATEGORY: row[2],
+                                     product_db.SKU: row[3],
+                                     option_type: row[4],
+                                     product_db.UNIT_PRICE: row[5],
+                                     product_db.IMAGE: "N/A"})
+                del writer
+                product_db.import_products(csv_file, chunk_size=1)
+                self.assertRaises(CommandError, product_db.import_products,
+                                  csv_file)
+                rows = [("Imported", "Shirts", "", "imported-3", "", "15")]
+        finally:
+            os.remove(csv_file)
+        product = Product.objects.get(title="Imported")
+        self.assertEqual(product.variations.count(), 3)
+        self.assertEqual(product.variations.get(default=True).sku,
+                         "imported-1")
+        self.assertEqual(product.unit_price, Decimal("10"))
+        categories = product.categories.values_list("title", flat=True)
+        self.assertEqual(set(categories), set(["Shop", "Shirts", "Long"]))
+        self.assertEqual(Category.objects.filter(title="Shirts").count(), 1)
+        # Products are only in the category of a row if it has no
+        # sub-category.
+        other = Product.objects.get(title="Other")
+        categories = other.categories.values_list("title", flat=True)
+        self.assertEqual(set(categories), set(["Shop", "Short"]))
+        self.assertTrue(other.slug)
+        csv_file = mkstemp(suffix=".csv.gz")[1]
+        try:
+            product_db.export_products(csv_file, chunk_size=2)
+            rows = list(csv.DictReader(gzip.open(csv_file)))
+        finally:
+            os.remove(csv_file)
+        rows = dict([(row[product_db.SKU], row) for row in rows])
+        self.assertEqual(set(rows), set(["imported-1", "imported-2",
+                                         "imported-3", "other-1"]))
+        self.assertEqual(rows["imported-2"][product_db.TITLE], "Imported")
+        self.assertEqual(rows["imported-2"][option_type], "test1")
+        self.assertEqual(Decimal(rows["other-1"][product_db.UNIT_PRICE]),
+                         Decimal("5"))
+
+    def test_product_import_update(self):
+        """
+        Test updating products from a csv file by SKU, skipping rows
+        that haven't changed and retiring products not in the file.
+        """
+        from cartridge.shop.management.commands import product_db
+        rows = [("Imported", "imported-1", "10"),
+                ("Imported", "imported-2", "12"),
+                ("Other", "other-1", "5")]
+        csv_file = mkstemp(suffix=".csv")[1]
+        counts = []
+        try:
+            for i in range(3):
+                writer = csv.DictWriter(open(csv_file, "w"),
+                                        product_db.fieldnames, restval="")
+                writer.writerow(dict(zip(product_db.fieldnames,
+                                         product_db.fieldnames)))
+                for row in rows:
+                    writer.writerow({product_db.TITLE: row[0],
+                                     product_db.SKU: row[1],
+                                     product_db.UNIT_PRICE: row[2],
+                                     product_db.IMAGE: "N/A"})
+                del writer
+                counts.append(product_db.import_products(csv_file,
+                    update=True, retire=True))
+                rows = rows[:1] + [("Imported", "imported-2", "14")]
+        finally:
+            os.remove(csv_file)
+        self.assertEqual(counts[0]["inserted"], 3)
+        self.assertEqual(counts[1], {"inserted": 0, "updated": 1,
+                                     "unchanged": 1, "retired": 1,
+                                     "restored": 0})
+        self.assertEqual(counts[2], {"inserted": 0, "updated": 0,
+                                     "unchanged": 2, "retired": 0,
+                                     "restored": 0})
+        variation = ProductVariation.objects.get(sku="imported-2")
+        self.assertEqual(variation.unit_price, Decimal("14"))
+        self.assertEqual(variation.product.variations.count(), 2)
+        self.assertFalse(Product.objects.get(title="Other").available)
+
+    def test_product_import_retire(self):
+        """
+        Test that products are only retired when none of their SKUs
+        are in the csv file, including new SKUs, and that retired
+        products are made available again when they're back in the
+        file, even if their rows haven't changed.
+        """
+        from cartridge.shop.management.commands import product_db
+        csv_file = mkstemp(suffix=".csv")[1]
+
+        def import_rows(*rows):
+            writer = csv.DictWriter(open(csv_file, "w"),
+                                    product_db.fieldnames, restval="")
+            writer.writerow(dict(zip(product_db.fieldnames,
+                                     product_db.fieldnames)))
+            for title, sku in rows:
+                writer.writerow({product_db.TITLE: title,
+                                 product_db.SKU: sku,
+                                 product_db.UNIT_PRICE: "10",
+                                 product_db.IMAGE: "N/A"})
+            del writer
+            return product_db.import_products(csv_file, update=True,
+                                              retire=True)
+
+        def available(title):
+            return Product.objects.get(title=title).available
+
+        try:
+            import_rows(("New", "new-1"))
+            counts = import_rows(("New", "new-2"))
+            self.assertEqual(counts["retired"], 0)
+            self.assertTrue(available("New"))
+            import_rows(("New", "new-2"), ("Returning", "returning-1"))
+            counts = import_rows(("New", "new-2"))
+            self.assertEqual(counts["retired"], 1)
+            self.assertFalse(available("Returning"))
+            counts = import_rows(("New", "new-2"),
+                                 ("Returning", "returning-1"))
+        finally:
+            os.remove(csv_file)
+        self.assertEqual(counts, {"inserted": 0, "updated": 0,
+                                  "unchanged": 2, "retired": 0,
+                                  "restored": 1})
+        self.assertTrue(available("Returning"))
+
+    def test_image_ingestion(self):
+        """
+        Test that imported images with the same contents are stored
+        once, with their thumbnails generated.
+        """
+        from django.conf import settings as django_settings
+        from PIL import Image
+        from cartridge.shop.management.commands import product_db
+        media_root = mkdtemp()
+        local_dir = mkdtemp()
+        originals = (django_settings.MEDIA_ROOT, product_db.LOCAL_IMAGE_DIR,
+                     product_db.PRODUCT_IMAGE_DIR)
+        django_settings.MEDIA_ROOT = media_root
+        product_db.LOCAL_IMAGE_DIR = local_dir
+        product_db.PRODUCT_IMAGE_DIR = os.path.join(media_root,
+            product_db.SITE_MEDIA_IMAGE_DIR)
+        try:
+            for name, colour in (("a", "red"), ("b", "red"), ("c", "blue")):
+                Image.new("RGB", (100, 100), colour).save(
+                    os.path.join(local_dir, "%s.jpg" % name))
+            images = product_db.ingest_images(["a.jpg", "b.jpg", "c.jpg",
+                                               "a.jpg", "N/A"], processes=2)
+            stored = os.listdir(product_db.PRODUCT_IMAGE_DIR)
+            # The product and its default variation use the product's
+            # first image when the default row doesn't have one.
+            csv_file = mkstemp(suffix=".csv")[1]
+            try:
+                writer = csv.DictWriter(open(csv_file, "w"),
+                                        product_db.fieldnames, restval="")
+                writer.writerow(dict(zip(product_db.fieldnames,
+                                         product_db.fieldnames)))
+                for sku, image in (("imaged-1", "N/A"), ("imaged-2", "c.jpg")):
+                    writer.writerow({product_db.TITLE: "Imaged",
+                                     product_db.SKU: sku,
+                                     product_db.IMAGE: image})
+                del writer
+                product_db.import_products(csv_file)
+            finally:
+                os.remove(csv_file)
+        finally:
+            (django_settings.MEDIA_ROOT, product_db.LOCAL_IMAGE_DIR,
+             product_db.PRODUCT_IMAGE_DIR) = originals
+            rmtree(media_root)
+            rmtree(local_dir)
+        self.assertEqual(images["a.jpg"], images["b.jpg"])
+        self.assertNotEqual(images["a.jpg"], images["c.jpg"])
+        self.assertFalse("N/A" in images)
+        sizes = settings.SHOP_IMAGE_THUMBNAIL_SIZES
+        self.assertEqual(len(stored), 2 * (len(sizes) + 1))
+        self.assertTrue("c-%sx%s.jpg" % sizes[0] in stored)
+        product = Product.objects.get(title="Imaged")
+        self.assertEqual(product.image, images["c.jpg"])
+        self.assertEqual(product.variations.get(default=True).image.file,
+                         images["c.jpg"])
+
+    def test_stock_prices(self):
+        """
+        Test updating prices and stock from a feed, and copying the
+        prices to the products of default variations.
+        """
+        self._product.variations.create_from_options(self._options)
+        self._product.variations.manage_empty()
+        variations = list(self._product.variations.all()[:2])
+        for variation in variations:
+            variation.unit_price = TEST_PRICE
+            variation.num_in_stock = TEST_STOCK
+            variation.save()
+        self._product.copy_default_variation()
+        lines = [{"sku": variations[0].sku, "unit_price": "12.50"},
+                 {"sku": variations[1].sku, "num_in_stock": 1},
+                 {"sku": "missing", "unit_price": 1},
+                 # Repeated SKUs keep the last value given.
+                 {"sku": variations[0].sku, "num_in_stock": 2},
+                 {"sku": variations[1].sku, "num_in_stock": 3}]
+        feed_file = mkstemp(suffix=".jsonl")[1]
+        try:
+            feed = open(feed_file, "w")
+            feed.write("\n".join([simplejson.dumps(l) for l in lines]))
+            feed.close()
+            call_command("product_stock_prices", feed_file, verbosity=0)
+        finally:
+            os.remove(feed_file)
+        first, second = [ProductVariation.objects.get(id=variation.id)
+                         for variation in variations]
+        self.assertEqual(first.unit_price, Decimal("12.50"))
+        self.assertEqual(first.num_in_stock, 2)
+        self.assertEqual(second.unit_price, TEST_PRICE)
+        self.assertEqual(second.num_in_stock, 3)
+        product = Product.objects.get(id=self._product.id)
+        self.assertEqual(product.unit_price, Decimal("12.50"))
+
+    def test_catalog_serializers(self):
+        """
+        Test that the catalog serializers round-trip products with all
+        of their categories, images and variations.
+        """
+        from cartridge.shop import serializers
+        child = Category.objects.create(title="Child",
+                                        parent=self._category)
+        self._product.categories.add(self._category, child)
+        image = self._product.images.create(file="product/a.jpg")
+        self._product.images.create(file="product/b.jpg", description="B")
+        self._product.variations.create_from_options(self._options)
+        for variation in self._product.variations.all():
+            variation.unit_price = TEST_PRICE
+            variation.num_in_stock = TEST_STOCK
+            variation.image = image
+            variation.save()
+        self._product.variations.manage_empty()
+        self._product.copy_default_variation()
+        dumped = list(serializers.dump_products(chunk_size=1))
+        formats = ["jsonl"]
+        if serializers.HAS_NUMPY:
+            formats.append("npz")
+        for format in formats:
+            serializer = serializers.get_serializer(format)
+            dump_file = mkstemp(suffix=".%s" % format)[1]
+            try:
+                serializer.write(iter(dumped), dump_file)
+                if format == "npz":
+                    # Columns other than strings are stored typed.
+                    import numpy
+                    arrays = numpy.load(dump_file)
+                    kinds = [arrays["000000/%s" % name].dtype.kind
+                             for name in ("products/title.data",
+                                          "products/unit_price",
+                                          "products/available",
+                                          "products/publish_date",
+                                          "variations/num_in_stock")]
+                    arrays.close()
+                    self.assertEqual(kinds, ["u", "f", "b", "M", "i"])
+                Product.objects.all().delete()
+                Category.objects.all().delete()
+                serializers.load_products(serializer.read(dump_file, 1))
+            finally:
+                os.remove(dump_file)
+            loaded = list(serializers.dump_products(chunk_size=1))
+            self.assertEqual(len(loaded), len(dumped))
+            for records, loaded_records in zip(dumped, loaded):
+                for record, loaded_record in zip(records, loaded_records):
+                    self.assertEqual(record, loaded_record)
+            product = Product.objects.get(slug=self._product.slug)
+            self.assertEqual(product.variations.count(),
+                             len(self._options["option1"]) *
+                             len(self._options["option2"]))
+            self.assertEqual(product.categories.get(title="Child").parent,
+                             product.categories.get(parent=None).page_ptr)
+            # Chunks are read in the given chunk size whatever size
+            # they were written in.
+            dump_file = mkstemp(suffix=".%s" % format)[1]
+            try:
+                serializer.write(iter(dumped * 3), dump_file)
+                chunks = list(serializer.read(dump_file, 2))
+            finally:
+                os.remove(dump_file)
+            self.assertEqual([len(records) for records in chunks], [2, 1])
+        # Images not in the loaded products are removed, without
+        # removing the variations using them.
+        records = [dict(record) for record in dumped[0]]
+        records[0]["images"] = [image for image in records[0]["images"]
+                                if image["file"] != "product/a.jpg"]
+        serializers.load_products([records])
+        product = Product.objects.get(slug=self._product.slug)
+        self.assertEqual(list(product.images.values_list("file", flat=True)),
+                         ["product/b.jpg"])
+        self.assertEqual(product.variations.count(),
+                         len(self._options["option1"]) *
+                         len(self._options["option2"]))
+        self.assertEqual(product.variations.filter(image__isnull=False
+                                                   ).count(), 0)
+
+    def test_generate_catalog(self):
+        """
+        Test generating a catalog, and that the same seed generates the
+        same data.
+        """
+        options = {"categories": 5, "products": 5, "carts": 2, "orders": 3,
+                   "chunk_size": 2, "processes": 1, "verbosity": 0}
+        categories = Category.objects.count()
+        titles = []
+        for prefix in ("first", "second"):
+            call_command("generate_catalog", prefix=prefix, **options)
+            products = Product.objects.filter(slug__startswith=prefix)
+            titles.append(list(products.order_by("slug").values_list(
+                "title", "unit_price")))
+            variations = ProductVariation.objects.filter(
+                product__in=products)
+            self.assertEqual(variations.count(), 5 * 3 * 2)
+            self.assertEqual(variations.filter(default=True).count(), 5)
+            orders = Order.objects.filter(key__startswith=prefix)
+            self.assertEqual(orders.count(), 3)
+            for order in orders:
+                items = order.items.all()
+                self.assertEqual(order.total, sum([item.total_price
+                                                   for item in items]))
+        self.assertEqual(len(titles[0]), 5)
+        self.assertEqual(titles[0], titles[1])
+        self.assertEqual(Category.objects.count(), categories + 10)
+        self.assertEqual(Cart.objects.count(), 4)
+        for cart in Cart.objects.all():
+            self.assertEqual(cart.item_count, sum([item.quantity
+                                                   for item in cart]))
+
+    def test_benchmark_views(self):
+        """
+        Test benchmarking the views against a generated catalog.
+        """
+        call_command("generate_catalog", categories=3, products=5,
+                     carts=0, orders=0, processes=1, verbosity=0)
+        output = mkstemp(suffix=".json")[1]
+        try:
+            call_command("benchmark_views", requests=4, warmup=1, targets=3,
+                         output=output, verbosity=0,
+                         scenarios="product,category,cart,wishlist,checkout")
+            results = simplejson.load(open(output))
+        finally:
+            os.remove(output)
+        self.assertEqual(results["catalog"]["products"], 6)
+        for scenario, summary in results["scenarios"].items():
+            self.assertEqual(summary["requests"], 4, scenario)
+            self.assertEqual(summary["errors"], 0, scenario)
+            self.assertTrue(summary["queries_mean"] > 0, scenario)
+        # Percentiles are nearest rank, including when the rank is a
+        # whole number.
+        from cartridge.shop.management.commands.benchmark_views import \
+            _percentile
+        values = range(1, 201)
+        self.assertEqual([_percentile(values, p) for p in (0, 50, 99, 100)],
+                         [1, 100, 198, 200])
+        self.assertEqual(_percentile([1, 2, 3], 50), 2)
+
+    def test_benchmark_primitives(self):
+        """
+        Test benchmarking the pricing and option primitives.
+        """
+        output = mkstemp(suffix=".json")[1]
+        try:
+            call_command("benchmark_primitives", number=1000, repeat=1,
+                         output=output, verbosity=0)
+            results = simplejson.load(open(output))
+        finally:
+            os.remove(output)
+        self.assertEqual(len(results["primitives"]), 9)
+        for name, summary in results["primitives"].items():
+            self.assertTrue(summary["ops_per_sec"] > 0, name)
+        # A list of ten tuples.
+        allocations = lambda name: round(results["primitives"][name]
+                                         ["allocations"])
+        self.assertEqual(allocations("make_choices"), 11)
+        self.assertEqual(allocations("Priced.price"), 0)
+
+    def assertQueryBudget(self, name, size, func, *args, **kwargs):
+        """
+        Calls the given function with the given args and checks that
+        the number of queries run is within the budget for the given
+        name and input size, listing the queries grouped by their
+        fingerprint if not. Returns the function's result.
+        """
+        budget = QUERY_BUDGETS[name](size)
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            result = func(*args, **kwargs)
+            queries = [query["sql"] for query in connection.queries]
+        finally:
+            connection.use_debug_cursor = None
+            connection.queries = []
+        if len(queries) > budget:
+            counts = {}
+            for sql in queries:
+                key = fingerprint(sql)
+                counts[key] = counts.get(key, 0) + 1
+            counts = sorted(counts.items(), key=lambda c: -c[1])
+            self.fail("%s ran %s queries for size %s, over its budget of "
+                      "%s:\n%s" % (name, len(queries), size, budget,
+                      "\n".join(["%4s x %s" % (c, sql) for sql, c in counts])))
+        return result
+
+    def _query_budget_catalog(self, size):
+        """
+        Creates the given number of products in the test category,
+        each with the given number of variations, and returns the SKU
+        of a variation for each product.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        option_field, options = self._options.items()[0]
+        skus = []
+        for i in range(size):
+            product = Product.objects.create(**published)
+            self._category.products.add(product)
+            product.variations.create_from_options({option_field:
+                                                    options[:size]})
+            product.variations.all().update(unit_price=TEST_PRICE,
+                                            num_in_stock=TEST_STOCK)
+            skus.append(product.variations.all()[0].sku)
+        return skus
+
+    def _query_budget_request(self, size):
+        """
+        Returns a request with a session and a cart with the given
+        number of items.
+        """
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request.session.save()
+        skus = self._query_budget_catalog(size)
+        variations = ProductVariation.objects.from_skus(skus)
+        Cart.objects.from_request(request).add_items(
+            [(variations[sku], 1) for sku in skus])
+        return request
+
+    def test_query_budgets_views(self):
+        """
+        Test the number of queries for each view stays within its
+        budget as the number of products, variations and cart items
+        grows.
+        """
+        for size in QUERY_BUDGET_SIZES:
+            client = Client()
+            skus = self._query_budget_catalog(size)
+            product = ProductVariation.objects.get(sku=skus[0]).product
+            client.post(reverse("shop_cart_bulk"), {"items": "\n".join(skus)})
+            client.cookies["wishlist"] = ",".join(skus)
+            for name, url in (
+                ("category", self._category.get_absolute_url()),
+                ("product", product.get_absolute_url()),
+                ("cart", reverse("shop_cart")),
+                ("cart_bulk", reverse("shop_cart_bulk")),
+                ("cart_panel", reverse("shop_cart_panel")),
+                ("wishlist", reverse("shop_wishlist")),
+                ("checkout", reverse("shop_checkout"))):
+                response = self.assertQueryBudget(name, size, client.get, url)
+                self.assertEqual(response.status_code, 200)
+            response = client.post(reverse("shop_checkout"),
+                                   {"step": len(CHECKOUT_STEPS)})
+            self.assertEqual(response.status_code, 302)
+            response = self.assertQueryBudget("complete", size, client.get,
+                                              reverse("shop_complete"))
+            self.assertEqual(response.status_code, 200)
+
+    def test_query_budgets_models(self):
+        """
+        Test the number of queries for model methods on the cart,
+        orders, sales and categories stays within their budgets as
+        the number of items, products and options grows.
+        """
+        for size in QUERY_BUDGET_SIZES:
+            # Adding an item to a cart with other items.
+            request = self._query_budget_request(size)
+            cart = Cart.objects.from_request(request)
+            sku = self._query_budget_catalog(1)[0]
+            variation = ProductVariation.objects.from_skus([sku])[sku]
+            self.assertQueryBudget("Cart.add_item", size, cart.add_item,
+                                   variation, 1)
+            # Setting up and completing an order for a cart.
+            request = self._query_budget_request(size)
+            order = Order(**dict([(f.name, "x") for f in Order._meta.fields
+                                  if f.name.startswith("billing_detail") or
+                                  f.name.startswith("shipping_detail")]))
+            request.session["order"] = {}
+            self.assertQueryBudget("Order.setup", size, order.setup, request)
+            self.assertEqual(order.items.count(), size)
+            self.assertQueryBudget("Order.complete", size, order.complete,
+                                   request)
+            product_ids = order.items.values_list("sku", flat=True)
+            product_ids = ProductVariation.objects.filter(
+                sku__in=list(product_ids)).values_list("product", flat=True)
+            purchased = ProductAction.objects.filter(total_purchase=1,
+                                                     product__in=product_ids)
+            self.assertEqual(purchased.count(), size)
+            # Saving a sale for products and categories.
+            products = Product.objects.all()[:size]
+            sale = Sale.objects.create(active=True, discount_deduct=1)
+            sale.products.add(*products)
+            sale.categories.add(self._category)
+            self.assertQueryBudget("Sale.save", size, sale.save)
+            # Building the filters for a category with options.
+            option_field, options = self._options.items()[0]
+            self._category.options.add(*ProductOption.objects.filter(
+                type=option_field[-1], name__in=options[:size]))
+            self.assertQueryBudget("Category.filters", size,
+                                   self._category.filters)
+
+    def test_page_cache(self):
+        """
+        Test that full pages are cached for anonymous users with the
+        cart loaded separately.
+        """
+        setting = registry["SHOP_PAGE_CACHE_SECONDS"]
+        default = setting["default"]
+        setting["default"] = 300
+        try:
+            self._product.title = "Before"
+            self._product.save()
+            url = self._product.get_absolute_url()
+            response = self.client.get(url)
+            self.assertContains(response, reverse("shop_cart_panel"))
+            self.assertNotContains(response, "Cart contains")
+            Product.objects.filter(id=self._product.id).update(title="Stale")
+            self.assertNotContains(self.client.get(url), "Stale")
+            self._product.title = "After"
+            self._product.save()
+            self.assertContains(self.client.get(url), "After")
+            response = self.client.get(reverse("shop_cart_panel"))
+            self.assertContains(response, "Cart contains")
+            self.assertContains(response, "csrfmiddlewaretoken")
+        finally:
+            setting["default"] = default
+
+    def test_conditional_get(self):
+        """
+        Test that product and category pages are only sent when they've
+        been modified since the visitor's copy.
+        """
+        self._category.title = "Category"
+        self._category.save()
+        product_url = self._product.get_absolute_url()
+        category_url = self._category.get_absolute_url()
+        for url in (product_url, category_url):
+            response = Client().get(url)
+            etag = response["ETag"]
+            since = response["Last-Modified"]
+            response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = Client().get(url, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, 304)
+            # Changing a product's categories modifies both.
+            self._product.categories.add(self._category)
+            response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self._product.categories.clear()
+        # Variations modify their product.
+        etag = Client().get(product_url)["ETag"]
+        self._product.variations.create(unit_price=Decimal("10"))
+        response = Client().get(product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # Categories with filters are modified by the products they
+        # match, without being updated themselves.
+        self._category.price_min = Decimal("1")
+        self._category.save()
+        etag = Client().get(category_url)["ETag"]
+        date_modified = Category.objects.get(id=self._category.id
+                                             ).date_modified
+        self._product.variations.create(unit_price=Decimal("20"))
+        response = Client().get(category_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Category.objects.get(id=self._category.id
+                                              ).date_modified, date_modified)
+        # Pages that contain the visitor's cart are always sent.
+        self.client.get(product_url)
+        response = self.client.get(product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_currency(self):
+        """
+        Test currency formatting with different monetary conventions.
+        """
+        conv = {"currency_symbol": "$", "frac_digits": 2,
+                "mon_decimal_point": ".", "p_cs_precedes": 1,
+                "p_sep_by_space": 0, "p_sign_posn": 1, "positive_sign": "",
+                "n_cs_precedes": 1, "n_sep_by_space": 0, "n_sign_posn": 1,
+                "negative_sign": "-"}
+        formatter = CurrencyFormatter(conv)
+        self.assertEqual(formatter.format(Decimal("1234.5")), "$1234.50")
+        self.assertEqual(formatter.format(-3.005), "-$3.01")
+        self.assertEqual(formatter.format(0), "$0.00")
+        conv.update({"currency_symbol": "EUR", "mon_decimal_point": ",",
+                     "p_cs_precedes": 0, "p_sep_by_space": 1,
+                     "n_cs_precedes": 0, "n_sep_by_space": 1,
+                     "n_sign_posn": 0})
+        formatter = CurrencyFormatter(conv)
+        self.assertEqual(formatter.format(Decimal("9.99")), "9,99 EUR")
+        self.assertEqual(formatter.format(Decimal("-9.99")), "(9,99 EUR)")
+        self.assertRaises(AttributeError, setattr, formatter,
+                          "frac_digits", 3)
+
+    def test_editable_settings(self):
+        """
+        Test that editable settings are kept loaded until one is saved.
+        """
+        default = registry["SHOP_PER_PAGE_SEARCH"]["default"]
+        self.assertEqual(shop_settings.SHOP_PER_PAGE_SEARCH, default)
+        setting = Setting(name="SHOP_PER_PAGE_SEARCH", value=default + 1)
+        setting.save()
+        self.assertEqual(shop_settings.SHOP_PER_PAGE_SEARCH, default + 1)
+        Setting.objects.filter(id=setting.id).update(value=default + 2)
+        self.assertEqual(shop_settings.SHOP_PER_PAGE_SEARCH, default + 1)
+        setting.delete()
+        self.assertEqual(shop_settings.SHOP_PER_PAGE_SEARCH, default)
+
+    def test_ssl_redirect(self):
+        """
+        Test the SSL paths and path prefixes are redirected to.
+        """
+        setting = registry["SHOP_FORCE_SSL_VIEWS"]
+        default = setting["default"]
+        setting["default"] = ("shop_checkout", "/account/")
+        middleware = SSLRedirect()
+        request = RequestFactory().get(reverse("shop_checkout"))
+        try:
+            self.assertTrue(middleware._is_ssl_path(request))
+            request.path = "/account/orders/"
+            self.assertTrue(middleware._is_ssl_path(request))
+            request.path = reverse("shop_cart")
+            self.assertFalse(middleware._is_ssl_path(request))
+        finally:
+            setting["default"] = default
+
     def test_with_pyflakes(self):
         """
         Run pyflakes across the code base to check for potential errors.
@@ -9,9 +9,11 @@ urlpatterns = patterns("cartridge.shop.views",
     url("^search/$", "search", name="shop_search"),
     url("^wishlist/$", "wishlist", name="shop_wishlist"),
     url("^cart/$", "cart", name="shop_cart"),
+    url("^cart/bulk/$", "cart_bulk", name="shop_cart_bulk"),
+    url("^cart/panel/$", "cart_panel", name="shop_cart_panel"),
     url("^checkout/$", "checkout_steps", name="shop_checkout"),
     url("^checkout/complete/$", "complete", name="shop_complete"),
-)
+)
 
 if getattr(settings, "SHOP_CHECKOUT_ACCOUNT_ENABLED", False):
     urlpatterns += patterns("cartridge.shop.views",
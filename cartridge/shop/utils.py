@@ -1,16 +1,13 @@
 
 import hmac
-from locale import setlocale, LC_MONETARY
 from datetime import datetime, timedelta
 try:
     from hashlib import sha512 as digest
 except ImportError:
     from md5 import new as digest
 
-from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMultiAlternatives
 from django.template import loader, Context
-from django.utils.translation import ugettext as _
 
 from mezzanine.conf import settings
 
@@ -69,20 +66,3 @@ def send_mail_template(subject, template, addr_from, addr_to, context=None,
     for attachment in attachments:
         msg.attach(attachment)
     msg.send(fail_silently=fail_silently)
-
-
-def set_locale():
-    """
-    Sets the locale for currency formatting.
-    """
-    currency_locale = settings.SHOP_CURRENCY_LOCALE
-    try:
-        if setlocale(LC_MONETARY, currency_locale) == "C":
-            # C locale doesn't contain a suitable value for "frac_digits".
-            raise
-    except:
-        msg = _("Invalid currency locale specified for SHOP_CURRENCY_LOCALE: "
-                "'%s'. You'll need to set the locale for your system, or "
-                "configure the SHOP_CURRENCY_LOCALE setting in your settings "
-                "module.")
-        raise ImproperlyConfigured(msg % currency_locale)
@@ -2,21 +2,25 @@
 from django.contrib.auth import logout as auth_logout
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.template import RequestContext
 from django.template.defaultfilters import slugify
 from django.utils import simplejson
 from django.utils.translation import ugettext as _
+from django.views.decorators.cache import never_cache
 
-from mezzanine.conf import settings
 from mezzanine.utils.importing import import_dotted_path
 from mezzanine.utils.views import render_to_response
 
-from cartridge.shop import checkout
-from cartridge.shop.forms import OrderForm, LoginForm, SignupForm
+from cartridge.shop import catalog, checkout
+from cartridge.shop.conf import settings
+from cartridge.shop.forms import BulkAddProductForm, OrderForm, LoginForm
+from cartridge.shop.forms import CartItemFormSet, SignupForm
 from cartridge.shop.forms import get_add_product_form
 from cartridge.shop.models import Product, ProductVariation, Cart, Order
+from cartridge.shop.models import ProductRecommendation
+from cartridge.shop.paging import KeysetPaginator
 from cartridge.shop.utils import set_cookie, set_shipping, sign
 
 
@@ -37,7 +41,9 @@ except ImportError:
 
 def product_list(products, request, per_page):
     """
-    Handle pagination and sorting for the given products.
+    Handle pagination and sorting for the given products. If
+    ``SHOP_PAGING_KEYSET`` is ``True`` and a sort option is selected,
+    products are paged by cursor rather than page number.
     """
     sort_options = settings.SHOP_PRODUCT_SORT_OPTIONS
     sort_options = [(slugify(o[0]), o[1]) for o in sort_options]
@@ -47,6 +53,13 @@ def product_list(products, request, per_page):
     sort_value = dict(sort_options).get(sort_name)
     if sort_value is not None:
         products = products.order_by(sort_value)
+        # Keyset paging requires a sort field on the product itself
+        # to filter against.
+        if settings.SHOP_PAGING_KEYSET and "__" not in sort_value:
+            paginator = KeysetPaginator(products, per_page, sort_value)
+            products = paginator.page(request.GET.get("cursor"))
+            products.sort = sort_name
+            return products
     paginator = Paginator(products, per_page)
     try:
         page_num = int(request.GET.get("page", 1))
@@ -65,8 +78,14 @@ def product(request, slug, template="shop/product.html"):
     Display a product - convert the product variations to JSON as well as 
     handling adding the product to either the cart or the wishlist.
     """
+    modified = lambda: catalog.product_modified(slug)
+    response = catalog.not_modified(request, modified)
+    if response is not None:
+        return response
     published_products = Product.objects.published(for_user=request.user)
-    product = get_object_or_404(published_products, slug=slug)
+    product = catalog.get_or_set("product-%s" % slug, [catalog.SITE],
+        lambda: get_object_or_404(published_products, slug=slug),
+        for_user=request.user)
     AddProductForm = get_add_product_form(product)
     add_product_form = AddProductForm(initial={"quantity": 1})
     if request.method == "POST":
@@ -91,22 +110,41 @@ def product(request, slug, template="shop/product.html"):
     # Build variations JSON from list of variation dicts.
     fields = [f.name for f in ProductVariation.option_fields()]
     fields.extend(["sku", "image_id"])
+    user = request.user
+    scopes = [catalog.product_scope(product.id)]
+    all_variations = catalog.get_or_set("variations", scopes,
+        lambda: list(product.variations.all()), for_user=user)
     variations = []
     variations_json = []
     has_available_variations = False
-    for variation in product.variations.all():
+    for variation in all_variations:
         if not has_available_variations and variation.has_price():
             has_available_variations = True
         variations.append(variation)
         variation_dict = dict([(f, getattr(variation, f)) for f in fields])
         variations_json.append(variation_dict)
     variations_json = simplejson.dumps(variations_json)
-    related = product.related_products.published(for_user=request.user)
-    context = {"product": product, "images": list(product.images.all()), 
+    images = catalog.get_or_set("images", scopes,
+        lambda: list(product.images.all()), for_user=user)
+
+    def related_products():
+        # Fall back to products bought together with this one.
+        related = list(product.related_products.published(for_user=user))
+        if not related:
+            ids = ProductRecommendation.objects.for_products([product.id])
+            published = Product.objects.published(for_user=user)
+            related = sorted(published.filter(id__in=ids),
+                             key=lambda p: ids.index(p.id))
+        return related
+
+    related = catalog.get_or_set("related", scopes + [catalog.SITE],
+                                 related_products, for_user=user)
+    context = {"product": product, "images": images, 
                "variations": variations, "variations_json": variations_json,
                "has_available_variations": has_available_variations,
-               "related_products": list(related),
+               "related_products": related,
                "add_product_form": add_product_form}
+    catalog.cache_page(request)
     return render_to_response(template, context, RequestContext(request))
 
 
@@ -114,11 +152,14 @@ def search(request, template="shop/search_results.html"):
     """
     Display product search results.
     """
-    settings.use_editable()
     query = request.REQUEST.get("query", "")
     results = Product.objects.published_for(user=request.user).search(query)
+    # Searches without any terms give an empty queryset to list.
+    if hasattr(results, "listing"):
+        results = results.listing()
     results = product_list(results, request, settings.SHOP_PER_PAGE_SEARCH)
     context = {"query": query, "results": results}
+    catalog.cache_page(request)
     return render_to_response(template, context, RequestContext(request))
 
     
@@ -136,7 +177,9 @@ def wishlist(request, template="shop/wishlist.html"):
         if to_cart:
             quantity = 1
             try:
-                variation = ProductVariation.objects.get(sku=sku)
+                variations = ProductVariation.objects.select_related(
+                    "product", "image")
+                variation = variations.get(sku=sku)
             except ProductVariation:
                 error = _("This item is no longer available")
             else:
@@ -173,14 +216,74 @@ def wishlist(request, template="shop/wishlist.html"):
 
 def cart(request, template="shop/cart.html"):
     """
-    Display cart and handle removing items from the cart.
+    Display cart and handle removing items from the cart, or changing
+    the quantities of all items at once.
     """
-    if request.method == "POST":
-        cart = Cart.objects.from_request(request)
+    cart = Cart.objects.from_request(request)
+    if request.method == "POST" and "item_id" in request.POST:
         cart.remove_item(request.POST.get("item_id"))
         info(request, _("Item removed from cart"), fail_silently=True)
         return HttpResponseRedirect(reverse("shop_cart"))
-    return render_to_response(template, {}, RequestContext(request))
+    cart_formset = CartItemFormSet(request.POST or None, instance=cart)
+    if request.method == "POST" and cart_formset.is_valid():
+        cart_formset.save()
+        info(request, _("Cart updated"), fail_silently=True)
+        return HttpResponseRedirect(reverse("shop_cart"))
+    context = {"cart": cart, "cart_formset": cart_formset}
+    return render_to_response(template, context, RequestContext(request))
+
+
+def cart_bulk(request, template="shop/cart_bulk.html"):
+    """
+    Display and handle the form for adding multiple items to the cart
+    by SKU. The items can also be posted as JSON, either as a list or
+    under an ``items`` key, in which case the cart totals, or the
+    errors for each line, are returned as JSON.
+    """
+    content_type = request.META.get("CONTENT_TYPE", "")
+    is_json = content_type.startswith("application/json")
+    data = None
+    if request.method == "POST":
+        data = request.POST
+        if is_json:
+            try:
+                items = simplejson.loads(request.raw_post_data)
+            except ValueError:
+                items = None
+            if isinstance(items, dict):
+                items = items.get("items")
+            data = {"items": items}
+    bulk_add_form = BulkAddProductForm(data, for_user=request.user)
+    if request.method == "POST":
+        if bulk_add_form.is_valid():
+            cart = Cart.objects.from_request(request)
+            cart.add_items(bulk_add_form.lines)
+            if not is_json:
+                info(request, _("Items added to cart"), fail_silently=True)
+                return HttpResponseRedirect(reverse("shop_cart"))
+            result = {"item_count": cart.item_count,
+                      "total_price": unicode(cart.total_price)}
+            status = 200
+        elif is_json:
+            errors = bulk_add_form.errors.get("items", [])
+            result = {"errors": [unicode(error) for error in errors]}
+            status = 400
+        if is_json:
+            return HttpResponse(simplejson.dumps(result), status=status,
+                                mimetype="application/json")
+    context = {"bulk_add_form": bulk_add_form}
+    return render_to_response(template, context, RequestContext(request))
+
+
+@never_cache
+def cart_panel(request, template="shop/cart_panel.html"):
+    """
+    Display the cart and wishlist summary on its own, for loading into
+    pages cached with ``SHOP_PAGE_CACHE_SECONDS``. Also includes the
+    visitor's CSRF token, which is removed from cached pages.
+    """
+    context = {"panel_only": True}
+    return render_to_response(template, context, RequestContext(request))
 
 
 def account(request, template="shop/account.html"):
@@ -270,7 +373,7 @@ def checkout_steps(request):
                 discount = getattr(form, "discount", None)
                 if discount is not None:
                     cart = Cart.objects.from_request(request)
-                    discount_total = discount.calculate(cart.total_price())
+                    discount_total = discount.calculate(cart.total_price)
                     if discount.free_shipping:
                         set_shipping(request, _("Free shipping"), 0)
                     request.session["free_shipping"] = discount.free_shipping